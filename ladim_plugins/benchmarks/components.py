@@ -0,0 +1,139 @@
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from .compute_w import synthetic_frame
+from .synthetic import START_TIME, write_roms_file, synthetic_model
+
+
+def seconds_per_call(fn, *args, repeat=3, **kwargs):
+    """Return the result of a function and the mean time per call [s]"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) / repeat
+
+
+def forcing_update_speed(imax=100, jmax=80, N=20, steps=18, **gridforce):
+    """Time per step of the chemicals Forcing.update
+
+    The forcing file has hourly records, and the model time step is 600
+    seconds. New frames are therefore read every sixth time step. Keyword
+    arguments are added to the gridforce configuration.
+    """
+    results = dict()
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = os.path.join(tempdir, 'forcing.nc')
+        write_roms_file(fname, imax, jmax, N)
+
+        start = time.perf_counter()
+        grid, forcing = synthetic_model(fname, dt=600, **gridforce)
+        results['seconds_init'] = time.perf_counter() - start
+
+        seconds = []
+        for t in range(steps):
+            start = time.perf_counter()
+            forcing.update(t)
+            seconds.append(time.perf_counter() - start)
+        forcing.close()
+
+    results['seconds_per_step'] = sum(seconds) / steps
+    results['seconds_max_step'] = max(seconds)
+    return results
+
+
+def compute_w_speed(imax=400, jmax=300, N=35, repeat=3):
+    """Time per call of the standard and lean compute_w engines"""
+    from ..chemicals.gridforce import compute_w, compute_w_lean
+
+    f = synthetic_frame(imax, jmax, N)
+    _, seconds_std = seconds_per_call(
+        compute_w, f['pn'], f['pm'], f['u'][np.newaxis], f['v'][np.newaxis],
+        f['z_w'][np.newaxis], f['z_r'][np.newaxis], repeat=repeat)
+    _, seconds_lean = seconds_per_call(
+        compute_w_lean, f['pn'], f['pm'], f['u'], f['v'], f['z_w'], f['z_r'],
+        dict(), repeat=repeat)
+
+    return dict(
+        seconds_standard=seconds_std,
+        seconds_lean=seconds_lean,
+    )
+
+
+def sample3d_speed(imax=200, jmax=150, N=35, num_particles=1000000, repeat=3):
+    """Time per call of the vertical level lookup and trilinear sampling"""
+    from ..chemicals.gridforce import z2s, z_columns, z2s_columns, sample3D
+    from .horzdiff import synthetic_forcing, random_positions
+
+    forcing = synthetic_forcing(imax, jmax, N)
+    grid = forcing._grid
+    X, Y, Z = random_positions(forcing, num_particles)
+    F = np.random.default_rng(0).normal(size=grid.z_r.shape)
+
+    (K, A), seconds_z2s = seconds_per_call(z2s, grid.z_r, X, Y, Z, repeat=repeat)
+    z_cols = z_columns(grid.z_r)
+    _, seconds_z2s_columns = seconds_per_call(
+        z2s_columns, z_cols, X, Y, Z, repeat=repeat)
+    _, seconds_sample = seconds_per_call(
+        sample3D, F, X, Y, K, A, repeat=repeat)
+
+    return dict(
+        seconds_z2s=seconds_z2s,
+        seconds_z2s_columns=seconds_z2s_columns,
+        seconds_sample3D=seconds_sample,
+    )
+
+
+def make_release_speed(sizes=(10**3, 10**4, 10**5, 10**6)):
+    """Time of make_release with a polygon location, for each release size"""
+    from ..release import make_release
+
+    results = dict()
+    for num in sizes:
+        config = dict(
+            seed=0,
+            date=['2015-09-07 00:00', '2015-09-08 00:00'],
+            num=num,
+            location=[[5, 5.5, 6, 5.5, 5.2], [60, 60.2, 60, 60.5, 60.4]],
+            depth=[0, 10],
+        )
+        _, results[str(num)] = seconds_per_call(make_release, config, repeat=1)
+    return results
+
+
+def synthetic_ladim_dset(num_particles=100000, num_times=24, seed=0):
+    """Create a ladim output dataset with random particle positions"""
+    import xarray as xr
+
+    rng = np.random.default_rng(seed)
+    num_instances = num_particles * num_times
+    return xr.Dataset(
+        data_vars=dict(
+            lon=xr.Variable('particle_instance', rng.uniform(5, 6, num_instances)),
+            lat=xr.Variable('particle_instance', rng.uniform(60, 61, num_instances)),
+            particle_count=xr.Variable('time', np.full(num_times, num_particles)),
+        ),
+        coords=dict(
+            time=START_TIME + np.arange(num_times) * np.timedelta64(1, 'h'),
+        ),
+    )
+
+
+def ladim_raster_speed(num_particles=100000, num_times=24, imax=200, jmax=150):
+    """Time of ladim_raster with a regular lon/lat grid"""
+    import xarray as xr
+    from ..utils import ladim_raster
+
+    particle_dset = synthetic_ladim_dset(num_particles, num_times)
+    grid_dset = xr.Dataset(coords=dict(
+        lat=60 + (0.5 + np.arange(jmax)) / jmax,
+        lon=5 + (0.5 + np.arange(imax)) / imax,
+    ))
+    raster, seconds = seconds_per_call(
+        ladim_raster, particle_dset, grid_dset, repeat=1)
+    return dict(
+        seconds=seconds,
+        num_counted=int(raster.bincount.sum()),
+    )
@@ -0,0 +1,64 @@
+import numpy as np
+import tracemalloc
+
+
+def synthetic_frame(imax=100, jmax=80, N=35, seed=0):
+    """Create a ROMS-like grid and velocity frame for testing compute_w
+
+    Returns a dict with entries pn, pm, u, v, z_w, z_r, where the velocities
+    are restricted to internal u- and v-points, as in Forcing.compute_w.
+    """
+    from ..chemicals.gridforce import s_stretch, sdepth
+
+    rng = np.random.default_rng(seed)
+    H = rng.uniform(20, 300, (jmax, imax))
+    hc = 10
+    Cs_r = s_stretch(N, 4, 0.75, stagger="rho")
+    Cs_w = s_stretch(N, 4, 0.75, stagger="w")
+    return dict(
+        pn=1 / rng.uniform(700, 900, (jmax, imax)),
+        pm=1 / rng.uniform(700, 900, (jmax, imax)),
+        u=rng.normal(0, 0.3, (N, jmax, imax - 1)).astype(np.float32),
+        v=rng.normal(0, 0.3, (N, jmax - 1, imax)).astype(np.float32),
+        z_w=sdepth(H, hc, Cs_w, stagger="w"),
+        z_r=sdepth(H, hc, Cs_r, stagger="rho"),
+    )
+
+
+def peak_memory(fn, *args, **kwargs):
+    """Return the result of a function call and its peak memory use [bytes]"""
+    tracemalloc.start()
+    try:
+        result = fn(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def compute_w_memory(imax=100, jmax=80, N=35):
+    """Compare peak memory of the standard and lean compute_w engines
+
+    The lean engine is called twice with the same work buffers, and the
+    peak memory of the second call is reported.
+    """
+    from ..chemicals.gridforce import compute_w, compute_w_lean
+
+    f = synthetic_frame(imax, jmax, N)
+    w_std, peak_std = peak_memory(
+        compute_w, f['pn'], f['pm'], f['u'][np.newaxis], f['v'][np.newaxis],
+        f['z_w'][np.newaxis], f['z_r'][np.newaxis])
+
+    work = dict()
+    compute_w_lean(f['pn'], f['pm'], f['u'], f['v'], f['z_w'], f['z_r'], work)
+    w_lean, peak_lean = peak_memory(
+        compute_w_lean, f['pn'], f['pm'], f['u'], f['v'], f['z_w'], f['z_r'],
+        work)
+
+    w_std = w_std[0]
+    return dict(
+        peak_bytes_standard=peak_std,
+        peak_bytes_lean=peak_lean,
+        output_bytes=w_std.size * 4,
+        max_rel_diff=float(np.max(np.abs(w_lean - w_std)) / np.max(np.abs(w_std))),
+    )
@@ -0,0 +1,71 @@
+import time
+import numpy as np
+
+
+def synthetic_forcing(imax=100, jmax=80, N=35, seed=0, **settings):
+    """Create a chemicals Forcing object with synthetic grid and velocity
+
+    The forcing is not connected to any file, and only supports sampling
+    the current velocity fields. Keyword arguments override the forcing
+    settings, such as horzdiff_engine.
+    """
+    from ..chemicals.gridforce import Forcing, Grid, s_stretch, sdepth
+
+    rng = np.random.default_rng(seed)
+    grid = Grid.__new__(Grid)
+    grid.i0 = grid.j0 = 0
+    grid.imax, grid.jmax = imax, jmax
+    grid.H = rng.uniform(20, 300, (jmax, imax))
+    grid.M = np.ones((jmax, imax))
+    grid.dx = rng.uniform(700, 900, (jmax, imax))
+    grid.Cs_w = s_stretch(N, 4, 0.75, stagger="w")
+    grid.z_r = sdepth(grid.H, 10, s_stretch(N, 4, 0.75, stagger="rho"), stagger="rho")
+    grid.z_w = sdepth(grid.H, 10, grid.Cs_w, stagger="w")
+
+    forcing = Forcing.__new__(Forcing)
+    forcing.__dict__.update(
+        _grid=grid, _z2s_memo=dict(), _sample_work=dict(), _column_memo=dict(),
+        _shear_fields=dict(), _velocity_increments=0, _ring=None, _window=None,
+        ibm_forcing=[], interpolate_velocity_in_time=True, interpolate_ibm_forcing_in_time=False,
+        field_engine="standard", horzdiff_engine="standard",
+        U=rng.normal(0, 0.3, (N, jmax, imax + 1)).astype(np.float32),
+        V=rng.normal(0, 0.3, (N, jmax + 1, imax)).astype(np.float32),
+    )
+    forcing.__dict__.update(settings)
+    return forcing
+
+
+def random_positions(forcing, num_particles, seed=1):
+    grid = forcing._grid
+    rng = np.random.default_rng(seed)
+    X = rng.uniform(1, grid.imax - 2, num_particles)
+    Y = rng.uniform(1, grid.jmax - 2, num_particles)
+    Z = rng.uniform(0, 0.9, num_particles) * grid.H[np.round(Y).astype(int), np.round(X).astype(int)]
+    return X, Y, Z
+
+
+def horzdiff_speed(imax=200, jmax=150, N=35, num_particles=100000, steps=3):
+    """Compare time per step of the standard and field horzdiff engines
+
+    Each time step calls Forcing.horzdiff four times with slightly
+    displaced positions, as the chemicals IBM does.
+    """
+    results = dict()
+    values = dict()
+    for engine in ['standard', 'field']:
+        forcing = synthetic_forcing(imax, jmax, N, horzdiff_engine=engine)
+        X, Y, Z = random_positions(forcing, num_particles)
+
+        start = time.perf_counter()
+        for _ in range(steps):
+            # New time step: Reset caches, as in Forcing.update
+            forcing._z2s_memo.clear()
+            forcing._shear_fields.clear()
+            for dx, dy in [(0, 0), (0.1, 0), (0.1, 0), (0.1, 0.1)]:
+                values[engine] = forcing.horzdiff(X + dx, Y + dy, Z)
+        results[f'seconds_per_step_{engine}'] = (time.perf_counter() - start) / steps
+
+    results['speedup'] = results['seconds_per_step_standard'] / results['seconds_per_step_field']
+    scale = np.max(np.abs(values['standard']))
+    results['max_rel_diff'] = float(np.max(np.abs(values['field'] - values['standard'])) / scale)
+    return results
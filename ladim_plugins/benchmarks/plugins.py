@@ -0,0 +1,162 @@
+import importlib
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from .synthetic import (
+    write_roms_file, synthetic_model, random_state, Wrapper, SyntheticState)
+
+
+class FishSizeState(SyntheticState):
+    """State where `size` is the fish length, not the number of particles
+
+    The vps IBM uses `state.size` as a swimming speed common to all
+    particles, so the mean of the `size` particle variable is returned.
+    """
+
+    @property
+    def size(self):
+        return float(np.mean(self._data['size']))
+
+
+# Mapping of plugin names to (IBM configuration, initial particle variables)
+PLUGINS = {
+    'chemicals': (
+        dict(vertical_mixing='AKs', vertdiff_dt=60, vertdiff_dz=2, vertdiff_max=0.01,
+             horzdiff_type='smagorinsky', land_collision='reposition', lifespan=86400),
+        dict(age=0),
+    ),
+    'sedimentation': (
+        dict(lifespan=86400, taucrit=dict(method='constant', value=0.12),
+             vertical_mixing=dict(method='constant', value=1e-4)),
+        dict(active=1, sink_vel=0, age=0),
+    ),
+    'mine': (
+        dict(lifespan=86400, taucrit=0.12, vertical_mixing=1e-4),
+        dict(active=1, sink_vel=0.001, age=0),
+    ),
+    'egg': (
+        dict(vertical_mixing=5e-5, egg_diam=0.0011),
+        dict(temp=0, salt=0, egg_buoy=32, age=0),
+    ),
+    'larvae': (
+        dict(vertical_mixing=1e-4, species='cod'),
+        dict(temp=0, salt=0, egg_buoy=32, age=100, weight=0.1),
+    ),
+    'saithe': (
+        dict(extra_spreading=True),
+        dict(temp=0, salt=0, egg_buoy=32, age=100, weight=0.1, direction=0),
+    ),
+    'salmon_lice': (
+        dict(vertical_mixing=1e-3),
+        dict(super=1, temp=0, salt=0, age=50, days=0),
+    ),
+    'shrimp': (
+        dict(mindepth_day=[20] * 5, maxdepth_day=[20, 20, 200, 200, 200],
+             mindepth_night=[0] * 5, maxdepth_night=[0, 0, 100, 100, 100],
+             vertical_mixing=[0.01, 0.01, 0.25, 0.25, 0.25],
+             vertical_speed=[0.001, 0.001, 0.005, 0.005, 0.005],
+             variables=['active']),
+        dict(temp=0, salt=0, stage=1, length=0, depth_quantile=0, age=0, active=1),
+    ),
+    'sandeel': (
+        dict(vertical_mixing=5e-5, max_depth=50),
+        dict(hatch_rate=0, stage=0.5, active=1, temp=0),
+    ),
+    'lunar_eel': (
+        dict(vertical_mixing=5e-5, lunar_latlon=[60, 0], vertical_limits=[0, 20], speed=0.12),
+        dict(),
+    ),
+    'vps': (
+        dict(vertical_mixing=1e-4),
+        dict(size=0.1, age=0),
+    ),
+}
+
+
+# Plugins with per-particle python loops are only run for small states
+MAX_PARTICLES = dict(vps=10**4)
+
+# Plugins needing a special state class
+STATE_CLASS = dict(vps=FishSizeState)
+
+
+def missing_requirement(name):
+    """Reason why a plugin cannot run in this installation, or None"""
+    if name == 'lunar_eel':
+        from importlib.resources import files
+        if not files('ladim_plugins.lunar_eel').joinpath('de421.bsp').is_file():
+            return 'Ephemeris file de421.bsp is not installed'
+    return None
+
+
+def make_ibm(name, ibmconf, dt, tempdir):
+    """Create the IBM of a plugin"""
+    config = dict(dt=dt, ibm=dict(ibmconf), nc_attributes=dict(), output_instance=[])
+    if name == 'vps':
+        fjord_index = os.path.join(tempdir, 'fjord_index.npy')
+        config['ibm']['fjord_index_file'] = fjord_index
+    module = importlib.import_module(f'ladim_plugins.{name}')
+    return module.IBM(config)
+
+
+def write_fjord_index(fname, grid):
+    # Distance to the western boundary, positive everywhere
+    jmax, imax = grid.j1 + 1, grid.i1 + 1
+    np.save(fname, np.broadcast_to(1 + np.arange(imax), (jmax, imax)).copy())
+
+
+def update_ibm_speed(plugins=None, sizes=(10**3, 10**4, 10**5, 10**6),
+                     imax=100, jmax=80, N=20, steps=2):
+    """Time per step of `update_ibm` for each plugin
+
+    All plugins use a synthetic ROMS file, read by the chemicals Grid and
+    Forcing classes. For each plugin and number of particles, the result is
+    the number of seconds per time step, or an error message if the plugin
+    could not run. Plugins with missing requirements are skipped, and the
+    reason is given as `skipped`.
+    """
+    plugins = plugins or list(PLUGINS)
+    dt = 600
+    results = dict()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = os.path.join(tempdir, 'forcing.nc')
+        write_roms_file(fname, imax, jmax, N)
+        grid, forcing = synthetic_model(fname, dt=dt)
+        write_fjord_index(os.path.join(tempdir, 'fjord_index.npy'), grid)
+        forcing.update(0)
+
+        for name in plugins:
+            ibmconf, variables = PLUGINS[name]
+            results[name] = dict()
+            reason = missing_requirement(name)
+            if reason:
+                logging.info(f'update_ibm: Skipping {name}: {reason}')
+                results[name]['skipped'] = reason
+                continue
+            for num in sizes:
+                if num > MAX_PARTICLES.get(name, num):
+                    continue
+                logging.info(f'update_ibm: {name}, {num} particles')
+                try:
+                    np.random.seed(0)
+                    ibm = make_ibm(name, ibmconf, dt, tempdir)
+                    state = random_state(
+                        grid, num, state_class=STATE_CLASS.get(name, SyntheticState),
+                        **variables)
+                    start = time.perf_counter()
+                    for i in range(steps):
+                        state['timestep'] = i
+                        ibm.update_ibm(Wrapper(grid), state, Wrapper(forcing))
+                    seconds = (time.perf_counter() - start) / steps
+                    results[name][str(num)] = seconds
+                except Exception as e:
+                    results[name][str(num)] = f'{type(e).__name__}: {e}'
+
+        forcing.close()
+
+    return results
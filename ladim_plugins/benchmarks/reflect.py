@@ -0,0 +1,89 @@
+import time
+import numpy as np
+from .horzdiff import synthetic_forcing, random_positions
+
+
+class _State(dict):
+    def __getattr__(self, item):
+        return self[item]
+
+
+def _reflect_masked(grid, state):
+    # Previous implementation: Sample depth and use boolean indexing per call
+    z = state.Z
+    H = grid.sample_depth(state.X, state.Y)
+    below_seabed = z > H
+    z[z < 0] *= -1
+    z[below_seabed] = 2 * H[below_seabed] - z[below_seabed]
+    state['Z'] = z
+
+
+def _reposition_sorted(old, state):
+    # Previous implementation: Match particles by sorting the pid arrays
+    pid, pidx_old, pidx_new = np.intersect1d(old['pid'], state.pid, return_indices=True)
+    onland = ((old['X'][pidx_old] == state.X[pidx_new]) &
+              (old['Y'][pidx_old] == state.Y[pidx_new]))
+    num_onland = np.count_nonzero(onland)
+    pidx_new_onland = pidx_new[onland]
+    state.X[pidx_new_onland] = np.round(state.X[pidx_new_onland]) - 0.5 + np.random.rand(num_onland)
+    state.Y[pidx_new_onland] = np.round(state.Y[pidx_new_onland]) - 0.5 + np.random.rand(num_onland)
+
+
+def reflect_speed(imax=200, jmax=150, num_particles=1000000, num_reflect=21, steps=3):
+    """Compare time per step of the reposition and reflect passes
+
+    Each time step repositions the particles that have not moved since the
+    previous step, and reflects the vertical positions `num_reflect` times
+    (once after advection, and twice per vertical diffusion substep). The
+    previous implementation is compared with the chemicals IBM.
+    """
+    from ..chemicals.ibm import IBM
+
+    forcing = synthetic_forcing(imax, jmax)
+    grid = forcing._grid
+    X, Y, Z = random_positions(forcing, num_particles)
+    Z = Z * 1.1 - 1  # Some particles above surface and below seabed
+    pid = np.arange(num_particles)
+
+    # Half of the particles have moved since the previous time step
+    X_old = np.where(pid % 2 == 0, X + 0.1, X)
+
+    def new_state():
+        return _State(X=X.copy(), Y=Y.copy(), Z=Z.copy(), pid=pid)
+
+    results = dict()
+    states = dict()
+
+    np.random.seed(0)
+    old = dict(X=X_old, Y=Y, pid=pid)
+    state = states['masked'] = new_state()
+    start = time.perf_counter()
+    for _ in range(steps):
+        _reposition_sorted(old, state)
+        for _ in range(num_reflect):
+            _reflect_masked(grid, state)
+        old = dict(X=state.X.copy(), Y=state.Y.copy(), pid=state.pid)
+    results['seconds_per_step_masked'] = (time.perf_counter() - start) / steps
+
+    np.random.seed(0)
+    ibm = IBM(dict(dt=600, ibm=dict()))
+    ibm.grid = grid
+    ibm.state = _State(X=X_old, Y=Y, pid=pid)
+    ibm.store_position()
+    ibm.state = state = states['inplace'] = new_state()
+    start = time.perf_counter()
+    for _ in range(steps):
+        ibm.reposition()
+        ibm._depth = None
+        for chunk, depth in ibm.depth_chunks():
+            for _ in range(num_reflect):
+                ibm.reflect(chunk, depth)
+        ibm.state = _State(state, X=state.X.copy(), Y=state.Y.copy())
+        ibm.store_position()
+        ibm.state = state
+    results['seconds_per_step_inplace'] = (time.perf_counter() - start) / steps
+
+    results['speedup'] = results['seconds_per_step_masked'] / results['seconds_per_step_inplace']
+    results['same_result'] = all(
+        np.array_equal(states['masked'][k], states['inplace'][k]) for k in 'XYZ')
+    return results
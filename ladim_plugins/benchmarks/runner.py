@@ -0,0 +1,75 @@
+import json
+import logging
+import platform
+from . import compute_w, components, horzdiff, plugins, reflect
+
+
+# Mapping of benchmark names to (function, default keyword arguments)
+BENCHMARKS = {
+    'compute_w_memory': (compute_w.compute_w_memory, dict(imax=400, jmax=300, N=35)),
+    'horzdiff_speed': (horzdiff.horzdiff_speed, dict(
+        imax=200, jmax=150, N=35, num_particles=1000000, steps=3)),
+    'reflect_speed': (reflect.reflect_speed, dict(
+        imax=200, jmax=150, num_particles=1000000, num_reflect=21, steps=3)),
+    'update_ibm_speed': (plugins.update_ibm_speed, dict(
+        plugins=list(plugins.PLUGINS), sizes=[10**3, 10**4, 10**5, 10**6],
+        imax=100, jmax=80, N=20, steps=2)),
+    'forcing_update_speed': (components.forcing_update_speed, dict(
+        imax=400, jmax=300, N=35, steps=18)),
+    'compute_w_speed': (components.compute_w_speed, dict(
+        imax=400, jmax=300, N=35, repeat=3)),
+    'sample3d_speed': (components.sample3d_speed, dict(
+        imax=200, jmax=150, N=35, num_particles=1000000, repeat=3)),
+    'make_release_speed': (components.make_release_speed, dict(
+        sizes=[10**3, 10**4, 10**5, 10**6])),
+    'ladim_raster_speed': (components.ladim_raster_speed, dict(
+        num_particles=100000, num_times=24, imax=200, jmax=150)),
+}
+
+
+def run(names=None, **kwargs):
+    """Run benchmarks and return the results as a list of dicts
+
+    :param names: Benchmarks to run (default: all)
+    :param kwargs: Keyword arguments overriding the benchmark defaults
+    """
+    names = names or list(BENCHMARKS)
+    results = []
+    for name in names:
+        fn, default_args = BENCHMARKS[name]
+        args = {**default_args, **{k: v for k, v in kwargs.items() if k in default_args}}
+        logging.info(f'Running benchmark {name}: {args}')
+        results.append(dict(name=name, params=args, results=fn(**args)))
+    return results
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Run ladim_plugins performance benchmarks.',
+    )
+    parser.add_argument(
+        "names", nargs='*', metavar='name',
+        help="benchmarks to run (default: all). Available: " + ", ".join(BENCHMARKS),
+    )
+    parser.add_argument("--output", help="output JSON file (default: stdout)")
+    args = parser.parse_args()
+    unknown = [n for n in args.names if n not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(unknown)}")
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s: %(message)s',
+        level=logging.INFO,
+    )
+
+    out = dict(
+        python=platform.python_version(),
+        machine=platform.machine(),
+        benchmarks=run(args.names),
+    )
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fp:
+            json.dump(out, fp, indent=2)
+    else:
+        print(json.dumps(out, indent=2))
@@ -0,0 +1,160 @@
+import numpy as np
+
+
+START_TIME = np.datetime64('2015-09-07T00:00:00')
+
+
+def write_roms_file(fname, imax=100, jmax=80, N=20, num_times=4, dt=3600, seed=0):
+    """Write a synthetic ROMS output file
+
+    The file contains the grid variables and the fields u, v, temp, salt
+    and AKs, with `num_times` records separated by `dt` seconds. The depth
+    and velocities are random, and the land mask has a rectangular island
+    in the middle of the domain.
+    """
+    import netCDF4 as nc
+    from ..chemicals.gridforce import s_stretch
+
+    rng = np.random.default_rng(seed)
+    hc, theta_s, theta_b = 10, 4, 0.75
+
+    mask = np.ones((jmax, imax))
+    mask[jmax // 2 - jmax // 10:jmax // 2, imax // 2 - imax // 10:imax // 2] = 0
+    lon, lat = np.meshgrid(5 + 0.01 * np.arange(imax), 60 + 0.005 * np.arange(jmax))
+
+    with nc.Dataset(fname, 'w') as dset:
+        for name, size in [
+            ('xi_rho', imax), ('eta_rho', jmax), ('xi_u', imax - 1),
+            ('eta_u', jmax), ('xi_v', imax), ('eta_v', jmax - 1),
+            ('s_rho', N), ('s_w', N + 1), ('ocean_time', None),
+        ]:
+            dset.createDimension(name, size)
+
+        def put(name, dims, value, dtype='f8', **attrs):
+            var = dset.createVariable(name, dtype, dims)
+            var.setncatts(attrs)
+            var[:] = value
+
+        put('ocean_time', ('ocean_time', ), np.arange(num_times) * dt,
+            units=f'seconds since {START_TIME}')
+        put('Vtransform', (), 1, dtype='i4')
+        put('hc', (), hc)
+        put('Cs_r', ('s_rho', ), s_stretch(N, theta_s, theta_b, stagger='rho'))
+        put('Cs_w', ('s_w', ), s_stretch(N, theta_s, theta_b, stagger='w'))
+
+        rho = ('eta_rho', 'xi_rho')
+        put('h', rho, rng.uniform(20, 300, (jmax, imax)))
+        put('mask_rho', rho, mask)
+        put('pm', rho, 1 / rng.uniform(700, 900, (jmax, imax)))
+        put('pn', rho, 1 / rng.uniform(700, 900, (jmax, imax)))
+        put('lon_rho', rho, lon)
+        put('lat_rho', rho, lat)
+        put('angle', rho, np.zeros((jmax, imax)))
+
+        def field(*shape):
+            return rng.normal(0, 1, (num_times, ) + shape).astype(np.float32)
+
+        t = ('ocean_time', )
+        put('u', t + ('s_rho', 'eta_u', 'xi_u'), 0.3 * field(N, jmax, imax - 1), 'f4')
+        put('v', t + ('s_rho', 'eta_v', 'xi_v'), 0.3 * field(N, jmax - 1, imax), 'f4')
+        put('temp', t + ('s_rho', ) + rho, 8 + field(N, jmax, imax), 'f4')
+        put('salt', t + ('s_rho', ) + rho, 34 + 0.5 * field(N, jmax, imax), 'f4')
+        put('AKs', t + ('s_w', ) + rho, 1e-3 * np.abs(field(N + 1, jmax, imax)), 'f4')
+
+
+def synthetic_model(fname, dt=600, **gridforce):
+    """Create chemicals Grid and Forcing objects from a synthetic ROMS file
+
+    The forcing includes the fields temp, salt and AKs, so that it can be
+    used by all the IBMs in the benchmarks.
+    """
+    from ..chemicals.gridforce import Grid, Forcing
+
+    config = dict(
+        gridforce=dict(grid_file=fname, input_file=fname, **gridforce),
+        ibm_forcing=['AKs', 'temp', 'salt'],
+        start_time=START_TIME,
+        stop_time=START_TIME + np.timedelta64(3, 'h'),
+        dt=dt,
+    )
+    grid = Grid(config)
+    forcing = Forcing(config, grid)
+    return grid, forcing
+
+
+class Wrapper:
+    """Stand-in for the grid and forcing wrappers in ladim
+
+    Attribute access is delegated to the wrapped object, which is also
+    available as the attributes `grid` and `forcing`.
+    """
+
+    def __init__(self, obj):
+        self.grid = obj
+        self.forcing = obj
+
+    def __getattr__(self, item):
+        return getattr(self.grid, item)
+
+
+class SyntheticState:
+    """Particle state with the same item and attribute access as in ladim"""
+
+    def __init__(self, **variables):
+        self.__dict__['_data'] = dict()
+        for name, value in variables.items():
+            self[name] = value
+
+    @property
+    def size(self):
+        """Current number of particles"""
+        return len(self._data['X'])
+
+    def __len__(self):
+        return len(self._data['X'])
+
+    def __contains__(self, item):
+        return item in self._data
+
+    def __getitem__(self, item):
+        return self._data[item]
+
+    def __setitem__(self, item, value):
+        self._data[item] = value
+
+    def __getattr__(self, item):
+        try:
+            return self._data[item]
+        except KeyError:
+            raise AttributeError(f'Attribute not defined: {item}')
+
+    def __setattr__(self, item, value):
+        self._data[item] = value
+
+
+def random_state(grid, num_particles, seed=1, state_class=SyntheticState, **variables):
+    """Particles at random positions at sea
+
+    Keyword arguments are initial values of additional particle variables.
+    """
+    rng = np.random.default_rng(seed)
+    X = rng.uniform(grid.xmin + 1, grid.xmax - 1, num_particles)
+    Y = rng.uniform(grid.ymin + 1, grid.ymax - 1, num_particles)
+    keep = grid.atsea(X, Y)
+    X, Y = X[keep], Y[keep]
+    while len(X) < num_particles:
+        X = np.concatenate([X, X])[:num_particles]
+        Y = np.concatenate([Y, Y])[:num_particles]
+    Z = rng.uniform(0, 0.9, num_particles) * grid.sample_depth(X, Y)
+
+    state = state_class(
+        pid=np.arange(num_particles),
+        X=X, Y=Y, Z=Z,
+        alive=np.ones(num_particles, dtype=bool),
+        dt=600,
+        timestep=0,
+        timestamp=START_TIME,
+    )
+    for name, value in variables.items():
+        state[name] = np.zeros(num_particles) + value
+    return state
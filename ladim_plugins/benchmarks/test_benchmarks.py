@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from ladim_plugins.benchmarks import plugins, runner
+
+
+# Tiny problem sizes, overriding the benchmark defaults
+SMOKE_ARGS = dict(
+    imax=20, jmax=15, N=5, num_particles=100, num_reflect=3, num_times=2,
+    steps=1, repeat=1, sizes=[100],
+)
+
+
+def errors(results):
+    """Error messages in benchmark results, with the path to each"""
+    if isinstance(results, dict):
+        return [
+            (key, ) + err
+            for key, value in results.items() if key != 'skipped'
+            for err in errors(value)
+        ]
+    if isinstance(results, str):
+        return [(results, )]
+    return []
+
+
+class Test_run:
+    @pytest.mark.parametrize("name", list(runner.BENCHMARKS))
+    def test_runs_without_errors(self, name):
+        result, = runner.run([name], **SMOKE_ARGS)
+        assert result['name'] == name
+        assert errors(result['results']) == []
+
+    def test_vps_uses_fish_size(self):
+        result = plugins.update_ibm_speed(
+            plugins=['vps'], sizes=[100], imax=20, jmax=15, N=5, steps=3)
+        assert np.isfinite(result['vps']['100'])
+
+    def test_skipped_plugins_give_reason(self):
+        result = plugins.update_ibm_speed(
+            plugins=['lunar_eel'], sizes=[100], imax=20, jmax=15, N=5, steps=1)
+        if plugins.missing_requirement('lunar_eel'):
+            assert result['lunar_eel'] == dict(skipped=plugins.missing_requirement('lunar_eel'))
+        else:
+            assert list(result['lunar_eel']) == ['100']
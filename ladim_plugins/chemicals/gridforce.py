@@ -12,12 +12,70 @@ Grid and Forcing for LADiM for the Regional Ocean Model System (ROMS)
 
 # import sys
 import glob
+import hashlib
+import json
 import logging
+import os
+import queue
+import shutil
+import threading
 import numpy as np
 from netCDF4 import Dataset, num2date
 
 from ladim.sample import sample2D, bilin_inv
 
+from ..utils.iostats import IOStats
+
+# The netCDF library is not thread safe. All forcing file access in this
+# module holds this lock, so that frames can be read by a background thread
+# (the `prefetch` option). Other netCDF access in the same process, such as
+# the ladim output, does not hold it. Prefetch is therefore only allowed if
+# the HDF5 library is built thread safe, see hdf5_threadsafe.
+netcdf_lock = threading.RLock()
+
+
+
+def hdf5_threadsafe():
+    """True if the HDF5 library used by netCDF4 reports that it is thread safe
+
+    The library is located among the shared libraries loaded by the process,
+    or else by name. Returns False if the answer cannot be determined.
+    """
+    import ctypes
+    import ctypes.util
+
+    paths = []
+    try:
+        with open("/proc/self/maps") as fp:
+            for line in fp:
+                path = line.split()[-1]
+                name = os.path.basename(path)
+                if name.startswith("libhdf5") and not name.startswith("libhdf5_"):
+                    if path not in paths:
+                        paths.append(path)
+    except OSError:
+        pass
+    found = ctypes.util.find_library("hdf5")
+    if found:
+        paths.append(found)
+
+    for path in paths:
+        try:
+            is_threadsafe = ctypes.CDLL(path).H5is_library_threadsafe
+        except (OSError, AttributeError):
+            continue
+        answer = ctypes.c_bool(False)
+        if is_threadsafe(ctypes.byref(answer)) >= 0:
+            return answer.value
+    return False
+
+
+# Grid file variables read by the Grid class
+GRID_VARIABLES = [
+    "h", "mask_rho", "pm", "pn", "lon_rho", "lat_rho", "angle",
+    "hc", "Cs_r", "Cs_w", "Vtransform",
+]
+
 
 class Grid:
     """Simple ROMS grid object
@@ -27,6 +85,11 @@ class Grid:
         Ordinary python style, start points included, not end points
         Each of the elements can be replaced with None, for no limitation
       Vinfo: dictionary with N, hc, theta_s and theta_b
+      grid_bundle: directory for storing the grid arrays as .npy files
+        If the bundle matches the grid file and the arguments above, the
+        arrays are memory-mapped from the bundle instead of computed.
+      grid_cache: directory with one bundle per grid file version, subgrid
+        and Vinfo. Outdated bundles for the same grid file are removed.
 
     """
 
@@ -50,6 +113,22 @@ class Grid:
             logging.error("No grid file specified")
             raise SystemExit(1)
 
+        # Precomputed grid arrays
+        bundle = config["gridforce"].get("grid_bundle", None)
+        cache = config["gridforce"].get("grid_cache", None)
+        bundle_key = None
+        if not isinstance(grid_file, memoryview):
+            if bundle is not None:
+                bundle_key = self.bundle_key(grid_file, config["gridforce"])
+            elif cache is not None:
+                bundle_key = self.bundle_key(
+                    grid_file, config["gridforce"], variables_hash=True)
+                entry = hashlib.sha1(json.dumps(bundle_key).encode()).hexdigest()
+                bundle = os.path.join(cache, entry)
+        if bundle_key is not None and self.load_bundle(bundle, bundle_key):
+            logging.info("Grid arrays loaded from " + bundle)
+            return
+
         try:
             if isinstance(grid_file, memoryview):
                 import uuid
@@ -150,6 +229,9 @@ class Grid:
         self.z_w = sdepth(
             self.H, self.hc, self.Cs_w, stagger="w", Vtransform=self.Vtransform
         )
+        # Contiguous vertical columns, for fast vertical lookup
+        self.z_r_cols = z_columns(self.z_r)
+        self.z_w_cols = z_columns(self.z_w)
 
         # Land masks at u- and v-points
         M = self.M
@@ -168,6 +250,90 @@ class Grid:
         # Close the file(s)
         ncid.close()
 
+        if bundle_key is not None:
+            self.save_bundle(bundle, bundle_key)
+            if cache is not None:
+                remove_outdated_bundles(cache, bundle_key)
+
+    @staticmethod
+    def bundle_key(grid_file, gridforce_config, variables_hash=False):
+        """Identification of the grid arrays computed from a grid file
+
+        The grid file is identified by its size and modification time. If
+        *variables_hash* is True, the sha1 hash of the grid variables is
+        included as well. Other variables in the file are not read.
+        """
+        key = dict(grid_file=os.path.abspath(grid_file))
+        stat = os.stat(grid_file)
+        key["size"] = stat.st_size
+        key["mtime_ns"] = stat.st_mtime_ns
+        if variables_hash:
+            key["sha1"] = grid_variables_sha1(grid_file)
+        key["subgrid"] = gridforce_config.get("subgrid", None)
+        key["Vinfo"] = gridforce_config.get("Vinfo", None)
+
+        # Normalize tuples and numpy scalars
+        return json.loads(json.dumps(key, default=_json_scalar))
+
+    def save_bundle(self, path, key=None):
+        """Store the grid arrays as .npy files in the directory *path*
+
+        Files are written under temporary names and then renamed, so that
+        several processes may share the same bundle.
+        """
+        os.makedirs(path, exist_ok=True)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        attrs = dict()
+        for name, value in self.__dict__.items():
+            if isinstance(value, np.ndarray):
+                fname = os.path.join(path, name + ".npy")
+                with open(fname + suffix, "wb") as fp:
+                    np.save(fp, value)
+                os.replace(fname + suffix, fname)
+                attrs[name] = dict(array=name + ".npy")
+            elif isinstance(value, slice):
+                attrs[name] = dict(slice=[value.start, value.stop])
+            else:
+                attrs[name] = dict(value=value)
+
+        # The manifest is written last, and marks the bundle as complete
+        manifest = dict(key=key, attrs=attrs)
+        fname = os.path.join(path, "manifest.json")
+        with open(fname + suffix, "w") as fp:
+            json.dump(manifest, fp, default=_json_scalar)
+        os.replace(fname + suffix, fname)
+
+    def load_bundle(self, path, key=None):
+        """Memory-map the grid arrays from a bundle made by save_bundle
+
+        Returns False if the bundle is missing, unreadable or does not
+        match *key*.
+        """
+        try:
+            with open(os.path.join(path, "manifest.json")) as fp:
+                manifest = json.load(fp)
+        except (OSError, ValueError):
+            return False
+        if key is not None and manifest["key"] != key:
+            logging.info("Grid bundle " + path + " does not match grid")
+            return False
+
+        attrs = dict()
+        for name, spec in manifest["attrs"].items():
+            if "array" in spec:
+                fname = os.path.join(path, spec["array"])
+                try:
+                    attrs[name] = np.load(fname, mmap_mode="r")
+                except (OSError, ValueError):
+                    logging.warning("Could not read grid bundle array " + fname)
+                    return False
+            elif "slice" in spec:
+                attrs[name] = slice(*spec["slice"])
+            else:
+                attrs[name] = spec["value"]
+        self.__dict__.update(attrs)
+        return True
+
     def sample_metric(self, X, Y):
         """Sample the metric coefficients
 
@@ -227,15 +393,67 @@ class Grid:
         return X + self.i0, Y + self.j0
 
     def nearest_sea(self, X, Y):
-        I = X - self.i0
-        J = Y - self.j0
-        i_new, j_new = nearest_unmasked(np.logical_not(self.M), I, J)
+        """Subgrid indices of the sea cell nearest to the particles
+
+        Particles in sea cells are looked up in a table computed from the
+        land mask at first use. Particles in land cells get the neighbouring
+        sea cell closest to the particle, as in `nearest_unmasked`, or the
+        sea cell closest to their cell from the table if there is no
+        neighbouring sea cell.
+        """
+        I, J = self._cell_index(X, Y)
+        j_sea, i_sea = self._nearest_sea_table()
+        i_new, j_new = i_sea[J, I], j_sea[J, I]
+
+        on_land = self.M[J, I] == 0
+        if np.any(on_land):
+            i_near, j_near = nearest_unmasked(
+                np.logical_not(self.M), X[on_land] - self.i0, Y[on_land] - self.j0)
+            found = self.M[j_near, i_near] != 0
+            idx = np.flatnonzero(on_land)[found]
+            i_new[idx] = i_near[found]
+            j_new[idx] = j_near[found]
+
         return i_new, j_new
 
     def is_close_to_land(self, X, Y):
-        I = X - self.i0
-        J = Y - self.j0
-        return is_close_to_land(self.M, I, J)
+        """True if any of the eight neighbouring cells is land
+
+        Same as the function `is_close_to_land`, using a table computed from
+        the land mask at first use.
+        """
+        I, J = self._cell_index(X, Y)
+        return self._close_to_land_table()[J, I]
+
+    def _cell_index(self, X, Y):
+        jmax, imax = self.M.shape
+        I = np.clip(np.round(X - self.i0).astype(np.intp), 0, imax - 1)
+        J = np.clip(np.round(Y - self.j0).astype(np.intp), 0, jmax - 1)
+        return I, J
+
+    def _nearest_sea_table(self):
+        table = getattr(self, "_nearest_sea", None)
+        if table is None:
+            from scipy.ndimage import distance_transform_edt
+            is_land = ~np.array(self.M, dtype=bool)
+            if np.all(is_land):  # No sea cells, keep position
+                table = np.indices(is_land.shape)
+            else:
+                table = distance_transform_edt(
+                    is_land, return_distances=False, return_indices=True)
+            self._nearest_sea = table
+        return table
+
+    def _close_to_land_table(self):
+        table = getattr(self, "_close_to_land", None)
+        if table is None:
+            from scipy.ndimage import maximum_filter
+            is_land = ~np.array(self.M, dtype=bool)
+            footprint = np.ones((3, 3), dtype=bool)
+            footprint[1, 1] = False
+            table = maximum_filter(is_land, footprint=footprint, mode="nearest")
+            self._close_to_land = table
+        return table
 
 
 # -----------------------------------------------
@@ -257,6 +475,81 @@ class Forcing:
         # self.config = config["gridforce"]
         self.ibm_forcing = config["ibm_forcing"]
 
+        # Number of frames to read ahead in a background thread (0 = off)
+        self.prefetch = int(config["gridforce"].get("prefetch", 0))
+        self._prefetcher = None
+        if self.prefetch > 0 and not hdf5_threadsafe():
+            raise ValueError(
+                "Forcing prefetch reads netCDF files in a background thread "
+                "while the ladim output is written, and requires an HDF5 "
+                "library built thread safe")
+
+        # Directory for storing diagnosed vertical velocities (None = off)
+        self.w_cache = config["gridforce"].get("w_cache", None)
+        self._w_cache_grid = None  # Hash of the grid arrays used by compute_w
+
+        # Method for diagnosing vertical velocity: "standard" or "lean"
+        self.w_engine = config["gridforce"].get("w_engine", "standard")
+        if self.w_engine not in ("standard", "lean"):
+            raise ValueError(f"Unknown w_engine: {self.w_engine}")
+        self._w_work = dict()
+
+        # Method for sampling ibm forcing fields: "standard" or "columns"
+        self.field_engine = config["gridforce"].get("field_engine", "standard")
+        if self.field_engine not in ("standard", "columns"):
+            raise ValueError(f"Unknown field_engine: {self.field_engine}")
+        self._column_memo = dict()
+
+        # Method for computing horizontal diffusivity: "standard" or "field"
+        self.horzdiff_engine = config["gridforce"].get("horzdiff_engine", "standard")
+        if self.horzdiff_engine not in ("standard", "field"):
+            raise ValueError(f"Unknown horzdiff_engine: {self.horzdiff_engine}")
+        self._shear_fields = dict()  # Shear fields on the whole subgrid
+        self._velocity_increments = 0  # Number of times dU, dV have been added
+
+        # Floating point precision of forcing fields (None = as computed)
+        precision = config["gridforce"].get("precision", None)
+        if precision not in (None, "float32", "float64"):
+            raise ValueError(f"Unknown precision: {precision}")
+        self.dtype = None if precision is None else np.dtype(precision)
+
+        # Padding of read window around particles, in grid cells (0 = off)
+        self.read_window = int(config["gridforce"].get("read_window", 0))
+        if 0 < self.read_window < 2:
+            raise ValueError("read_window must be at least 2")
+        self._window = None  # [j0, j1, i0, i1] relative to subgrid
+        self._window_warned = None  # Last time step with a warning
+        self.dt = config["dt"]
+
+        # Storage of forcing frames: "standard" or "ring"
+        self.forcing_buffer = config["gridforce"].get("forcing_buffer", "standard")
+        if self.forcing_buffer not in ("standard", "ring"):
+            raise ValueError(f"Unknown forcing_buffer: {self.forcing_buffer}")
+        self._ring = None  # name -> array with two frame slots
+        self._ring_steps = None  # Time step of each frame slot
+        self._ring_new = 1  # Index of the slot with the newest frame
+        self._time = -1  # Current time step
+
+        # Time interpolation between forcing frames. The ibm forcing fields
+        # may also be interpolated lazily, only at the particle positions.
+        self.interpolate_velocity_in_time = bool(
+            config["gridforce"].get("interpolate_velocity_in_time", True))
+        self.interpolate_ibm_forcing_in_time = config["gridforce"].get(
+            "interpolate_ibm_forcing_in_time", False)
+        if self.interpolate_ibm_forcing_in_time not in (False, True, "lazy"):
+            raise ValueError(
+                "Unknown interpolate_ibm_forcing_in_time: "
+                f"{self.interpolate_ibm_forcing_in_time}")
+        self._field_steps = None  # Time steps of name + "old" and name + "new"
+
+        # Vertical lookups of field(), reused within a time step
+        self._z2s_memo = dict()
+        self._sample_work = dict()  # Scratch arrays for sample3D_fused
+
+        # Counters and timers for file access, logged every io_log_interval steps
+        self.io_stats = IOStats(
+            "Forcing", config["gridforce"].get("io_log_interval", 0))
+
         files = self.find_files(config["gridforce"])
         numfiles = len(files)
         if numfiles == 0:
@@ -268,7 +561,14 @@ class Forcing:
         # Overview of all the files
         # ---------------------------
 
-        all_frames, num_frames = self.scan_file_times(files)
+        # JSON file with the time frames of each forcing file (None = off)
+        self.time_index = config["gridforce"].get("time_index", None)
+
+        # Number of processes for reading forcing file times (0 = off)
+        self.scan_workers = int(config["gridforce"].get("scan_workers", 0))
+
+        all_frames, num_frames = self.scan_file_times(
+            files, self.time_index, self.scan_workers, self.io_stats)
         steps, file_idx, frame_idx = self.forcing_steps(
             config, files, all_frames, num_frames
         )
@@ -279,6 +579,7 @@ class Forcing:
         self.file_idx = file_idx
         self.frame_idx = frame_idx
         self._nc = None
+        self._nc_file = None
         self.steps = steps
         self._files = files
         self.initialization_finished = False
@@ -288,6 +589,14 @@ class Forcing:
             return
         steps = self.steps
 
+        if self.read_window:
+            self._window = self._particle_window(empty=(0, 0, 0, 0))
+
+        if self.forcing_buffer == "ring":
+            self._ring_initialization()
+            self.initialization_finished = True
+            return
+
         # Read old input
         # requires at least one input before start
         # to get Runge-Kutta going
@@ -298,12 +607,13 @@ class Forcing:
         V = [step for step in steps if step < 0]
         if V:  # Forcing available before start time
             prestep = max(V)
-            stepdiff = self.stepdiff[steps.index(prestep)]
+            stepdiff = int(self.stepdiff[steps.index(prestep)])
             nextstep = prestep + stepdiff
-            self.U, self.V = self._read_velocity(prestep)
-            self.W = self.compute_w(self.U, self.V)
-            self.Unew, self.Vnew = self._read_velocity(nextstep)
-            self.Wnew = self.compute_w(self.Unew, self.Vnew)
+            self._start_prefetch(prestep)
+            frame = self._get_frame(prestep)
+            newframe = self._get_frame(nextstep)
+            self.U, self.V, self.W = frame["U"], frame["V"], frame["W"]
+            self.Unew, self.Vnew, self.Wnew = newframe["U"], newframe["V"], newframe["W"]
             self.dU = (self.Unew - self.U) / stepdiff
             self.dV = (self.Vnew - self.V) / stepdiff
             self.dW = (self.Wnew - self.W) / stepdiff
@@ -312,19 +622,26 @@ class Forcing:
             self.V = self.V - (prestep + 1) * self.dV
             self.W = self.W - (prestep + 1)*self.dW
             # Other forcing
-            for name in self.ibm_forcing:
-                self[name] = self._read_field(name, prestep)
-                self[name + "new"] = self._read_field(name, nextstep)
-                self["d" + name] = (self[name + "new"] - self[name]) / prestep
-                self[name] = self[name] - (prestep + 1) * self["d" + name]
+            if self.interpolate_ibm_forcing_in_time == "lazy":
+                self._init_lazy_fields(prestep, frame, nextstep, newframe)
+            else:
+                for name in self.ibm_forcing:
+                    self[name] = frame[name]
+                    self[name + "new"] = newframe[name]
+                    if self.interpolate_ibm_forcing_in_time is True:
+                        self["d" + name] = (self[name + "new"] - self[name]) / stepdiff
+                    else:
+                        self["d" + name] = (self[name + "new"] - self[name]) / prestep
+                    self[name] = self[name] - (prestep + 1) * self["d" + name]
 
         elif steps[0] == 0:
             # Simulation start at first forcing time
             # Runge-Kutta needs dU and dV in this case as well
-            self.U, self.V = self._read_velocity(0)
-            self.W = self.compute_w(self.U, self.V)
-            self.Unew, self.Vnew = self._read_velocity(steps[1])
-            self.Wnew = self.compute_w(self.Unew, self.Vnew)
+            self._start_prefetch(0)
+            frame = self._get_frame(0)
+            newframe = self._get_frame(steps[1])
+            self.U, self.V, self.W = frame["U"], frame["V"], frame["W"]
+            self.Unew, self.Vnew, self.Wnew = newframe["U"], newframe["V"], newframe["W"]
             self.dU = (self.Unew - self.U) / steps[1]
             self.dV = (self.Vnew - self.V) / steps[1]
             self.dW = (self.Wnew - self.W) / steps[1]
@@ -337,11 +654,17 @@ class Forcing:
             self.V = self.V - self.dV
             self.W = self.W - self.dW
             # Other forcing:
-            for name in self.ibm_forcing:
-                self[name] = self._read_field(name, 0)
-                self[name + "new"] = self._read_field(name, steps[1])
-                self["d" + name] = (self[name + "new"] - self[name]) / steps[1]
-                self[name] = self[name] - self["d" + name]
+            if self.interpolate_ibm_forcing_in_time == "lazy":
+                self._init_lazy_fields(0, frame, steps[1], newframe)
+            else:
+                for name in self.ibm_forcing:
+                    self[name] = frame[name]
+                    self[name + "new"] = newframe[name]
+                    self["d" + name] = (self[name + "new"] - self[name]) / steps[1]
+                    if self.interpolate_ibm_forcing_in_time is True:
+                        # Synchronize with start time
+                        self[name + "new"] = frame[name]
+                    self[name] = self[name] - self["d" + name]
 
         else:
             # No forcing at start, should already be excluded
@@ -349,6 +672,13 @@ class Forcing:
 
         self.initialization_finished = True
 
+    def _init_lazy_fields(self, prevstep, frame, nextstep, newframe):
+        """Keep the frames surrounding the current time for lazy interpolation"""
+        for name in self.ibm_forcing:
+            self[name + "old"] = frame[name]
+            self[name + "new"] = newframe[name]
+        self._field_steps = [prevstep, nextstep]
+
     # ===================================================
     @staticmethod
     def find_files(force_config):
@@ -367,33 +697,75 @@ class Forcing:
 
     @staticmethod
     def open_dataset(fname):
-        if isinstance(fname, memoryview):
-            import uuid
-            return Dataset(uuid.uuid4(), memory=fname)
-        else:
-            return Dataset(fname)
+        with netcdf_lock:
+            if isinstance(fname, memoryview):
+                import uuid
+                return Dataset(uuid.uuid4(), memory=fname)
+            else:
+                return Dataset(fname)
 
     @staticmethod
-    def scan_file_times(files):
+    def scan_file_times(files, time_index=None, scan_workers=0, io_stats=None):
         """Check files and scan the times
 
+        If *time_index* is the name of a JSON file, the time frames of each
+        forcing file are stored there, and only files that are new or
+        changed since the last scan are opened.
+
+        If *scan_workers* > 1, the files are opened concurrently by this
+        number of worker processes.
+
+        If *io_stats* is an IOStats object, the scan is timed, and files
+        found in the time index are counted as cache hits.
+
         Returns:
           all_frames: List of all time frames
           num_frames: Mapping: filename -> number of time frames in file
 
         """
+        index = read_time_index(time_index) if time_index else None
+
+        # Use time index where possible
+        file_frames = [None] * len(files)  # Time frames of each file
+        index_keys = [None] * len(files)
+        for i, fname in enumerate(files):
+            if index is None or isinstance(fname, memoryview):
+                continue
+            key, signature = time_index_key(fname)
+            index_keys[i] = key, signature
+            entry = index.get(key)
+            if isinstance(entry, dict) and entry.get("signature") == signature:
+                file_frames[i] = [np.datetime64(tf) for tf in entry["times"]]
+
+        # Read the remaining files
+        to_read = [i for i, frames in enumerate(file_frames) if frames is None]
+        if io_stats is None:
+            new_frames = read_times([files[i] for i in to_read], scan_workers)
+        else:
+            io_stats.hit("scan_file_times", len(files) - len(to_read))
+            io_stats.miss("scan_file_times", len(to_read))
+            with io_stats.measure("scan_file_times"):
+                new_frames = read_times([files[i] for i in to_read], scan_workers)
+        for i, frames in zip(to_read, new_frames):
+            file_frames[i] = frames
+            if index_keys[i] is not None:
+                key, signature = index_keys[i]
+                index[key] = dict(
+                    signature=signature,
+                    times=[str(tf) for tf in frames],
+                )
+
+        if index is not None and any(index_keys[i] for i in to_read):
+            write_time_index(time_index, index)
+
         all_frames = []  # All time frames
         num_frames = {}  # Number of time frames in each file
-        for fname in files:
-            with Forcing.open_dataset(fname) as nc:
-                new_times = nc.variables["ocean_time"][:]
-                num_frames[fname] = len(new_times)
-                units = nc.variables["ocean_time"].units
-                new_frames = num2date(new_times, units)
-                all_frames.extend(new_frames)
+        for fname, frames in zip(files, file_frames):
+            num_frames[fname] = len(frames)
+            all_frames.extend(frames)
 
         # Check that time frames are strictly sorted
-        all_frames = np.array([np.datetime64(tf) for tf in all_frames])
+        all_frames = np.array(all_frames)
         I = all_frames[1:] <= all_frames[:-1]
         if np.any(I):
             # print(all_frames[1:][I])
@@ -404,6 +776,15 @@ class Forcing:
         logging.info(f"Number of available forcing times = {len(all_frames)}")
         return all_frames, num_frames
 
+    @staticmethod
+    def read_file_times(fname):
+        """Read the time frames of a forcing file"""
+        with netcdf_lock, Forcing.open_dataset(fname) as nc:
+            new_times = nc.variables["ocean_time"][:]
+            units = nc.variables["ocean_time"].units
+        new_frames = num2date(new_times, units)
+        return [np.datetime64(tf) for tf in new_frames]
+
     @staticmethod
     def forcing_steps(config, files, all_frames, num_frames):
 
@@ -445,18 +826,25 @@ class Forcing:
 
     # ==============================================
 
-    # Turned off time interpolation of scalar fields
-    # TODO: Implement a switch for turning it on again if wanted
     def update(self, t):
         """Update the fields to time step t"""
 
+        if self.initialization_finished and self.read_window:
+            self._check_window(t)
         self._remaining_initialization()
 
-        # Read from config?
-        interpolate_velocity_in_time = True
-        interpolate_ibm_forcing_in_time = False
+        interpolate_velocity_in_time = self.interpolate_velocity_in_time
+        interpolate_ibm_forcing_in_time = self.interpolate_ibm_forcing_in_time is True
 
         logging.debug("Updating forcing, time step = {}".format(t))
+        self._z2s_memo.clear()
+        self._column_memo.clear()
+        self._time = t
+        self.io_stats.step()
+        if self._ring is not None:
+            self._ring_update(t)
+            return
+
         if t in self.steps:  # No time interpolation
             self.U = self.Unew
             self.V = self.Vnew
@@ -465,12 +853,16 @@ class Forcing:
                 self[name] = self[name + "new"]
         else:
             if t - 1 in self.steps:  # Need new fields
-                stepdiff = self.stepdiff[self.steps.index(t - 1)]
+                stepdiff = int(self.stepdiff[self.steps.index(t - 1)])
                 nextstep = t - 1 + stepdiff
-                self.Unew, self.Vnew = self._read_velocity(nextstep)
-                self.Wnew = self.compute_w(self.Unew, self.Vnew)
+                newframe = self._get_frame(nextstep)
+                self.Unew, self.Vnew, self.Wnew = newframe["U"], newframe["V"], newframe["W"]
+                if self._field_steps is not None and nextstep != self._field_steps[1]:
+                    for name in self.ibm_forcing:
+                        self[name + "old"] = self[name + "new"]
+                    self._field_steps = [self._field_steps[1], nextstep]
                 for name in self.ibm_forcing:
-                    self[name + "new"] = self._read_field(name, nextstep)
+                    self[name + "new"] = newframe[name]
                 if interpolate_velocity_in_time:
                     self.dU = (self.Unew - self.U) / stepdiff
                     self.dV = (self.Vnew - self.V) / stepdiff
@@ -484,17 +876,348 @@ class Forcing:
                 self.U += self.dU
                 self.V += self.dV
                 self.W += self.dW
+                self._velocity_increments += 1
             if interpolate_ibm_forcing_in_time:
                 for name in self.ibm_forcing:
                     self[name] += self["d" + name]
 
     # --------------
 
+    def _particle_positions(self):
+        """Return current particle positions, or None if unavailable"""
+        model = getattr(self._grid, "modules", None)
+        if model is None:
+            return None
+        return model.state["X"], model.state["Y"]
+
+    def _particle_extent(self):
+        """Grid cells [j0, j1, i0, i1] covered by the particles, or None"""
+        pos = self._particle_positions()
+        if pos is None or len(pos[0]) == 0:
+            return None
+
+        X = np.asarray(pos[0]) - self._grid.i0
+        Y = np.asarray(pos[1]) - self._grid.j0
+        return [
+            int(np.floor(np.min(Y))), int(np.ceil(np.max(Y))) + 1,
+            int(np.floor(np.min(X))), int(np.ceil(np.max(X))) + 1,
+        ]
+
+    def _particle_window(self, empty=None):
+        """Padded read window around the current particle positions
+
+        Returns *empty* if there are no particles.
+        """
+        extent = self._particle_extent()
+        if extent is None:
+            return empty
+
+        grid = self._grid
+        pad = max(self.read_window, self._step_displacement() + 1)
+        return [
+            max(0, extent[0] - pad), min(grid.jmax, extent[1] + pad),
+            max(0, extent[2] - pad), min(grid.imax, extent[3] + pad),
+        ]
+
+    def _step_displacement(self):
+        """Largest horizontal advection in one time step, in grid cells
+
+        Returns 0 if no velocity has been read yet.
+        """
+        if self._ring is not None:
+            U, V = self._ring["U"], self._ring["V"]
+        elif hasattr(self, "U"):
+            U, V = self.U, self.V
+        else:
+            return 0
+        speed = max(
+            float(U.max(initial=0)), -float(U.min(initial=0)),
+            float(V.max(initial=0)), -float(V.min(initial=0)))
+        min_dx = min(float(np.min(self._grid.dx)), float(np.min(self._grid.dy)))
+        return int(np.ceil(speed * self.dt / min_dx))
+
+    def _check_window(self, t):
+        """Grow the read window if particles approach its edge"""
+        extent = self._particle_extent()
+        if extent is None:
+            return
+
+        # Particles must stay at least half the padding away from the edges,
+        # unless the window is already at the subgrid boundary. After one
+        # more time step, they are then still one cell away from the edges,
+        # as needed by the vertical velocity stencil.
+        margin = max(self.read_window // 2, self._step_displacement() + 1)
+        grid = self._grid
+        j0, j1, i0, i1 = self._window
+        is_empty = j1 <= j0 or i1 <= i0
+        too_small = is_empty or (
+            (j0 > 0 and extent[0] < j0 + margin)
+            or (j1 < grid.jmax and extent[1] > j1 - margin)
+            or (i0 > 0 and extent[2] < i0 + margin)
+            or (i1 < grid.imax and extent[3] > i1 - margin)
+        )
+        if not too_small:
+            return
+
+        window = self._particle_window()
+        if not is_empty:
+            window = [
+                min(j0, window[0]), max(j1, window[1]),
+                min(i0, window[2]), max(i1, window[3]),
+            ]
+        logging.info(f"Expanding forcing read window to {window}")
+        self._window = window
+        self._reload_fields(t - 1)
+
+    def _reload_fields(self, t):
+        """Re-read the forcing fields valid at time step t
+
+        The fields are restored to the state they had after calling
+        ``self.update(t)``.
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+
+        steps = self.steps
+        prev_idx = max(i for i, step in enumerate(steps) if step <= t)
+        prevstep = steps[prev_idx]
+        nextstep = steps[min(prev_idx + 1, len(steps) - 1)]
+        stepdiff = max(1, nextstep - prevstep)
+        frame = self._load_frame(prevstep)
+        newframe = self._load_frame(nextstep)
+
+        self._time = t
+        if self._ring is not None:
+            self._ring_fill(prevstep, frame, nextstep, newframe)
+            if prevstep < 0:
+                self._ring_hold_extrapolated(prevstep)
+            else:
+                self._ring_hold(self._ring_new if prev_idx == 0 else 1 - self._ring_new)
+
+        else:
+            for name in ["U", "V", "W"]:
+                if prevstep == t:
+                    self[name] = self[name + "new"] = frame[name]
+                else:
+                    self[name + "new"] = newframe[name]
+                    self["d" + name] = (newframe[name] - frame[name]) / stepdiff
+                    self[name] = frame[name] + (t - prevstep) * self["d" + name]
+
+            # Mimic the first forcing interval of _remaining_initialization
+            if self.interpolate_ibm_forcing_in_time == "lazy":
+                self._init_lazy_fields(prevstep, frame, nextstep, newframe)
+            else:
+                for name in self.ibm_forcing:
+                    self[name + "new"] = newframe[name]
+                    if self.interpolate_ibm_forcing_in_time is True:
+                        if prevstep == t:
+                            self[name] = self[name + "new"] = frame[name]
+                        else:
+                            self["d" + name] = (newframe[name] - frame[name]) / stepdiff
+                            self[name] = frame[name] + (t - prevstep) * self["d" + name]
+                    elif prevstep < 0:
+                        self["d" + name] = (newframe[name] - frame[name]) / prevstep
+                        self[name] = frame[name] - (prevstep + 1) * self["d" + name]
+                    elif prev_idx == 0:
+                        self[name] = newframe[name]
+                    else:
+                        self[name] = frame[name]
+
+        # The next frame is read when t - 1 is a forcing step
+        if prevstep == t:
+            self._start_prefetch(nextstep)
+        elif nextstep != steps[-1]:
+            self._start_prefetch(steps[steps.index(nextstep) + 1])
+
+    # --------------
+    # Ring buffer
+    # --------------
+
+    def _ring_initialization(self):
+        """Fill the frame slots of the ring buffer at start"""
+        steps = self.steps
+        V = [step for step in steps if step < 0]
+        if V:  # Forcing available before start time
+            prestep = max(V)
+            nextstep = prestep + int(self.stepdiff[steps.index(prestep)])
+        elif steps[0] == 0:
+            prestep = 0
+            nextstep = steps[1]
+        else:
+            # No forcing at start, should already be excluded
+            raise SystemExit(3)
+
+        self._start_prefetch(prestep)
+        frame = self._get_frame(prestep)
+        newframe = self._get_frame(nextstep)
+        self._ring_fill(prestep, frame, nextstep, newframe)
+
+        # Other forcing, as in the standard buffer
+        if prestep < 0:
+            self._ring_hold_extrapolated(prestep)
+        else:
+            self._ring_hold(self._ring_new)
+
+    def _ring_fill(self, prevstep, frame, nextstep, newframe):
+        """Copy two frames into the slots, allocating them if necessary"""
+        if self._ring is None:
+            self._ring = {
+                name: np.empty((2,) + np.shape(value), dtype=np.asarray(value).dtype)
+                for name, value in frame.items()
+            }
+        for name, slots in self._ring.items():
+            slots[0] = frame[name]
+            slots[1] = newframe[name]
+        self._shear_fields.clear()
+        self._ring_steps = [prevstep, nextstep]
+        self._ring_new = 1
+
+    def _ring_update(self, t):
+        """Advance the ring buffer to time step t"""
+        if t in self.steps:
+            self._ring_hold(self._ring_new)
+        elif t - 1 in self.steps:  # Need new fields
+            nextstep = t - 1 + int(self.stepdiff[self.steps.index(t - 1)])
+            if nextstep != self._ring_steps[self._ring_new]:
+                # Overwrite the oldest frame
+                old = 1 - self._ring_new
+                frame = self._get_frame(nextstep)
+                for name, slots in self._ring.items():
+                    slots[old] = frame[name]
+                self._shear_fields.pop(old, None)
+                self._ring_steps[old] = nextstep
+                self._ring_new = old
+
+    def _ring_hold(self, slot):
+        """Use the ibm forcing fields of the given slot, without interpolation"""
+        for name in self.ibm_forcing:
+            self[name] = self._ring[name][slot]
+
+    def _ring_hold_extrapolated(self, prestep):
+        """Ibm forcing fields before the first forcing step after start
+
+        Mimics the standard buffer, which extrapolates the fields to time
+        step = -1 and keeps them until the next forcing step.
+        """
+        for name in self.ibm_forcing:
+            old, new = self._ring[name][1 - self._ring_new], self._ring[name][self._ring_new]
+            d = (new - old) / prestep
+            self[name] = old - (prestep + 1) * d
+
+    def _ring_interp(self, sample, tstep=0, interpolate=True):
+        """Interpolate in time between values sampled from the two slots
+
+        *sample(i)* should return the values sampled from frame slot i.
+        Without interpolation, the slot of the last forcing step is used.
+        """
+        new = self._ring_new
+        oldstep, newstep = self._ring_steps[1 - new], self._ring_steps[new]
+        if interpolate:
+            w = self._time_weight(oldstep, newstep, tstep)
+        else:
+            w = float(self._time >= newstep)
+        return time_interp(sample, 1 - new, new, w)
+
+    def _time_weight(self, oldstep, newstep, tstep=0):
+        """Time interpolation weight of the frame at time step = newstep"""
+        if newstep == oldstep:
+            return 1.0
+        return (self._time + tstep - oldstep) / (newstep - oldstep)
+
+    def _sample_field(self, name, sample):
+        """Sample ibm forcing field *name* using the function sample(F)
+
+        With lazy time interpolation, the two surrounding frames are sampled
+        and interpolated, instead of interpolating the whole field.
+        """
+        if self._ring is not None and self.interpolate_ibm_forcing_in_time:
+            slots = self._ring[name]
+            return self._ring_interp(lambda i: sample(slots[i]))
+
+        if self.interpolate_ibm_forcing_in_time == "lazy":
+            w = self._time_weight(*self._field_steps)
+            return time_interp(sample, self[name + "old"], self[name + "new"], w)
+
+        return sample(self[name])
+
+    def _start_prefetch(self, n):
+        """Start reading frames from time step = n in a background thread"""
+        if self.prefetch > 0:
+            first = self.steps.index(n)
+            self._prefetcher = FramePrefetcher(
+                self._load_frame, self.steps[first:], self.prefetch)
+
+    def _get_frame(self, n):
+        """Return all forcing fields at time step = n"""
+        if self._prefetcher is not None:
+            return self._prefetcher.get(n)
+        return self._load_frame(n)
+
+    def _load_frame(self, n):
+        """Read and preprocess all forcing fields at time step = n"""
+        U, V = self._read_velocity(n)
+        frame = dict(U=U, V=V, W=self._vertical_velocity(n, U, V))
+        for name in self.ibm_forcing:
+            frame[name] = self._read_field(name, n)
+        if self.dtype is not None:
+            for name, value in frame.items():
+                frame[name] = np.asarray(value, dtype=self.dtype)
+        return frame
+
+    def _vertical_velocity(self, n, U, V):
+        """Diagnose vertical velocity at time step = n, or load it from cache"""
+        fname = self._w_cache_file(n)
+        if fname is None:
+            return self.compute_w(U, V)
+
+        if os.path.exists(fname):
+            try:
+                with self.io_stats.measure("w_cache") as m:
+                    W = m.add(np.load(fname))
+                self.io_stats.hit("w_cache")
+                return W
+            except (OSError, ValueError):
+                logging.warning(f"Could not read cached vertical velocity {fname}")
+
+        self.io_stats.miss("w_cache")
+        W = self.compute_w(U, V)
+
+        # Write to a temporary file first, in case several runs share the cache
+        os.makedirs(self.w_cache, exist_ok=True)
+        tmp_fname = f"{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_fname, "wb") as fp:
+            np.save(fp, W)
+        os.replace(tmp_fname, fname)
+        return W
+
+    def _w_cache_file(self, n):
+        """Name of cache file for vertical velocity at time step = n"""
+        forcing_file = self.file_idx[n]
+        if self.w_cache is None or isinstance(forcing_file, memoryview):
+            return None
+
+        # Cache key: Forcing file, frame, subgrid, horizontal and vertical grid
+        grid = self._grid
+        if self._w_cache_grid is None:
+            self._w_cache_grid = arrays_sha1(grid.H, grid.dx, grid.dy)
+        stat = os.stat(forcing_file)
+        key = hashlib.sha1()
+        key.update(os.path.abspath(forcing_file).encode("utf-8"))
+        key.update(repr((stat.st_size, stat.st_mtime_ns, self.frame_idx[n])).encode())
+        key.update(repr((grid.i0, grid.i1, grid.j0, grid.j1, self.w_engine)).encode())
+        key.update(repr(self._window).encode())
+        key.update(self._w_cache_grid.encode())
+        key.update(repr((float(grid.hc), int(grid.Vtransform))).encode())
+        key.update(np.asarray(grid.Cs_r, dtype="f8").tobytes())
+        key.update(np.asarray(grid.Cs_w, dtype="f8").tobytes())
+        return os.path.join(self.w_cache, f"w_{key.hexdigest()}.npy")
+
     def open_forcing_file(self, n):
         """Open forcing file at time step = n"""
         nc = self._nc
-        nc = self.open_dataset(self.file_idx[n])
-        nc.set_auto_maskandscale(False)
+        with self.io_stats.measure("open_forcing_file", hit=False, lock=netcdf_lock):
+            nc = self.open_dataset(self.file_idx[n])
 
         self.scaled = dict()
         self.scale_factor = dict()
@@ -502,15 +1225,18 @@ class Forcing:
 
         # Åpne for alias til navn
         forcing_variables = ["u", "v"] + self.ibm_forcing
-        for key in forcing_variables:
-            if hasattr(nc.variables[key], "scale_factor"):
-                self.scaled[key] = True
-                self.scale_factor[key] = np.float32(nc.variables[key].scale_factor)
-                self.add_offset[key] = np.float32(nc.variables[key].add_offset)
-            else:
-                self.scaled[key] = False
+        with netcdf_lock:
+            nc.set_auto_maskandscale(False)
+            for key in forcing_variables:
+                if hasattr(nc.variables[key], "scale_factor"):
+                    self.scaled[key] = True
+                    self.scale_factor[key] = np.float32(nc.variables[key].scale_factor)
+                    self.add_offset[key] = np.float32(nc.variables[key].add_offset)
+                else:
+                    self.scaled[key] = False
 
         self._nc = nc
+        self._nc_file = self.file_idx[n]
 
     def _read_velocity(self, n):
         """Read fields at time step = n"""
@@ -521,18 +1247,23 @@ class Forcing:
         # Always read velocity before other fields
         logging.info("Reading velocity for time step = {}".format(n))
 
-        # If finished a file or first read (self._nc == "")
+        # If first read or time step is in another file
         if not self._nc:  # First read
             self.open_forcing_file(n)
-        elif self.frame_idx[n] == 0:  # Just finished a forcing file
-            self._nc.close()
+        elif self.file_idx[n] != self._nc_file:  # Time step in another file
+            with netcdf_lock:
+                self._nc.close()
             self.open_forcing_file(n)
+        else:
+            self.io_stats.hit("open_forcing_file")
 
         frame = self.frame_idx[n]
 
         # Read the velocity
-        U = self._nc.variables["u"][frame, :, self._grid.Ju, self._grid.Iu]
-        V = self._nc.variables["v"][frame, :, self._grid.Jv, self._grid.Iv]
+        grid = self._grid
+        with self.io_stats.measure("read_velocity", lock=netcdf_lock) as m:
+            U = self._read_subgrid("u", frame, grid.i0 - 1, grid.j0, 1, 0, m)
+            V = self._read_subgrid("v", frame, grid.i0, grid.j0 - 1, 0, 1, m)
 
         # Scale if needed
         # Assume offset = 0 for velocity
@@ -551,49 +1282,177 @@ class Forcing:
     def _read_field(self, name, n):
         """Read a 3D field"""
         frame = self.frame_idx[n]
-        F = self._nc.variables[name][frame, :, self._grid.J, self._grid.I]
+        with self.io_stats.measure("read_field", lock=netcdf_lock) as m:
+            F = self._read_subgrid(name, frame, self._grid.i0, self._grid.j0, 0, 0, m)
         if self.scaled[name]:
             F = self.add_offset[name] + self.scale_factor[name] * F
         return F
 
+    def _read_subgrid(self, name, frame, i_start, j_start, di, dj, measurement):
+        """Read a 3D subgrid variable, restricted to the read window if active
+
+        *i_start*, *j_start*: File index of the first subgrid column and row
+        *di*, *dj*: Number of extra columns and rows compared to rho-points
+        *measurement*: I/O statistics entry counting the hyperslab read from
+        file, before it is padded to the full subgrid
+        """
+        grid = self._grid
+        with netcdf_lock:
+            var = self._nc.variables[name]
+            if self._window is None:
+                return measurement.add(var[
+                    frame, :, j_start:j_start + grid.jmax + dj,
+                    i_start:i_start + grid.imax + di])
+
+            j0, j1, i0, i1 = self._window
+            F = np.zeros((var.shape[1], grid.jmax + dj, grid.imax + di), dtype=var.dtype)
+            if j1 > j0 and i1 > i0:
+                F[:, j0:j1 + dj, i0:i1 + di] = measurement.add(var[
+                    frame, :, j_start + j0:j_start + j1 + dj,
+                    i_start + i0:i_start + i1 + di])
+        return F
+
     # Allow item notation
     def __setitem__(self, key, value):
         setattr(self, key, value)
 
     def __getitem__(self, key):
+        if self._ring is not None and key in ("U", "V", "W"):
+            # Full interpolated field, for compatibility
+            return self._ring_interp(
+                lambda i: self._ring[key][i],
+                interpolate=self.interpolate_velocity_in_time)
         return getattr(self, key)
 
+    def current_field(self, name):
+        """Forcing field *name* on the whole subgrid at the current time step"""
+        if name in ("U", "V", "W"):
+            return self[name]
+        return self._sample_field(name, lambda F: F)
+
     # ------------------
 
     def close(self):
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+
+        with netcdf_lock:
+            self._nc.close()
+
+    def _z2s(self, stagger, I, J, Z):
+        """Vertical level of depth Z in grid cell (I, J)
+
+        The level is found in the depth array z_r (stagger = "r") or z_w
+        (stagger = "w").
+        """
+        self._check_sampled_window(I, J)
+        return z2s_columns(self._z_columns(stagger), I, J, Z)
+
+    def _check_sampled_window(self, I, J):
+        """Warn if positions I, J are outside the read window
 
-        self._nc.close()
+        The forcing fields are zero outside the window. The warning is given
+        at most once per time step.
+        """
+        if self._window is None or np.size(I) == 0 or self._window_warned == self._time:
+            return
+        j0, j1, i0, i1 = self._window
+        if (
+            np.min(I) < i0 - 0.5 or np.max(I) >= i1 - 0.5
+            or np.min(J) < j0 - 0.5 or np.max(J) >= j1 - 0.5
+        ):
+            logging.warning(
+                f"Particles sampled outside the forcing read window {self._window} "
+                f"at time step {self._time}, increase read_window")
+            self._window_warned = self._time
+
+    def _field_z2s(self, X, Y, Z, I, J):
+        """Memoized vertical lookup of field() for particle positions X, Y, Z
+
+        Callers often sample several fields at the same positions, as ladim
+        does for the ibm_forcing variables. The result is reused if the
+        same position arrays are passed again within the time step. The
+        other sampling methods are called with new positions each time,
+        and do not use the memo. The returned arrays must not be modified.
+        """
+        memo = self._z2s_memo.get("field")
+        if memo is not None:
+            arrays, values, result = memo
+            if (
+                all(a is b for a, b in zip(arrays, (X, Y, Z)))
+                and all(np.array_equal(a, b) for a, b in zip(values, (X, Y, Z)))
+            ):
+                return result
+
+        result = self._z2s("r", I, J, Z)
+        # Position arrays are often updated in place, hence the value copies
+        self._z2s_memo["field"] = ((X, Y, Z), (X.copy(), Y.copy(), Z.copy()), result)
+        return result
+
+    def _z_columns(self, stagger):
+        name = "z_" + stagger + "_cols"
+        z_cols = getattr(self._grid, name, None)
+        if z_cols is None:  # Grid class without precomputed columns
+            z_cols = z_columns(getattr(self._grid, "z_" + stagger))
+            setattr(self._grid, name, z_cols)
+        return z_cols
 
     def velocity(self, X, Y, Z, tstep=0, method="bilinear"):
 
         i0 = self._grid.i0
         j0 = self._grid.j0
-        K, A = z2s(self._grid.z_w, X - i0, Y - j0, Z)
+        K, A = self._z2s("w", X - i0, Y - j0, Z)
+        return self._sample_uv(X - i0, Y - j0, K, A, tstep, method)
+
+    def _sample_uv(self, x, y, K, A, tstep, method):
         A = np.ones_like(A)
         idx_K_limit = K >= self._grid.z_w.shape[0] - 1
-        K[idx_K_limit] = self._grid.z_w.shape[0] - 2
+        K = np.minimum(K, self._grid.z_w.shape[0] - 2)
         A[idx_K_limit] = 0
-        if tstep < 0.001:
+        if self._ring is not None:
+            U, V = self._ring["U"], self._ring["V"]
+            x_u, y_v = x + 0.5, y + 0.5
+            x, y = np.round(x), np.round(y)
+            interpolate = self.interpolate_velocity_in_time
+            return (
+                self._ring_interp(
+                    lambda i: self._sample(U[i], x_u, y, K, A, method),
+                    tstep, interpolate),
+                self._ring_interp(
+                    lambda i: self._sample(V[i], x, y_v, K, A, method),
+                    tstep, interpolate),
+            )
+
+        if tstep < 0.001 or not self.interpolate_velocity_in_time:
             U = self.U
             V = self.V
         else:
             U = self.U + tstep * self.dU
             V = self.V + tstep * self.dV
-        return sample3DUV(U, V, X - i0, Y - j0, K, A, method=method)
+        return (
+            self._sample(U, x + 0.5, np.round(y), K, A, method),
+            self._sample(V, np.round(x), y + 0.5, K, A, method),
+        )
+
+    def _sample(self, F, X, Y, K, A, method):
+        if method == "bilinear":
+            return sample3D_fused(F, X, Y, K, A, self._sample_work)
+        return sample3D(F, X, Y, K, A, method=method)
 
     # Simplify to grid cell
     def field(self, X, Y, Z, name):
         # should not be necessary to repeat
         i0 = self._grid.i0
         j0 = self._grid.j0
-        K, A = z2s(self._grid.z_r, X - i0, Y - j0, Z)
-        F = self[name]
-        return sample3D(F, X - i0, Y - j0, K, A, method="nearest")
+        K, A = self._field_z2s(X, Y, Z, X - i0, Y - j0)
+        if self.field_engine == "columns":
+            I = (X - i0).round().astype("int")
+            J = (Y - j0).round().astype("int")
+            columns, index = self._columns(name, I, J)
+            return columns[K, index]
+        return self._sample_field(
+            name, lambda F: sample3D(F, X - i0, Y - j0, K, A, method="nearest"))
 
     def vertdiff(self, X, Y, Z, name):
         MAXIMUM_K = len(self._grid.Cs_w) - 2
@@ -602,12 +1461,38 @@ class Forcing:
 
         I = np.int32(np.round(X)) - self._grid.i0
         J = np.int32(np.round(Y)) - self._grid.j0
-        K, A = z2s(self._grid.z_w, I, J, Z)
+        K, A = self._z2s("w", I, J, Z)
         K_nearest = np.round(K - A).astype(np.int32)
         K_nearest = np.minimum(MAXIMUM_K, K_nearest)
         K_nearest = np.maximum(MINIMUM_K, K_nearest)
-        F = self[name]
-        return np.maximum(MINIMUM_D, F[K_nearest, J, I])
+        if self.field_engine == "columns":
+            columns, index = self._columns(name, I, J)
+            F = columns[K_nearest, index]
+        else:
+            F = self._sample_field(name, lambda F: F[K_nearest, J, I])
+        return np.maximum(MINIMUM_D, F)
+
+    def _columns(self, name, I, J):
+        """Columns of ibm forcing field *name* in the grid cells (I, J)
+
+        Only the unique columns are gathered (and interpolated in time, if
+        enabled). They are reused within the time step when the same cells
+        are sampled again, as in the substeps of the vertical diffusion.
+        Returns the columns and the column index of each cell, such that
+        columns[:, index] == F[:, J, I]. The columns must not be modified.
+        """
+        imax = self._grid.H.shape[1]
+        cells = J.astype(np.intp) * imax + I
+        key = (name, len(cells), cells[:1].tobytes(), cells[-1:].tobytes())
+        memo = self._column_memo.get(key)
+        if memo is not None and np.array_equal(memo[0], cells):
+            return memo[1], memo[2]
+
+        unique, index = np.unique(cells, return_inverse=True)
+        J_col, I_col = np.divmod(unique, imax)
+        columns = self._sample_field(name, lambda F: F[:, J_col, I_col])
+        self._column_memo[key] = (cells, columns, index)
+        return columns, index
 
     def horzdiff(self, X, Y, Z):
         # Compute horizontal diffusivity using Smagorinsky (1963)
@@ -618,28 +1503,129 @@ class Forcing:
         J = np.int32(np.round(Y)) - self._grid.j0
         I = np.maximum(0, np.minimum(imax - 2, I))
         J = np.maximum(0, np.minimum(jmax - 2, J))
-        K, A = z2s(self._grid.z_r, I, J, Z)
+        K, A = self._z2s("r", I, J, Z)
 
-        u1 = (1 - A) * self['U'][K, J, I] + A * self['U'][K - 1, J, I]
-        u2 = (1 - A) * self['U'][K, J + 1, I] + A * self['U'][K - 1, J + 1, I]
-        v1 = (1 - A) * self['V'][K, J, I] + A * self['V'][K - 1, J, I]
-        v2 = (1 - A) * self['V'][K, J, I + 1] + A * self['V'][K - 1, J, I + 1]
-
-        dudy = u2 - u1
-        dvdx = v2 - v1
+        if self.horzdiff_engine == "field":
+            def sample(S):
+                return (1 - A) * S[K, J, I] + A * S[K - 1, J, I]
+        else:
+            sample = None
+
+        if self._ring is not None:
+            U, V = self._ring["U"], self._ring["V"]
+            if sample:
+                shear = self._ring_interp(
+                    lambda i: sample(self._shear_field(i, U[i], V[i])),
+                    interpolate=self.interpolate_velocity_in_time)
+            else:
+                shear = self._ring_interp(
+                    lambda i: self._shear(U[i], V[i], I, J, K, A),
+                    interpolate=self.interpolate_velocity_in_time)
+        elif sample:
+            shear = self._current_shear(sample)
+        else:
+            shear = self._shear(self['U'], self['V'], I, J, K, A)
 
-        AHs = 0.04 * self._grid.dx[J, I] * np.abs(dudy + dvdx)
+        AHs = 0.04 * self._grid.dx[J, I] * np.abs(shear)
         AHs[~self._grid.atsea(I + self._grid.i0, J + self._grid.j0)] = 0
 
         return AHs
 
+    def _shear_field(self, key, U, V):
+        """Horizontal shear in all grid cells, computed once per key
+
+        The key is the index of a frame slot in the ring buffer, or
+        "increment" for the velocity increment dU, dV of the standard buffer.
+        Sampling the field at level K and K - 1 gives the same as _shear,
+        up to round-off.
+        """
+        S = self._shear_fields.get(key)
+        if S is None:
+            S = self._shear_fields[key] = self._subgrid_shear(U, V)
+        return S
+
+    def _subgrid_shear(self, U, V):
+        """Horizontal shear dU/dy + dV/dx in all grid cells"""
+        jmax, imax = self._grid.H.shape
+        S = U[:, 1:jmax, :imax - 1] - U[:, :jmax - 1, :imax - 1]
+        S += V[:, :jmax - 1, 1:imax]
+        S -= V[:, :jmax - 1, :imax - 1]
+        return S
+
+    def _current_shear(self, sample):
+        """Shear of the current velocity in the standard buffer
+
+        The shear field is computed when the velocity is set from a forcing
+        frame, and sampled with the function sample(S). If the velocity is
+        interpolated in time, the shear field of the increment dU, dV is
+        computed once per forcing interval, and its sampled value is added
+        once for every increment since the velocity was set.
+        """
+        U, V = self["U"], self["V"]
+        dU = getattr(self, "dU", None)
+        k = self._velocity_increments
+        frame = self._shear_fields.get("frame")
+        if frame is None or frame[1] is not U or frame[2] is not dU:
+            self._shear_fields.pop("increment", None)
+            frame = (self._subgrid_shear(U, V), U, dU, k)
+            self._shear_fields["frame"] = frame
+
+        S, _, _, k0 = frame
+        shear = sample(S)
+        if k > k0:
+            shear += (k - k0) * sample(self._shear_field("increment", dU, self.dV))
+        return shear
+
+    @staticmethod
+    def _shear(U, V, I, J, K, A):
+        """Horizontal shear dU/dy + dV/dx in grid cell (I, J)"""
+        u1 = (1 - A) * U[K, J, I] + A * U[K - 1, J, I]
+        u2 = (1 - A) * U[K, J + 1, I] + A * U[K - 1, J + 1, I]
+        v1 = (1 - A) * V[K, J, I] + A * V[K - 1, J, I]
+        v2 = (1 - A) * V[K, J, I + 1] + A * V[K - 1, J, I + 1]
+
+        dudy = u2 - u1
+        dvdx = v2 - v1
+        return dudy + dvdx
+
     def compute_w(self, u_in, v_in):
-        z_r = self._grid.z_r[np.newaxis, :, :, :]
-        z_w = self._grid.z_w[np.newaxis, :, :, :]
+        grid = self._grid
+        if self._window is None:
+            return self._compute_w(
+                u_in, v_in, grid.z_w, grid.z_r, grid.dx, grid.dy)
+
+        # Compute only within the read window, zero outside. The stencil
+        # needs one more grid cell on each side, where the velocity is zero.
+        # This only affects the values outside the window.
+        j0, j1, i0, i1 = self._window
+        if self.w_engine == "lean":
+            dtype = np.float32
+        else:
+            dtype = np.result_type(u_in, v_in, grid.z_w)
+        w = np.zeros(grid.z_w.shape, dtype=dtype)
+        if j1 > j0 and i1 > i0:
+            jj0, jj1 = max(0, j0 - 1), min(grid.jmax, j1 + 1)
+            ii0, ii1 = max(0, i0 - 1), min(grid.imax, i1 + 1)
+            if jj1 - jj0 > 2 and ii1 - ii0 > 2:
+                J, I = slice(jj0, jj1), slice(ii0, ii1)
+                w_pad = self._compute_w(
+                    u_in[:, J, ii0:ii1 + 1], v_in[:, jj0:jj1 + 1, I], grid.z_w[:, J, I],
+                    grid.z_r[:, J, I], grid.dx[J, I], grid.dy[J, I])
+                w[:, j0:j1, i0:i1] = w_pad[:, j0 - jj0:j1 - jj0, i0 - ii0:i1 - ii0]
+        return w
+
+    def _compute_w(self, u_in, v_in, z_w, z_r, dx, dy):
+        if self.w_engine == "lean":
+            return compute_w_lean(
+                1 / dy, 1 / dx, u_in[:, :, 1:-1], v_in[:, 1:-1, :], z_w, z_r,
+                self._w_work)
+
+        z_r = z_r[np.newaxis, :, :, :]
+        z_w = z_w[np.newaxis, :, :, :]
         u = u_in[np.newaxis, :, :, 1:-1]
         v = v_in[np.newaxis, :, 1:-1, :]
-        pm = 1 / self._grid.dx
-        pn = 1 / self._grid.dy
+        pm = 1 / dx
+        pn = 1 / dy
 
         w = compute_w(pn, pm, u, v, z_w, z_r)
         return w[0]
@@ -647,11 +1633,103 @@ class Forcing:
     def wvel(self, X, Y, Z, tstep=0.0, method='bilinear'):
         i0 = self._grid.i0
         j0 = self._grid.j0
-        K, A = z2s(self._grid.z_w, X-i0, Y-j0, Z)
+        K, A = self._z2s("w", X - i0, Y - j0, Z)
+        x, y = np.round(X - i0), np.round(Y - j0)
+        if self._ring is not None:
+            W = self._ring["W"]
+            return self._ring_interp(
+                lambda i: self._sample(W[i], x, y, K, A, method),
+                tstep, self.interpolate_velocity_in_time)
+
         F = self['W']
-        if tstep >= 0.001:
+        if tstep >= 0.001 and self.interpolate_velocity_in_time:
             F += tstep*self['dW']
-        return sample3D(F, np.round(X-i0), np.round(Y-j0), K, A, method=method)
+        return self._sample(F, np.round(X-i0), np.round(Y-j0), K, A, method)
+
+
+def time_interp(sample, old, new, w):
+    """Interpolate in time between values sampled from two frames
+
+    Returns (1 - w) * sample(old) + w * sample(new), sampling only the
+    frames that are needed. Sampling is linear in the field values, so
+    this is the same as sampling the interpolated field, without computing
+    the whole field.
+    """
+    if w == 1:
+        return sample(new)
+    values = sample(old)
+    if w == 0:
+        return values
+    return (1 - w) * values + w * sample(new)
+
+
+class FramePrefetcher:
+    """Read forcing frames ahead of time in a background thread
+
+    The frames are loaded in the order given by *steps*, and at most
+    *queue_size* finished frames are kept waiting in memory. Frames must be
+    requested in the same order using :meth:`get`, but the most recent frame
+    may be requested more than once. The *load* function must hold
+    :data:`netcdf_lock` while it accesses netCDF files.
+    """
+
+    def __init__(self, load, steps, queue_size=1):
+        self._load = load
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._last = (None, None)
+        self._thread = threading.Thread(
+            target=self._run, args=(list(steps), ), daemon=True)
+        self._thread.start()
+
+    def _run(self, steps):
+        for n in steps:
+            try:
+                item = (n, self._load(n), None)
+            except Exception as e:
+                item = (n, None, e)
+
+            # Wait for free space in the queue, unless we are told to stop
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+            if self._stop.is_set() or item[2] is not None:
+                return
+
+    def get(self, n):
+        """Return the frame at time step = n, waiting for it if necessary"""
+        last_step, last_frame = self._last
+        if last_step == n:
+            return {k: v.copy() for k, v in last_frame.items()}
+
+        while True:
+            try:
+                step, frame, err = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._thread.is_alive() or not self._queue.empty():
+                    continue
+                raise ValueError(f"Forcing frame {n} is not prefetched")
+
+            if err is not None:
+                raise err
+            if step == n:
+                self._last = (step, frame)
+                return frame
+            if step > n:
+                raise ValueError(f"Forcing frame {n} requested out of order")
+
+    def close(self):
+        """Stop the background thread and discard any prefetched frames"""
+        self._stop.set()
+        self._thread.join()
+        self._last = (None, None)
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
 
 # ---------------------------------------------
 #      Low-level vertical functions
@@ -660,6 +1738,103 @@ class Forcing:
 # ----------------------------------------------
 
 
+def read_times(files, workers=0):
+    """Read the time frames of several forcing files, in order
+
+    With workers > 1, the files are read by a pool of worker processes.
+    Threads are not used since the netCDF library is not thread safe.
+    """
+    workers = min(workers, len(files))
+    if workers <= 1 or any(isinstance(f, memoryview) for f in files):
+        return [Forcing.read_file_times(f) for f in files]
+
+    import concurrent.futures
+    import multiprocessing
+    ctx = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=ctx) as ex:
+        chunksize = max(1, len(files) // (4 * workers))
+        return list(ex.map(Forcing.read_file_times, files, chunksize=chunksize))
+
+
+def time_index_key(fname):
+    """Key and signature of a forcing file in the time index"""
+    stat = os.stat(fname)
+    return os.path.abspath(fname), [stat.st_size, stat.st_mtime_ns]
+
+
+def read_time_index(fname):
+    """Read time index file, or return an empty index if it is unusable"""
+    try:
+        with open(fname) as fp:
+            index = json.load(fp)
+    except FileNotFoundError:
+        return dict()
+    except (OSError, ValueError):
+        logging.warning(f"Could not read time index {fname}")
+        return dict()
+    if not isinstance(index, dict):
+        return dict()
+    return index
+
+
+def write_time_index(fname, index):
+    """Write time index file, via a temporary file"""
+    tmp_fname = f"{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_fname, "w") as fp:
+        json.dump(index, fp)
+    os.replace(tmp_fname, fname)
+
+
+def grid_variables_sha1(grid_file):
+    """Hex digest of the variables in a grid file that are read by Grid"""
+    sha1 = hashlib.sha1()
+    with netcdf_lock, Dataset(grid_file) as ncid:
+        ncid.set_auto_mask(False)
+        for name in GRID_VARIABLES:
+            if name in ncid.variables:
+                sha1.update(name.encode())
+                sha1.update(np.ascontiguousarray(ncid.variables[name][:]).tobytes())
+    return sha1.hexdigest()
+
+
+def remove_outdated_bundles(cache, key):
+    """Remove grid bundles made from an earlier version of the same grid file
+
+    Bundles in the directory *cache* are outdated if their key has the same
+    grid file, subgrid and Vinfo as *key*, but a different file version.
+    """
+    same_source = ("grid_file", "subgrid", "Vinfo")
+    for entry in os.listdir(cache):
+        path = os.path.join(cache, entry)
+        try:
+            with open(os.path.join(path, "manifest.json")) as fp:
+                other_key = json.load(fp)["key"]
+        except (OSError, ValueError, KeyError, TypeError):
+            continue
+        if other_key == key or not isinstance(other_key, dict):
+            continue
+        if all(other_key.get(k) == key[k] for k in same_source):
+            logging.info("Removing outdated grid bundle " + path)
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def arrays_sha1(*arrays):
+    """Hex digest of the shapes and values of numerical arrays"""
+    sha1 = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a, dtype="f8")
+        sha1.update(repr(a.shape).encode())
+        sha1.update(a.tobytes())
+    return sha1.hexdigest()
+
+
+def _json_scalar(value):
+    """Convert numpy scalars for json.dump"""
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
 def s_stretch(N, theta_s, theta_b, stagger="rho", Vstretching=1):
     """Compute a s-level stretching array
 
@@ -814,6 +1989,49 @@ def z2s(z_rho, X, Y, Z):
     return K, A
 
 
+def z_columns(z):
+    """Copy of a 3D depth array, with contiguous vertical columns
+
+    The result has shape (jmax, imax, kmax), for use with z2s_columns.
+    """
+    return np.ascontiguousarray(np.moveaxis(z, 0, -1))
+
+
+def z2s_columns(z_cols, X, Y, Z):
+    """
+    Find s-level and coefficients for vertical interpolation
+
+    Same as z2s, but using a binary search in the vertical columns of
+    z_cols = z_columns(z_rho). The result is identical to z2s.
+    """
+
+    jmax, imax, kmax = z_cols.shape
+    z_flat = z_cols.ravel()
+
+    # Find rho-based horizontal grid cell (rho-point)
+    I = np.around(X).astype("int")
+    J = np.around(Y).astype("int")
+    start = np.ravel_multi_index((J, I), (jmax, imax)) * kmax
+
+    # Vectorized binary search for the number of levels below -Z
+    lo = np.zeros(start.shape, dtype=int)
+    hi = np.full(start.shape, kmax)
+    for _ in range(int(kmax).bit_length()):
+        mid = (lo + hi) >> 1
+        active = lo < hi
+        below = z_flat[start + np.minimum(mid, kmax - 1)] < -Z
+        lo = np.where(active & below, mid + 1, lo)
+        hi = np.where(active & ~below, mid, hi)
+    K = lo.clip(1, kmax - 1)
+
+    z_upper = z_flat[start + K]
+    z_lower = z_flat[start + K - 1]
+    A = (z_upper + Z) / (z_upper - z_lower)
+    A = A.clip(0, 1)  # Extend constantly
+
+    return K, A
+
+
 def sample3D(F, X, Y, K, A, method="bilinear"):
     """
     Sample a 3D field on the (sub)grid
@@ -866,6 +2084,84 @@ def sample3D(F, X, Y, K, A, method="bilinear"):
     return F[K, J, I]
 
 
+def sample3D_fused(F, X, Y, K, A, work=None):
+    """
+    Trilinear interpolation of a 3D field, without temporary arrays
+
+    Gives the same result as sample3D(F, X, Y, K, A, method="bilinear").
+    The flat index of the grid cell corner is computed once, and the
+    eight corner values are gathered from the raveled field. Scratch
+    arrays are kept in the dictionary *work*, and reused in later calls.
+    The returned array is always a new array. As in sample3D, corner
+    indices outside the field raise IndexError.
+    """
+
+    if work is None:
+        work = dict()
+
+    kmax, jmax, imax = F.shape
+    n = len(X)
+
+    def buf(name, dtype):
+        b = work.get(name)
+        if b is None or b.size < n or b.dtype != dtype:
+            b = work[name] = np.empty(n, dtype=dtype)
+        return b[:n]
+
+    # Find rho-point as lower left corner
+    I = np.clip(X.astype("int"), 0, imax - 2)
+    J = np.clip(Y.astype("int"), 0, jmax - 2)
+    wtype = np.result_type(X, Y, I, A)
+    rtype = np.result_type(wtype, F)
+    P = np.subtract(X, I, out=buf("P", wtype))
+    Q = np.subtract(Y, J, out=buf("Q", wtype))
+    P1 = np.subtract(1, P, out=buf("P1", wtype))
+    Q1 = np.subtract(1, Q, out=buf("Q1", wtype))
+    A1 = np.subtract(1, A, out=buf("A1", wtype))
+    PQ = dict(
+        PQ00=np.multiply(P1, Q1, out=buf("PQ00", wtype)),
+        PQ01=np.multiply(P1, Q, out=buf("PQ01", wtype)),
+        PQ10=np.multiply(P, Q1, out=buf("PQ10", wtype)),
+        PQ11=np.multiply(P, Q, out=buf("PQ11", wtype)),
+    )
+
+    # Flat index of corner (K, J, I)
+    index = np.multiply(K, jmax * imax, out=buf("index", np.intp))
+    index += np.multiply(J, imax, out=buf("corner", np.intp))
+    index += I
+
+    # Corners in the summation order of sample3D
+    plane = jmax * imax
+    corners = [
+        ("PQ00", A1, 0),
+        ("PQ01", A1, imax),
+        ("PQ10", A1, 1),
+        ("PQ11", A1, imax + 1),
+        ("PQ00", A, -plane),
+        ("PQ01", A, imax - plane),
+        ("PQ10", A, 1 - plane),
+        ("PQ11", A, imax + 1 - plane),
+    ]
+
+    flat = F.ravel()
+    corner = buf("corner", np.intp)
+    value = buf("value", F.dtype)
+    weight = buf("weight", wtype)
+    term = buf("term", rtype)
+    result = None
+    for pq, a, offset in corners:
+        np.add(index, offset, out=corner)
+        np.take(flat, corner, out=value)
+        np.multiply(PQ[pq], a, out=weight)
+        if result is None:
+            result = np.multiply(weight, value, out=np.empty(n, dtype=rtype))
+        else:
+            np.multiply(weight, value, out=term)
+            result += term
+
+    return result
+
+
 def sample3DUV(U, V, X, Y, K, A, method="bilinear"):
     return (
         sample3D(U, X + 0.5, np.round(Y), K, A, method=method),
@@ -966,6 +2262,140 @@ def compute_w(pn, pm, u, v, z_w, z_r):
     return -wvel_pad[:]
 
 
+def compute_w_lean(pn, pm, u, v, z_w, z_r, work=None):
+    """Memory-lean version of :func:`compute_w` for a single time frame
+
+    The vertical velocity is computed level by level in single precision,
+    using work buffers which can be reused between frames by passing the same
+    *work* dict on each call. Shapes are as in :func:`compute_w`, but without
+    the leading time dimension. The result is a float32 array which agrees
+    with :func:`compute_w` to within about 1e-5 times the maximal absolute
+    vertical velocity.
+    """
+    N, jmax, imax = z_r.shape
+    if work is None:
+        work = dict()
+
+    def buf(name, shape):
+        if name not in work or work[name].shape != shape:
+            work[name] = np.empty(shape, dtype=np.float32)
+        return work[name]
+
+    # Metric coefficients
+    on_u = buf("on_u", (jmax, imax - 1))
+    om_v = buf("om_v", (jmax - 1, imax))
+    pm_u = buf("pm_u", (jmax, imax - 1))
+    pn_v = buf("pn_v", (jmax - 1, imax))
+    pmn = buf("pmn", (jmax - 2, imax - 2))
+    np.add(pn[:, :-1], pn[:, 1:], out=on_u)
+    np.divide(2, on_u, out=on_u)
+    np.add(pm[:-1, :], pm[1:, :], out=om_v)
+    np.divide(2, om_v, out=om_v)
+    np.add(pm[:, :-1], pm[:, 1:], out=pm_u)
+    np.add(pn[:-1, :], pn[1:, :], out=pn_v)
+    np.multiply(pm[1:-1, 1:-1], pn[1:-1, 1:-1], out=pmn)
+
+    # Level-wise work arrays
+    hz = buf("hz", (jmax, imax))
+    huon = buf("huon", (jmax, imax - 1))
+    hvom = buf("hvom", (jmax - 1, imax))
+    tmp = buf("tmp", (jmax - 2, imax - 2))
+    vert = buf("vert", (N, jmax - 2, imax - 2))
+
+    w = np.zeros((N + 1, jmax, imax), dtype=np.float32)
+    W = w[:, 1:-1, 1:-1]  # Interior points
+
+    for k in range(N):
+        # Horizontal flux
+        np.subtract(z_w[k + 1], z_w[k], out=hz)
+        np.add(hz[:, :-1], hz[:, 1:], out=huon)
+        huon *= 0.5
+        huon *= u[k]
+        huon *= on_u
+        np.add(hz[:-1, :], hz[1:, :], out=hvom)
+        hvom *= 0.5
+        hvom *= v[k]
+        hvom *= om_v
+
+        # Accumulated vertical flux
+        np.subtract(huon[1:-1, :-1], huon[1:-1, 1:], out=tmp)
+        tmp += hvom[:-1, 1:-1]
+        tmp -= hvom[1:, 1:-1]
+        np.add(W[k], tmp, out=W[k + 1])
+
+        # Contribution of horizontal movement to vertical flux
+        np.subtract(z_r[k][:, 1:], z_r[k][:, :-1], out=huon)
+        huon *= u[k]
+        huon *= pm_u
+        np.add(huon[1:-1, :-1], huon[1:-1, 1:], out=vert[k])
+        np.subtract(z_r[k][1:, :], z_r[k][:-1, :], out=hvom)
+        hvom *= v[k]
+        hvom *= pn_v
+        vert[k] += hvom[:-1, 1:-1]
+        vert[k] += hvom[1:, 1:-1]
+        vert[k] *= 0.25
+
+    # Remove contribution from moving ocean surface, and scale the flux
+    wtop = buf("wtop", (jmax - 2, imax - 2))
+    np.subtract(z_w[-1, 1:-1, 1:-1], z_w[0, 1:-1, 1:-1], out=wtop)
+    np.divide(W[-1], wtop, out=wtop)
+    for k in range(N + 1):
+        np.subtract(z_w[k, 1:-1, 1:-1], z_w[0, 1:-1, 1:-1], out=tmp)
+        tmp *= wtop
+        W[k] -= tmp
+        W[k] *= pmn
+
+    # Cubic interpolation to move vert from rho-points to w-points
+    cff1 = 3 / 8
+    cff2 = 3 / 4
+    cff3 = 1 / 8
+    cff4 = 9 / 16
+    cff5 = 1 / 16
+
+    # Bottom layers
+    slope = buf("slope", (jmax - 2, imax - 2))
+    np.subtract(z_r[0, 1:-1, 1:-1], z_w[0, 1:-1, 1:-1], out=slope)
+    np.subtract(z_r[1, 1:-1, 1:-1], z_r[0, 1:-1, 1:-1], out=tmp)
+    slope /= tmp
+    np.subtract(vert[1], vert[0], out=tmp)
+    tmp *= slope
+    np.subtract(vert[0], tmp, out=tmp)
+    tmp *= cff1
+    W[0] += tmp
+    W[0] += cff2 * vert[0]
+    W[0] -= cff3 * vert[1]
+    W[1] += cff1 * vert[0]
+    W[1] += cff2 * vert[1]
+    W[1] -= cff3 * vert[2]
+
+    # Middle layers
+    for k in range(2, N - 1):
+        np.add(vert[k - 1], vert[k], out=tmp)
+        tmp *= cff4
+        W[k] += tmp
+        np.add(vert[k - 2], vert[k + 1], out=tmp)
+        tmp *= cff5
+        W[k] -= tmp
+
+    # Top layers
+    np.subtract(z_w[-1, 1:-1, 1:-1], z_r[-1, 1:-1, 1:-1], out=slope)
+    np.subtract(z_r[-1, 1:-1, 1:-1], z_r[-2, 1:-1, 1:-1], out=tmp)
+    slope /= tmp
+    np.subtract(vert[-1], vert[-2], out=tmp)
+    tmp *= slope
+    tmp += vert[-1]
+    tmp *= cff1
+    W[-1] += tmp
+    W[-1] += cff2 * vert[-1]
+    W[-1] -= cff3 * vert[-2]
+    W[-2] += cff1 * vert[-1]
+    W[-2] += cff2 * vert[-2]
+    W[-2] -= cff3 * vert[-3]
+
+    np.negative(w, out=w)
+    return w
+
+
 def nearest_unmasked(mask, i, j):
     # All neighbours
     i_center = np.int32(np.round(i))
@@ -1,9 +1,11 @@
 import numpy as np
+from ..utils import state_chunks, make_rng, particle_ids, ParticleHistory, make_stage_timer
 
 
 class IBM:
     def __init__(self, config):
         ibmconf = config.get('ibm', dict())
+        self.config = ibmconf
 
         # Time before a particle is taken out of the simulation [seconds]
         self.lifespan = ibmconf.get('lifespan', None)
@@ -13,18 +15,30 @@ class IBM:
         self.vertdiff_dt = ibmconf.get('vertdiff_dt', self.dt)  # Vertical diffusion timestep [s]
         self.vertdiff_dz = ibmconf.get('vertdiff_dz', 0)  # Spacing of vertical diffusion sampling [m]
         self.vertdiff_max = ibmconf.get('vertdiff_max', np.inf)  # Maximal vertical diffusion [m2/s]
+        self.vertdiff_substeps = ibmconf.get('vertdiff_substeps', 'fixed')  # 'fixed' or 'adaptive'
         self.horzdiff_type = ibmconf.get('horzdiff_type', None)
         self.horzdiff_max = ibmconf.get('horzdiff_max', np.inf)
         self.horzdiff_min = ibmconf.get('horzdiff_min', 0)
         self.vertadv = ibmconf.get('vertical_advection', True)
-        self.x = np.array([])
-        self.y = np.array([])
-        self.pid = np.array([])
+        self.history = ParticleHistory(copy=False)  # Positions at end of previous step
         self.land_collision = ibmconf.get('land_collision', 'reposition')
+        self.chunk_size = ibmconf.get('chunk_size', None)  # Max particles per batch
+        self.workers = ibmconf.get('workers', 0)  # Number of worker processes
+        self.seed = ibmconf.get('seed', None)  # Seed for worker random numbers
+        self.rng = make_rng(ibmconf)  # Random numbers, 'legacy' or 'philox'
+        self.timer = make_stage_timer(ibmconf, 'chemicals')  # Enabled by 'profile'
+        self._pool = None
+        self._depth = None  # Depth under particles, for the current transport step
+        self._work = dict()
         self.grid = None
         self.state = None
         self.forcing = None
 
+        if self.vertdiff_substeps not in ('fixed', 'adaptive'):
+            raise ValueError(f'Unknown vertdiff_substeps: {self.vertdiff_substeps}')
+        if self.vertdiff_substeps == 'adaptive' and not self.vertdiff_dz > 0:
+            raise ValueError('Adaptive vertdiff_substeps requires vertdiff_dz > 0')
+
         # Issue warning if parameters for vertical diffusion indicates numerical instability
         if self.vertdiff_max < np.inf and self.vertdiff_dz > 0:
             instability = 6 * self.vertdiff_max * self.vertdiff_dt / (self.vertdiff_dz ** 2)
@@ -37,36 +51,92 @@ class IBM:
         self.grid = grid
         self.state = state
         self.forcing = forcing
+        self.rng.next_timestep()
+        timer = self.timer
+        num = len(state.X) if timer.enabled else 0
 
         if self.land_collision == "reposition":
-            self.reposition()
+            with timer.stage('reposition', num):
+                self.reposition()
         elif self.land_collision == "coastal_diffusion":
-            self.coastal_diffusion()
+            with timer.stage('coastal_diffusion', num):
+                self.coastal_diffusion()
+
+        if self.workers > 1:
+            with timer.stage('transport_parallel', num):
+                self.transport_parallel()
+        else:
+            self.transport()
+
+        if self.land_collision == "reposition":
+            with timer.stage('store_position', num):
+                self.store_position()
+
+        if self.lifespan is not None:
+            with timer.stage('kill_old', num):
+                self.kill_old()
+
+    def transport(self):
+        # Advection and vertical diffusion do not move the particles
+        # horizontally, so the depth under each particle is sampled once
+        self._depth = None
+        timer = self.timer
+        num = len(self.state.Z) if timer.enabled else 0
 
         if self.vertadv:
-            self.advect()
+            with timer.stage('advect', num):
+                self.advect()
 
-        if isinstance(self.D, str):
-            self.diffuse_labolle()
+        if isinstance(self.D, str) and self.vertdiff_substeps == 'adaptive':
+            with timer.stage('diffuse_labolle_adaptive', num):
+                self.diffuse_labolle_adaptive()
+        elif isinstance(self.D, str):
+            with timer.stage('diffuse_labolle', num):
+                self.diffuse_labolle()
         elif self.D:
-            self.diffuse_const()
+            with timer.stage('diffuse_const', num):
+                self.diffuse_const()
+
+        self._depth = None
 
         if self.horzdiff_type == 'smagorinsky':
-            self.horzdiff()
+            with timer.stage('horzdiff', num):
+                self.horzdiff()
 
-        if self.land_collision == "reposition":
-            self.store_position()
+    def transport_parallel(self):
+        if self._pool is None:
+            from .parallel import WorkerPool
+            config = dict(dt=self.dt, ibm=self.config)
+            self._pool = WorkerPool(config, self.workers, self.seed)
 
-        if self.lifespan is not None:
-            self.kill_old()
+        forcing = self.forcing.forcing
+        grid = getattr(self.grid, 'grid', self.grid)
+        ibm_forcing = [self.D] if isinstance(self.D, str) else []
+        self._pool.transport(ibm_forcing, grid, self.state, forcing, self.rng)
+
+    def chunks(self):
+        return state_chunks(self.state, self.chunk_size, len(self.state.Z))
+
+    def depth_chunks(self):
+        """Chunks of the state, with the depth and twice the depth under each particle"""
+        if self._depth is None:
+            H = self.grid.sample_depth(self.state.X, self.state.Y)
+            self._depth = (H, 2 * H)
+
+        start = 0
+        for state in self.chunks():
+            stop = start + len(state.Z)
+            yield state, tuple(d[start:stop] for d in self._depth)
+            start = stop
 
     def advect(self):
         # Vertical advection
-        x = self.state.X
-        y = self.state.Y
-        z = self.state.Z
-        self.state['Z'] += self.dt * self.forcing.forcing.wvel(x, y, z)
-        self.reflect()
+        for state, depth in self.depth_chunks():
+            x = state.X
+            y = state.Y
+            z = state.Z
+            state['Z'] += self.dt * self.forcing.forcing.wvel(x, y, z)
+            self.reflect(state, depth)
 
     def kill_old(self):
         state = self.state
@@ -75,43 +145,50 @@ class IBM:
 
     def horzdiff(self):
         # Itô backwards scheme (LaBolle et al. 2000) for horizontal diffusion
-        x = self.state.X
-        y = self.state.Y
-        z = self.state.Z
         dt = self.dt
-        dx, dy = self.grid.sample_metric(x, y)
 
         def compute_diff(xx, yy, zz):
             K = self.forcing.forcing.horzdiff(xx, yy, zz)
             K = np.maximum(self.horzdiff_min, np.minimum(self.horzdiff_max, K))
             return np.sqrt(2 * K)
 
-        # X direction. Uniform stochastic differential. Predictor-corrector.
-        dWx = (np.random.rand(len(z)) * 2 - 1) * np.sqrt(3 * dt) / dx
-        diff1x = compute_diff(x, y, z)
-        x1 = x + diff1x * dWx
-        diff2x = compute_diff(x1, y, z)
-        x2 = x + diff2x * dWx
-
-        # Y direction. Uniform stochastic differential. Predictor-corrector.
-        dWy = (np.random.rand(len(z)) * 2 - 1) * np.sqrt(3 * dt) / dy
-        diff1y = compute_diff(x2, y, z)
-        y1 = y + diff1y * dWy
-        diff2y = compute_diff(x2, y1, z)
-        y2 = y + diff2y * dWy
-
-        # Kill particles trying to move out of grid
-        in_grid = self.grid.ingrid(x2, y2)
-        self.state['X'][in_grid] = x2[in_grid]
-        self.state['Y'][in_grid] = y2[in_grid]
-        self.state.alive[~in_grid] = False
+        # Draw all random numbers in advance, to get the same sequence
+        # regardless of chunk size
+        pid = particle_ids(self.state)
+        rand_x = self.rng.uniform(pid, 'horzdiff_x')
+        rand_y = self.rng.uniform(pid, 'horzdiff_y')
+
+        start = 0
+        for state in self.chunks():
+            x = state.X
+            y = state.Y
+            z = state.Z
+            dx, dy = self.grid.sample_metric(x, y)
+            stop = start + len(z)
+
+            # X direction. Uniform stochastic differential. Predictor-corrector.
+            dWx = (rand_x[start:stop] * 2 - 1) * np.sqrt(3 * dt) / dx
+            diff1x = compute_diff(x, y, z)
+            x1 = x + diff1x * dWx
+            diff2x = compute_diff(x1, y, z)
+            x2 = x + diff2x * dWx
+
+            # Y direction. Uniform stochastic differential. Predictor-corrector.
+            dWy = (rand_y[start:stop] * 2 - 1) * np.sqrt(3 * dt) / dy
+            diff1y = compute_diff(x2, y, z)
+            y1 = y + diff1y * dWy
+            diff2y = compute_diff(x2, y1, z)
+            y2 = y + diff2y * dWy
+
+            # Kill particles trying to move out of grid
+            in_grid = self.grid.ingrid(x2, y2)
+            state['X'][in_grid] = x2[in_grid]
+            state['Y'][in_grid] = y2[in_grid]
+            state.alive[~in_grid] = False
+            start = stop
 
     # Itô backwards scheme (LaBolle et al. 2000) for vertical diffusion
     def diffuse_labolle(self):
-        x = self.state.X
-        y = self.state.Y
-        H = self.grid.sample_depth(x, y)
-
         if self.vertdiff_dz:
             def z_coarse(zz):
                 dz = self.vertdiff_dz
@@ -125,65 +202,158 @@ class IBM:
             return np.minimum(kk, self.vertdiff_max)
 
         current_time = 0
+        substep = 0
         while current_time < self.dt:
             old_time = current_time
             current_time = np.minimum(self.dt, current_time + self.vertdiff_dt)
             ddt = current_time - old_time
-            z = self.state.Z
 
-            # Uniform stochastic differential
-            dW = (np.random.rand(len(z)) * 2 - 1) * np.sqrt(3 * ddt)
+            # Chunks are processed in order, drawing the same random sequence
+            # as a single batch
+            for state, depth in self.depth_chunks():
+                x = state.X
+                y = state.Y
+                z = state.Z
+
+                # Uniform stochastic differential
+                rand = self.rng.uniform(particle_ids(state), 'vertdiff', substep)
+                dW = (rand * 2 - 1) * np.sqrt(3 * ddt)
+
+                # Vertical diffusion, intermediate step
+                Z1 = z + np.sqrt(2 * sample_K(x, y, z)) * dW  # Diffusive step
+                reflect_inplace(Z1, *depth, surface_first=True, work=self._work)
 
-            # Vertical diffusion, intermediate step
-            Z1 = z + np.sqrt(2 * sample_K(x, y, z)) * dW  # Diffusive step
-            Z1[Z1 < 0] *= -1                    # Reflexive boundary at top
-            below_seabed = Z1 > H
-            Z1[below_seabed] = 2*H[below_seabed] - Z1[below_seabed]  # Reflexive bottom
+                # Diffusive step and reflective boundary conditions
+                state['Z'] += np.sqrt(2 * sample_K(x, y, Z1)) * dW  # Diffusive step
+                self.reflect(state, depth)
 
-            # Diffusive step and reflective boundary conditions
-            self.state['Z'] += np.sqrt(2 * sample_K(x, y, Z1)) * dW  # Diffusive step
-            self.reflect()
+            substep += 1
+
+    def diffuse_labolle_adaptive(self):
+        # Same scheme as diffuse_labolle, but the number of substeps is chosen
+        # per particle from the stability criterion 6 * K * ddt / dz**2 <= 1.
+        # K is the largest diffusivity within one sampling distance of the
+        # particle. The substep is never shorter than vertdiff_dt, and
+        # particles are grouped by substep count (rounded up to a power of 2).
+        dz = self.vertdiff_dz
+
+        def z_coarse(zz):
+            return np.maximum(0.25 * dz, ((zz - 0.5 * dz) // dz) * dz + dz)
+
+        def sample_K(xx, yy, zz):
+            kk = self.forcing.forcing.vertdiff(xx, yy, z_coarse(zz), self.D)
+            return np.minimum(kk, self.vertdiff_max)
+
+        max_substeps = int(np.ceil(self.dt / self.vertdiff_dt))
+
+        for state, (H, H2) in self.depth_chunks():
+            x = state.X
+            y = state.Y
+            z = state.Z
+            pid = particle_ids(state)
+
+            K = np.maximum.reduce([sample_K(x, y, z + d) for d in (-dz, 0, dz)])
+            num_substeps = substep_counts(K, self.dt, dz, max_substeps)
+
+            z_new = np.array(z, dtype=float)
+            for n in np.unique(num_substeps):
+                idx = np.flatnonzero(num_substeps == n)
+                xx, yy, zz, HH = x[idx], y[idx], z_new[idx], (H[idx], H2[idx])
+                ddt = self.dt / n
+                for substep in range(n):
+                    # Uniform stochastic differential
+                    rand = self.rng.uniform(pid[idx], 'vertdiff', substep)
+                    dW = (rand * 2 - 1) * np.sqrt(3 * ddt)
+
+                    # Intermediate step, then diffusive step
+                    Z1 = zz + np.sqrt(2 * sample_K(xx, yy, zz)) * dW
+                    reflect_inplace(Z1, *HH, surface_first=True, work=self._work)
+                    zz = zz + np.sqrt(2 * sample_K(xx, yy, Z1)) * dW
+                    reflect_inplace(zz, *HH, work=self._work)
+
+                z_new[idx] = zz
+
+            state['Z'] = z_new
 
     def diffuse_const(self):
-        # Uniform stochastic differential
-        dW = (np.random.rand(len(self.state.Z)) * 2 - 1) * np.sqrt(3 * self.dt)
-        self.state['Z'] += np.sqrt(2 * self.D) * dW
-        self.reflect()
-
-    def reflect(self):
-        x = self.state.X
-        y = self.state.Y
-        z = self.state.Z
-        H = self.grid.sample_depth(x, y)
-        below_seabed = z > H
-        z[z < 0] *= -1  # Reflexive boundary at top
-        z[below_seabed] = 2 * H[below_seabed] - z[below_seabed]  # Reflexive bottom
-        self.state['Z'] = z
+        for state, depth in self.depth_chunks():
+            # Uniform stochastic differential
+            rand = self.rng.uniform(particle_ids(state), 'vertdiff')
+            dW = (rand * 2 - 1) * np.sqrt(3 * self.dt)
+            state['Z'] += np.sqrt(2 * self.D) * dW
+            self.reflect(state, depth)
+
+    def reflect(self, state=None, depth=None):
+        if state is None:
+            state = self.state
+        if depth is None:
+            H = self.grid.sample_depth(state.X, state.Y)
+            depth = (H, 2 * H)
+        z = state.Z
+        reflect_inplace(z, *depth, work=self._work)
+        state['Z'] = z
 
     def reposition(self):
         # If particles have not moved: Assume they ended up on land.
         # If that is the case, reposition them within the cell.
-        pid, pidx_old, pidx_new = np.intersect1d(self.pid, self.state.pid, return_indices=True)
-        onland = ((self.x[pidx_old] == self.state.X[pidx_new]) &
-                  (self.y[pidx_old] == self.state.Y[pidx_new]))
-        num_onland = np.count_nonzero(onland)
-        pidx_new_onland = pidx_new[onland]
-        x_new = np.round(self.state.X[pidx_new_onland]) - 0.5 + np.random.rand(num_onland)
-        y_new = np.round(self.state.Y[pidx_new_onland]) - 0.5 + np.random.rand(num_onland)
-        self.state.X[pidx_new_onland] = x_new
-        self.state.Y[pidx_new_onland] = y_new
+        pid = self.state.pid
+        onland = self.history.unchanged(pid, X=self.state.X, Y=self.state.Y)
+        pid_onland = pid[onland]
+        x_new = np.round(self.state.X[onland]) - 0.5 + self.rng.uniform(pid_onland, 'reposition_x')
+        y_new = np.round(self.state.Y[onland]) - 0.5 + self.rng.uniform(pid_onland, 'reposition_y')
+        self.state.X[onland] = x_new
+        self.state.Y[onland] = y_new
 
     def store_position(self):
-        self.x = self.state.X
-        self.y = self.state.Y
-        self.pid = self.state.pid
+        self.history.store(self.state.pid, X=self.state.X, Y=self.state.Y)
 
     def coastal_diffusion(self):
         # If particles are close to coast, reposition them within the cell
         x, y, pid = self.state.X, self.state.Y, self.state.pid
         is_coastal = self.grid.grid.is_close_to_land(x, y)
-        num_coastal = np.count_nonzero(is_coastal)
-        x_new = np.round(x[is_coastal]) - 0.5 + np.random.rand(num_coastal)
-        y_new = np.round(y[is_coastal]) - 0.5 + np.random.rand(num_coastal)
+        x_new = np.round(x[is_coastal]) - 0.5 + self.rng.uniform(pid[is_coastal], 'reposition_x')
+        y_new = np.round(y[is_coastal]) - 0.5 + self.rng.uniform(pid[is_coastal], 'reposition_y')
         self.state['X'][is_coastal] = x_new
         self.state['Y'][is_coastal] = y_new
+
+
+def reflect_inplace(z, H, H2, surface_first=False, work=None):
+    """Reflect vertical positions at the surface and the seabed, in place
+
+    :param z: Vertical positions, overwritten by the result
+    :param H: Depth under each particle
+    :param H2: Twice the depth under each particle
+    :param surface_first: If True, the seabed test uses the positions after
+        reflection at the surface. Otherwise, it uses the original positions.
+    :param work: Dict of reusable work arrays
+    :return: The reflected positions
+    """
+    if work is None:
+        work = dict()
+    num = len(z)
+    if 'surface' not in work or len(work['surface']) < num:
+        work['surface'] = np.empty(num, dtype=bool)
+        work['seabed'] = np.empty(num, dtype=bool)
+    surface = work['surface'][:num]
+    seabed = work['seabed'][:num]
+
+    np.less(z, 0, out=surface)
+    if not surface_first:
+        np.greater(z, H, out=seabed)
+    np.negative(z, out=z, where=surface)  # Reflexive boundary at top
+    if surface_first:
+        np.greater(z, H, out=seabed)
+    np.subtract(H2, z, out=z, where=seabed)  # Reflexive bottom
+    return z
+
+
+def substep_counts(K, dt, dz, max_substeps):
+    """Number of stable diffusion substeps for diffusivity K
+
+    The count satisfies 6 * K * (dt / count) / dz**2 <= 1, rounded up to a
+    power of 2, and is between 1 and max_substeps.
+    """
+    num_stable = np.nan_to_num(6 * K * dt / dz ** 2, nan=1, posinf=max_substeps)
+    num_stable = np.clip(num_stable, 1, max_substeps)
+    num = 2 ** np.ceil(np.log2(num_stable)).astype(np.int64)
+    return np.minimum(num, max_substeps)
@@ -0,0 +1,549 @@
+"""
+Parallel execution of the chemicals IBM
+
+The particles are split into contiguous slices, one per worker process.
+Grid arrays, forcing fields and particle variables are published through
+shared memory, so the workers sample the same arrays as the main process
+without copying them. Forcing frames are published once, when the forcing
+starts using them. On other time steps, only the time step and frame steps
+are passed on, and the workers interpolate in time as the main process
+would. The workers keep their forcing object between time steps, and drop
+cached lookups, such as the shear field of the velocity, only when the
+frames they depend on are published again. Each worker runs the transport stages of the IBM
+(advection and diffusion) on its own slice, and writes the new positions
+directly into the shared particle arrays. The particle order, and hence
+the pid order, is therefore preserved. The shared particle arrays replace
+those of the state, and are only copied when the state replaces them, as
+when particles are added or removed.
+
+Random numbers are drawn from one stream per worker and time step, derived
+from `numpy.random.SeedSequence([seed, timestep, worker])`. Results are
+reproducible for a given seed and number of workers. With the counter-based
+generator (`ibm.rng = "philox"`), the workers draw the same numbers as the
+main process would, and results are independent of the number of workers.
+"""
+
+import logging
+import multiprocessing
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from ..utils import particle_ids, ParticleRandom
+
+
+# Particle variables modified by the transport stages
+PARTICLE_VARIABLES = ('X', 'Y', 'Z', 'alive')
+
+# Forcing fields of the horizontal velocity, as published to the workers
+VELOCITY_FRAMES = frozenset(['U', 'V', 'dU', 'dV', 'ring_U', 'ring_V'])
+
+
+class SharedArrays:
+    """
+    Numpy arrays in shared memory
+
+    The arrays are created by the main process using `put`, and attached
+    to by other processes using `attach` with the specification returned
+    by `spec`. Arrays are reallocated only if they grow or change type.
+    """
+
+    def __init__(self):
+        self._blocks = dict()   # name -> SharedMemory
+        self._arrays = dict()   # name -> ndarray (view into block)
+        self._retired = []      # Unlinked blocks with arrays still in use
+
+    def put(self, name, value):
+        value = np.asarray(value)
+        block = self._blocks.get(name)
+        array = self._arrays.get(name)
+        if (
+            block is None
+            or array.dtype != value.dtype
+            or array.shape[1:] != value.shape[1:]
+            or block.size < value.nbytes
+        ):
+            if block is not None:
+                self._unlink(name)
+            # Allow for growth of particle arrays
+            nbytes = max(1, value.nbytes + value.nbytes // 4)
+            block = shared_memory.SharedMemory(create=True, size=nbytes)
+            self._blocks[name] = block
+
+        array = np.ndarray(value.shape, dtype=value.dtype, buffer=block.buf)
+        array[...] = value
+        self._arrays[name] = array
+        return array
+
+    def __getitem__(self, name):
+        return self._arrays[name]
+
+    def get(self, name):
+        return self._arrays.get(name)
+
+    def spec(self):
+        return {
+            name: (self._blocks[name].name, array.shape, array.dtype.str)
+            for name, array in self._arrays.items()
+        }
+
+    def _unlink(self, name):
+        self._arrays.pop(name, None)
+        block = self._blocks.pop(name)
+        block.unlink()
+        self._retired.append(block)
+        self._close_retired()
+
+    def _close_retired(self):
+        # Blocks are closed when no arrays refer to them any more
+        for block in list(self._retired):
+            try:
+                block.close()
+            except BufferError:
+                continue
+            self._retired.remove(block)
+
+    def close(self):
+        for name in list(self._blocks):
+            self._unlink(name)
+
+
+class AttachedArrays:
+    """
+    Arrays attached to a SharedArrays object in another process
+
+    The same array object is returned as long as its specification is
+    unchanged, so that objects keyed on the arrays stay valid.
+    """
+
+    def __init__(self):
+        self._blocks = dict()   # shared memory name -> SharedMemory
+        self._arrays = dict()   # (shared memory name, shape, dtype) -> ndarray
+
+    def attach(self, spec):
+        arrays = dict()
+        for name, key in spec.items():
+            array = self._arrays.get(key)
+            if array is None:
+                shm_name, shape, dtype = key
+                block = self._blocks.get(shm_name)
+                if block is None:
+                    block = shared_memory.SharedMemory(name=shm_name)
+                    self._blocks[shm_name] = block
+                array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+                self._arrays[key] = array
+            arrays[name] = array
+
+        in_use = set(spec.values())
+        return arrays, in_use
+
+    def release(self, in_use):
+        """Forget arrays, and detach from blocks, that are not in use"""
+        for key in list(self._arrays):
+            if key not in in_use:
+                del self._arrays[key]
+        blocks_in_use = {shm_name for shm_name, _, _ in in_use}
+        for shm_name in list(self._blocks):
+            if shm_name not in blocks_in_use:
+                try:
+                    self._blocks[shm_name].close()
+                except BufferError:  # Still referenced, try again later
+                    continue
+                del self._blocks[shm_name]
+
+    def close(self):
+        self.release(set())
+
+
+class SharedState:
+    """Particle state backed by shared arrays, as seen by a worker"""
+
+    def __init__(self, data):
+        self.__dict__['_data'] = data
+
+    def __getitem__(self, item):
+        return self._data[item]
+
+    def __setitem__(self, item, value):
+        self._data[item][...] = value
+
+    def __getattr__(self, item):
+        try:
+            return self._data[item]
+        except KeyError:
+            raise AttributeError(f'Attribute not defined: {item}')
+
+    def __setattr__(self, item, value):
+        self[item] = value
+
+    def __len__(self):
+        return len(self._data['X'])
+
+
+class StepMemo(dict):
+    """
+    Memo that keeps the entries used since it was last pruned
+
+    Entries are keyed on the particle cells, so entries not used in a time
+    step are unlikely to be used again.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._used = set()
+
+    def get(self, key, default=None):
+        self._used.add(key)
+        return super().get(key, default)
+
+    def __setitem__(self, key, value):
+        self._used.add(key)
+        super().__setitem__(key, value)
+
+    def clear(self):
+        super().clear()
+        self._used.clear()
+
+    def prune(self):
+        for key in set(self) - self._used:
+            del self[key]
+        self._used.clear()
+
+
+class WorkerPool:
+    """
+    Worker processes running the transport stages of the chemicals IBM
+
+    :param config: The IBM configuration, passed on to the workers
+    :param workers: Number of worker processes
+    :param seed: Seed for the random number streams. If None, a seed is
+        drawn from the global numpy random generator.
+    """
+
+    def __init__(self, config, workers, seed=None):
+        if seed is None:
+            seed = int(np.random.randint(2**31))
+        self.seed = seed
+        self.workers = workers
+        self.timestep = 0
+
+        ibmconf = dict(config.get('ibm', dict()), workers=0, profile=False)
+        worker_config = dict(dt=config['dt'], ibm=ibmconf)
+
+        self._shared = dict(
+            grid=SharedArrays(),
+            forcing=SharedArrays(),
+            state=SharedArrays(),
+        )
+        self._grid_published = None
+        self._frames = dict()   # name -> forcing array last published
+        self._adopted = dict()  # (kind, name) -> forcing attributes or state holding the shared array
+        self._versions = dict()  # name -> number of times the array was copied
+
+        ctx = multiprocessing.get_context('spawn')
+        self._connections = []
+        self._processes = []
+        for i in range(workers):
+            conn, child_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=_worker_main,
+                args=(child_conn, worker_config, i),
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self._connections.append(conn)
+            self._processes.append(process)
+
+        # The IBM wrapper in ladim does not forward close(), so the workers
+        # and shared memory are released at garbage collection or exit.
+        self._finalizer = weakref.finalize(
+            self, _shutdown, self._connections, self._processes,
+            self._shared, self._adopted,
+        )
+
+    def close(self):
+        self._finalizer()
+
+    def transport(self, ibm_forcing, grid, state, forcing, rng=None):
+        """
+        Run the transport stages on all particles
+
+        :param ibm_forcing: Names of the forcing fields sampled by the IBM
+        :param grid: The chemicals Grid object
+        :param state: The particle state
+        :param forcing: The chemicals Forcing object
+        :param rng: The random number service of the IBM
+        """
+        grid_spec = self._publish_grid(grid)
+        forcing_spec, forcing_settings = self._publish_forcing(ibm_forcing, forcing)
+
+        num = len(state['X'])
+        state_spec = self._publish_state(state)
+
+        rng_state = None
+        if isinstance(rng, ParticleRandom):
+            rng_state = (rng.seed, rng.timestep)
+
+        bounds = np.linspace(0, num, self.workers + 1).astype(int)
+        for i, conn in enumerate(self._connections):
+            conn.send(dict(
+                grid=grid_spec,
+                forcing=forcing_spec,
+                settings=dict(
+                    forcing_settings,
+                    field_engine=forcing.field_engine,
+                    horzdiff_engine=forcing.horzdiff_engine,
+                ),
+                versions=dict(self._versions),
+                state=state_spec,
+                start=bounds[i],
+                stop=bounds[i + 1],
+                seed=(self.seed, self.timestep, i),
+                rng=rng_state,
+            ))
+
+        errors = [conn.recv() for conn in self._connections]
+        for error in errors:
+            if error is not None:
+                raise RuntimeError(f'Error in IBM worker process:\n{error}')
+
+        self.timestep += 1
+
+    def _publish_grid(self, grid):
+        if self._grid_published is not grid:
+            shared = self._shared['grid']
+            attrs = dict()
+            for k, v in grid.__dict__.items():
+                if isinstance(v, np.ndarray):
+                    shared.put(k, v)
+                else:
+                    attrs[k] = v
+            self._grid_spec = dict(cls=type(grid), attrs=attrs, arrays=shared.spec())
+            self._grid_published = grid
+        return self._grid_spec
+
+    def _publish_state(self, state):
+        """
+        Publish the particle variables, and return their spec
+
+        The particle arrays are handed over to the state, so that the workers
+        update the positions in place. The arrays are only copied when the
+        state replaces them, as when particles are added or removed.
+        """
+        for name in PARTICLE_VARIABLES:
+            self._adopt('state', state, name)
+
+        shared = self._shared['state']
+        try:
+            state['pid']
+        except (KeyError, AttributeError):
+            # Particle indices, which only change with the particle count
+            pid = shared.get('pid')
+            if pid is None or len(pid) != len(state['X']):
+                shared.put('pid', particle_ids(state))
+        else:
+            self._adopt('state', state, 'pid')
+        return shared.spec()
+
+    def _publish_forcing(self, ibm_forcing, forcing):
+        """
+        Publish the forcing fields, and return their spec and the time settings
+
+        The ring buffer keeps two frames, which are copied when a slot gets a
+        new frame. Other frames are copied when the forcing object replaces
+        them. The standard buffer interpolates in time by updating the
+        current fields in place. These fields are therefore handed over to
+        the forcing object, so that the updates are made in shared memory.
+        """
+        interpolate = forcing.interpolate_ibm_forcing_in_time
+        settings = dict(
+            ibm_forcing=list(ibm_forcing),
+            interpolate_velocity_in_time=forcing.interpolate_velocity_in_time,
+            interpolate_ibm_forcing_in_time=interpolate,
+            _time=forcing._time,
+            _window=forcing._window,
+        )
+
+        if forcing._ring is not None:
+            steps = list(forcing._ring_steps)
+            settings.update(_ring_steps=steps, _ring_new=forcing._ring_new)
+            names = ['U', 'V', 'W'] + (list(ibm_forcing) if interpolate else [])
+            for name in names:
+                self._publish_slots('ring_' + name, forcing._ring[name], steps)
+            if not interpolate:
+                for name in ibm_forcing:
+                    self._publish_frame(name, forcing[name])
+
+        else:
+            settings.update(_velocity_increments=forcing._velocity_increments)
+            for name in ['U', 'V', 'W']:
+                self._adopt('forcing', forcing.__dict__, name)
+            if forcing.interpolate_velocity_in_time and forcing.horzdiff_engine == 'field':
+                # The workers keep the shear field of the velocity, and add
+                # the shear of the increments
+                self._publish_frame('dU', forcing.dU)
+                self._publish_frame('dV', forcing.dV)
+            if interpolate == 'lazy':
+                settings.update(_field_steps=list(forcing._field_steps))
+                for name in ibm_forcing:
+                    self._publish_frame(name + 'old', forcing[name + 'old'])
+                    self._publish_frame(name + 'new', forcing[name + 'new'])
+            else:
+                for name in ibm_forcing:
+                    self._adopt('forcing', forcing.__dict__, name)
+
+        return self._shared['forcing'].spec(), settings
+
+    def _publish_frame(self, name, value):
+        """Copy a forcing array which is not modified in place, if it is new"""
+        if self._frames.get(name) is not value:
+            self._shared['forcing'].put(name, value)
+            self._frames[name] = value
+            self._versions[name] = self._versions.get(name, 0) + 1
+
+    def _publish_slots(self, name, slots, steps):
+        """Copy the ring buffer slots that contain a new frame"""
+        shared = self._shared['forcing']
+        last = self._frames.get(name)
+        if last is None or last[0] is not slots:
+            shared.put(name, slots)
+            self._versions[name] = self._versions.get(name, 0) + 1
+        else:
+            for i, step in enumerate(steps):
+                if step != last[1][i]:
+                    shared[name][i] = slots[i]
+                    self._versions[name] = self._versions.get(name, 0) + 1
+        self._frames[name] = (slots, steps)
+
+    def _adopt(self, kind, holder, name):
+        """Replace a forcing or state array with its shared copy, if it is new"""
+        shared = self._shared[kind]
+        value = holder[name]
+        if value is not shared.get(name):
+            holder[name] = shared.put(name, value)
+            self._adopted[kind, name] = holder
+            if kind == 'forcing':
+                self._versions[name] = self._versions.get(name, 0) + 1
+
+
+def _shutdown(connections, processes, shared, adopted):
+    # Give the forcing and state private copies of the arrays they update
+    for (kind, name), holder in adopted.items():
+        try:
+            value = holder[name]
+        except (KeyError, AttributeError):
+            continue
+        if value is shared[kind].get(name):
+            holder[name] = value.copy()
+    adopted.clear()
+
+    for conn in connections:
+        try:
+            conn.send(None)
+        except (OSError, ValueError):
+            pass
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+    for conn in connections:
+        conn.close()
+    for s in shared.values():
+        s.close()
+
+
+def _worker_main(conn, config, worker):
+    import traceback
+    from types import SimpleNamespace
+    from .ibm import IBM
+    from .gridforce import Forcing
+
+    ibm = IBM(config)
+    attached = AttachedArrays()
+    grid = grid_arrays = arrays = fields = ring = data = state = forcing = None
+    field_names = set()
+    versions = dict()
+
+    try:
+        while True:
+            task = conn.recv()
+            if task is None:
+                break
+
+            try:
+                grid_spec = task['grid']
+                arrays, in_use_grid = attached.attach(grid_spec['arrays'])
+                if grid is None or grid_arrays != grid_spec['arrays']:
+                    grid = grid_spec['cls'].__new__(grid_spec['cls'])
+                    grid.__dict__.update(grid_spec['attrs'], **arrays)
+                    grid_arrays = grid_spec['arrays']
+
+                fields, in_use_forcing = attached.attach(task['forcing'])
+                ring = {
+                    name[5:]: fields.pop(name)
+                    for name in list(fields) if name.startswith('ring_')
+                }
+
+                # The forcing object is kept between time steps. Its shear
+                # fields are kept until the velocity frames change, and its
+                # ibm forcing columns until the ibm forcing frames change.
+                changed = {
+                    name for name, version in task['versions'].items()
+                    if versions.get(name) != version
+                }
+                versions = task['versions']
+                if forcing is None or forcing._grid is not grid:
+                    forcing = Forcing.__new__(Forcing)
+                    forcing.__dict__.update(
+                        _grid=grid, _z2s_memo=dict(), _sample_work=dict(),
+                        _column_memo=StepMemo(), _shear_fields=dict(),
+                        _window_warned=None)
+                    field_names = set()
+                if changed & VELOCITY_FRAMES:
+                    forcing._shear_fields.clear()
+                if (changed - VELOCITY_FRAMES
+                        or task['settings']['interpolate_ibm_forcing_in_time'] is True):
+                    forcing._column_memo.clear()
+                for name in field_names - set(fields):
+                    del forcing.__dict__[name]
+                field_names = set(fields)
+                forcing.__dict__.update(
+                    _ring=ring or None, **task['settings'], **fields)
+                forcing._z2s_memo.clear()
+
+                data, in_use_state = attached.attach(task['state'])
+                index = slice(task['start'], task['stop'])
+                state = SharedState({k: v[index] for k, v in data.items()})
+                attached.release(in_use_grid | in_use_forcing | in_use_state)
+
+                seed = np.random.SeedSequence(task['seed'])
+                np.random.seed(seed.generate_state(4))
+                if task['rng'] is not None:
+                    ibm.rng.seed, ibm.rng.timestep = task['rng']
+
+                ibm.grid = grid
+                ibm.state = state
+                ibm.forcing = SimpleNamespace(forcing=forcing)
+                ibm.transport()
+
+                # Drop the references to the particle arrays
+                ibm.state = ibm.forcing = None
+                forcing._z2s_memo.clear()
+                forcing._column_memo.prune()
+                state = data = fields = ring = None
+                conn.send(None)
+
+            except Exception:
+                conn.send(traceback.format_exc())
+
+    except (EOFError, KeyboardInterrupt):
+        pass
+
+    finally:
+        # Drop all references to shared memory before detaching
+        grid = arrays = fields = ring = data = state = forcing = None
+        ibm.grid = ibm.state = ibm.forcing = None
+        attached.close()
+        logging.debug(f'IBM worker {worker} finished')
@@ -1,4 +1,5 @@
 import numpy as np
+import pytest
 from ladim_plugins.chemicals import gridforce, IBM
 
 
@@ -66,6 +67,41 @@ class Test_is_close_to_land:
         assert isclose.tolist() == [True, True, False, False]
 
 
+class Test_Grid_land_tables:
+    @staticmethod
+    def make_grid(M, i0=3, j0=2):
+        grid = gridforce.Grid.__new__(gridforce.Grid)
+        grid.M, grid.i0, grid.j0 = M, i0, j0
+        return grid
+
+    def test_is_close_to_land_matches_stencil_version(self):
+        rng = np.random.default_rng(0)
+        M = (rng.uniform(size=(20, 30)) > 0.3).astype('f8')
+        grid = self.make_grid(M)
+        X = rng.uniform(3, 3 + 29, 1000)
+        Y = rng.uniform(2, 2 + 19, 1000)
+
+        expected = gridforce.is_close_to_land(M, X - 3, Y - 2)
+        assert grid.is_close_to_land(X, Y).tolist() == expected.tolist()
+
+    def test_nearest_sea_matches_stencil_version(self):
+        rng = np.random.default_rng(0)
+        M = (rng.uniform(size=(20, 30)) > 0.3).astype('f8')
+        M[5:10, 5:10] = 0  # Land cells without sea neighbours
+        grid = self.make_grid(M)
+        X = rng.uniform(3, 3 + 29, 1000)
+        Y = rng.uniform(2, 2 + 19, 1000)
+
+        i, j = grid.nearest_sea(X, Y)
+        assert np.all(M[j, i] == 1)
+
+        i_near, j_near = gridforce.nearest_unmasked(1 - M, X - 3, Y - 2)
+        found = M[j_near, i_near] == 1
+        assert not np.all(found)
+        assert i[found].tolist() == i_near[found].tolist()
+        assert j[found].tolist() == j_near[found].tolist()
+
+
 class Test_compute_w:
     def test_requires_correct_shape(self):
         pn = np.ones((10, 15))
@@ -129,6 +165,489 @@ class Test_compute_w:
         assert np.all(w_internal > 0), 'Downward velocity should be positive'
 
 
+class Test_Grid_bundle:
+    def test_loads_same_arrays_from_bundle(self, tmp_path):
+        bundle = str(tmp_path / 'bundle')
+        with forcing_file() as fname:
+            conf = dict(gridforce=dict(grid_file=fname, grid_bundle=bundle))
+            grid = gridforce.Grid(conf)
+            grid_loaded = gridforce.Grid(conf)
+
+        assert (tmp_path / 'bundle' / 'manifest.json').exists()
+        assert isinstance(grid_loaded.z_w, np.memmap)
+        assert grid_loaded.I == grid.I
+        assert grid_loaded.N == grid.N
+        for name in ['H', 'M', 'dx', 'lon', 'z_r', 'z_w', 'z_w_cols', 'Mu']:
+            assert np.array_equal(getattr(grid_loaded, name), getattr(grid, name))
+
+        X, Y = np.array([4.2, 6.7]), np.array([3.1, 5.8])
+        assert np.array_equal(grid_loaded.lonlat(X, Y), grid.lonlat(X, Y))
+
+    def test_rebuilds_bundle_if_subgrid_changes(self, tmp_path):
+        bundle = str(tmp_path / 'bundle')
+        with forcing_file() as fname:
+            gridforce.Grid(dict(gridforce=dict(grid_file=fname, grid_bundle=bundle)))
+            conf = dict(gridforce=dict(
+                grid_file=fname, grid_bundle=bundle, subgrid=[2, 8, 2, 6]))
+            grid = gridforce.Grid(conf)
+            grid_loaded = gridforce.Grid(conf)
+
+        assert grid.H.shape == (4, 6)
+        assert not isinstance(grid.H, np.memmap)
+        assert isinstance(grid_loaded.H, np.memmap)
+        assert grid_loaded.H.shape == (4, 6)
+
+    def test_rebuilds_bundle_if_array_is_unreadable(self, tmp_path):
+        bundle = tmp_path / 'bundle'
+        with forcing_file() as fname:
+            conf = dict(gridforce=dict(grid_file=fname, grid_bundle=str(bundle)))
+            grid = gridforce.Grid(conf)
+            (bundle / 'z_w.npy').write_bytes(b'corrupt')
+            grid_rebuilt = gridforce.Grid(conf)
+            grid_loaded = gridforce.Grid(conf)
+
+        assert not isinstance(grid_rebuilt.z_w, np.memmap)
+        assert isinstance(grid_loaded.z_w, np.memmap)
+        assert np.array_equal(grid_loaded.z_w, grid.z_w)
+
+
+class Test_Grid_cache:
+    def test_reuses_and_invalidates_cache(self, tmp_path):
+        import shutil
+        from netCDF4 import Dataset
+
+        grid_file = tmp_path / 'grid.nc'
+        with forcing_file() as fname:
+            shutil.copyfile(fname, grid_file)
+        cache = tmp_path / 'cache'
+        conf = dict(gridforce=dict(grid_file=str(grid_file), grid_cache=str(cache)))
+
+        grid = gridforce.Grid(conf)
+        grid_cached = gridforce.Grid(conf)
+        entries = list(cache.iterdir())
+        assert len(entries) == 1
+        assert isinstance(grid_cached.z_r, np.memmap)
+        assert np.array_equal(grid_cached.z_r, grid.z_r)
+
+        # Changing the grid file replaces the cache entry
+        with Dataset(grid_file, 'a') as dset:
+            dset.variables['h'][:] = dset.variables['h'][:] + 1
+        grid_changed = gridforce.Grid(conf)
+        assert not isinstance(grid_changed.z_r, np.memmap)
+        assert np.allclose(grid_changed.H, grid.H + 1)
+        new_entries = list(cache.iterdir())
+        assert len(new_entries) == 1
+        assert new_entries != entries
+
+    def test_hashes_only_grid_variables(self, tmp_path):
+        import shutil
+        from netCDF4 import Dataset
+
+        grid_file = tmp_path / 'grid.nc'
+        with forcing_file() as fname:
+            shutil.copyfile(fname, grid_file)
+        sha1 = gridforce.grid_variables_sha1(str(grid_file))
+
+        with Dataset(grid_file, 'a') as dset:
+            dset.variables['u'][:] = dset.variables['u'][:] + 1
+        assert gridforce.grid_variables_sha1(str(grid_file)) == sha1
+
+        with Dataset(grid_file, 'a') as dset:
+            dset.variables['pm'][:] = dset.variables['pm'][:] * 2
+        assert gridforce.grid_variables_sha1(str(grid_file)) != sha1
+
+
+class Test_scan_file_times:
+    def test_same_times_with_index(self, tmp_path):
+        index = tmp_path / 'index.json'
+        with forcing_file() as fname:
+            files = [str(fname)]
+            frames, num = gridforce.Forcing.scan_file_times(files)
+            frames_new, num_new = gridforce.Forcing.scan_file_times(files, str(index))
+            frames_idx, num_idx = gridforce.Forcing.scan_file_times(files, str(index))
+
+        assert index.exists()
+        assert num == num_new == num_idx == {str(fname): 3}
+        assert frames.dtype == frames_idx.dtype
+        assert frames.tolist() == frames_new.tolist() == frames_idx.tolist()
+
+    def test_only_rescans_changed_files(self, tmp_path, monkeypatch):
+        import shutil
+        index = str(tmp_path / 'index.json')
+        files = [str(tmp_path / 'a.nc'), str(tmp_path / 'b.nc')]
+        with forcing_file() as fname:
+            shutil.copyfile(fname, files[0])
+        gridforce.Forcing.scan_file_times(files[:1], index)
+
+        scanned = []
+        read_file_times = gridforce.Forcing.read_file_times
+
+        def read_and_record(fname):
+            scanned.append(fname)
+            return read_file_times(fname)
+
+        monkeypatch.setattr(gridforce.Forcing, 'read_file_times', read_and_record)
+
+        # Second file has later times than the first
+        from netCDF4 import Dataset
+        shutil.copyfile(files[0], files[1])
+        with Dataset(files[1], 'a') as dset:
+            dset.variables['ocean_time'][:] += 86400
+        frames, num = gridforce.Forcing.scan_file_times(files, index)
+        assert scanned == files[1:]
+        assert len(frames) == 6
+
+        # Changed file is scanned again
+        with Dataset(files[1], 'a') as dset:
+            dset.variables['ocean_time'][:] += 86400
+        scanned.clear()
+        frames_changed, _ = gridforce.Forcing.scan_file_times(files, index)
+        assert scanned == files[1:]
+        assert frames_changed[3] - frames[3] == np.timedelta64(1, 'D')
+
+
+class Test_scan_file_times_workers:
+    @staticmethod
+    def make_files(tmp_path, offsets):
+        import shutil
+        from netCDF4 import Dataset
+        files = []
+        with forcing_file() as fname:
+            for i, offset in enumerate(offsets):
+                files.append(str(tmp_path / f'forcing_{i}.nc'))
+                shutil.copyfile(fname, files[-1])
+                with Dataset(files[-1], 'a') as dset:
+                    dset.variables['ocean_time'][:] += offset
+        return files
+
+    def test_same_times_as_serial_scan(self, tmp_path):
+        files = self.make_files(tmp_path, [0, 86400, 2 * 86400, 3 * 86400])
+        frames, num = gridforce.Forcing.scan_file_times(files)
+        frames_par, num_par = gridforce.Forcing.scan_file_times(files, scan_workers=2)
+        assert frames.tolist() == frames_par.tolist()
+        assert num == num_par
+
+    def test_detects_unsorted_frames(self, tmp_path):
+        files = self.make_files(tmp_path, [86400, 0])
+        with pytest.raises(SystemExit):
+            gridforce.Forcing.scan_file_times(files, scan_workers=2)
+
+
+class Test_Forcing_precision:
+    def test_keeps_forcing_fields_in_single_precision(self):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = make_forcing(fname, grid, precision='float32')
+            for t in range(8):
+                forcing.update(t)
+            forcing.close()
+
+        for name in ['U', 'V', 'W', 'Unew', 'Vnew', 'Wnew', 'dU', 'dV', 'dW', 'AKs']:
+            assert forcing[name].dtype == np.float32, name
+
+        X, Y, Z = np.array([4.2, 6.7]), np.array([3.1, 5.8]), np.array([1., 5.])
+        u, v = forcing.velocity(X, Y, Z, tstep=0.5)
+        assert np.all(np.isfinite(u)) and np.all(np.isfinite(v))
+
+    def test_small_trajectory_drift_compared_to_double_precision(self):
+        import ladim
+        import yaml
+        import xarray as xr
+        from ladim_plugins.tests import test_examples
+
+        out = dict()
+        for precision in ['float32', 'float64']:
+            conf = yaml.safe_load(test_examples.get_config('chemicals'))
+            conf['gridforce']['precision'] = precision
+            with test_examples.chdir_temp() as test_dir:
+                np.random.seed(0)
+                ladim.main(yaml.safe_dump(conf))
+                out[precision] = xr.load_dataset(test_dir / 'out.nc')
+
+        for name in ['X', 'Y', 'Z']:
+            diff = out['float32'][name].values - out['float64'][name].values
+            assert np.max(np.abs(diff)) < 1e-3
+
+
+class Test_Forcing_ring_buffer:
+    def test_same_sampled_values_as_standard_buffer(self):
+        X = np.array([4.2, 6.7, 10.5])
+        Y = np.array([3.1, 5.8, 7.5])
+        Z = np.array([1., 5., 30.])
+
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = make_forcing(fname, grid)
+            ring = make_forcing(fname, grid, forcing_buffer='ring')
+            for t in range(13):
+                forcing.update(t)
+                ring.update(t)
+                for tstep in [0, 0.5]:
+                    for a, b in zip(forcing.velocity(X, Y, Z, tstep),
+                                    ring.velocity(X, Y, Z, tstep)):
+                        assert np.allclose(a, b, rtol=1e-5, atol=1e-8)
+                assert np.allclose(forcing.wvel(X, Y, Z), ring.wvel(X, Y, Z))
+                assert np.allclose(forcing.horzdiff(X, Y, Z), ring.horzdiff(X, Y, Z))
+                assert np.array_equal(
+                    forcing.vertdiff(X, Y, Z, 'AKs'), ring.vertdiff(X, Y, Z, 'AKs'))
+                assert np.array_equal(
+                    forcing.field(X, Y, Z, 'AKs'), ring.field(X, Y, Z, 'AKs'))
+                assert np.allclose(forcing['U'], ring['U'], rtol=1e-5, atol=1e-8)
+            forcing.close()
+            ring.close()
+
+    def test_reuses_two_frame_slots(self):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = make_forcing(fname, grid, forcing_buffer='ring')
+            forcing.update(0)
+            slots = dict(forcing._ring)
+            for t in range(1, 13):
+                forcing.update(t)
+            forcing.close()
+
+        assert set(slots) == {'U', 'V', 'W', 'AKs'}
+        for name, value in slots.items():
+            assert forcing._ring[name] is value
+            assert value.shape[0] == 2
+        for name in ['U', 'Unew', 'dU', 'AKsnew', 'dAKs']:
+            assert not hasattr(forcing, name)
+        assert sorted(forcing._ring_steps) == [6, 12]
+
+    def test_rejects_unknown_buffer(self):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            with pytest.raises(ValueError):
+                make_forcing(fname, grid, forcing_buffer='triple')
+
+
+class Test_Forcing_time_interpolation:
+    X = np.array([4.2, 6.7, 10.5])
+    Y = np.array([3.1, 5.8, 7.5])
+    Z = np.array([1., 5., 30.])
+
+    def test_lazy_interpolation_of_ibm_forcing(self):
+        X, Y, Z = self.X, self.Y, self.Z
+        confs = dict(
+            held=dict(),
+            full=dict(interpolate_ibm_forcing_in_time=True),
+            lazy=dict(interpolate_ibm_forcing_in_time='lazy'),
+            ring=dict(interpolate_ibm_forcing_in_time='lazy', forcing_buffer='ring'),
+        )
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcings = {k: make_forcing(fname, grid, **v) for k, v in confs.items()}
+            frames = [forcings['held']._load_frame(n)['AKs'] for n in [0, 6, 12]]
+
+            for t in range(13):
+                values = dict()
+                for k, forcing in forcings.items():
+                    forcing.update(t)
+                    values[k] = (
+                        forcing.field(X, Y, Z, 'AKs'),
+                        forcing.vertdiff(X, Y, Z, 'AKs'),
+                        forcing.current_field('AKs'),
+                    )
+                for k in ['lazy', 'ring']:
+                    for a, b in zip(values['full'], values[k]):
+                        assert np.allclose(a, b, rtol=1e-5, atol=1e-12)
+
+                # Linear interpolation between the frames
+                i, w = divmod(t, 6)
+                expected = frames[i] if w == 0 else (
+                    (1 - w / 6) * frames[i] + w / 6 * frames[i + 1])
+                assert np.allclose(values['lazy'][2], expected, rtol=1e-5, atol=1e-12)
+
+            assert not np.allclose(values['held'][2], frames[1])
+            for forcing in forcings.values():
+                forcing.close()
+
+        assert not hasattr(forcings['lazy'], 'dAKs')
+
+    def test_velocity_without_time_interpolation(self):
+        X, Y, Z = self.X, self.Y, self.Z
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            for buffer in ['standard', 'ring']:
+                forcing = make_forcing(
+                    fname, grid, forcing_buffer=buffer,
+                    interpolate_velocity_in_time=False)
+                forcing.update(0)
+                u0, v0 = forcing.velocity(X, Y, Z)
+                for t in range(1, 4):
+                    forcing.update(t)
+                    u, v = forcing.velocity(X, Y, Z, tstep=0.5)
+                    assert np.array_equal(u, u0) and np.array_equal(v, v0)
+                forcing.close()
+
+    def test_rejects_unknown_mode(self):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            with pytest.raises(ValueError):
+                make_forcing(fname, grid, interpolate_ibm_forcing_in_time='cubic')
+
+
+class Test_Forcing_field_engine:
+    def test_same_values_as_standard_engine(self):
+        rng = np.random.default_rng(0)
+        X = rng.uniform(2, 12, 50)
+        Y = rng.uniform(2, 8, 50)
+        Z = rng.uniform(0, 40, 50)
+
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            for interpolate in [False, 'lazy']:
+                forcing = make_forcing(
+                    fname, grid, interpolate_ibm_forcing_in_time=interpolate)
+                columns = make_forcing(
+                    fname, grid, interpolate_ibm_forcing_in_time=interpolate,
+                    field_engine='columns')
+                for t in range(4):
+                    forcing.update(t)
+                    columns.update(t)
+                    assert np.array_equal(
+                        forcing.vertdiff(X, Y, Z, 'AKs'), columns.vertdiff(X, Y, Z, 'AKs'))
+                    assert np.array_equal(
+                        forcing.field(X, Y, Z, 'AKs'), columns.field(X, Y, Z, 'AKs'))
+                forcing.close()
+                columns.close()
+
+    def test_reuses_columns_within_time_step(self):
+        X = np.array([4.2, 4.3, 6.7, 10.5])
+        Y = np.array([3.1, 3.2, 5.8, 7.5])
+        Z = np.array([1., 5., 5., 30.])
+
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = make_forcing(fname, grid, field_engine='columns')
+            forcing.update(0)
+
+            forcing.vertdiff(X, Y, Z, 'AKs')
+            (columns, index), = [v[1:] for v in forcing._column_memo.values()]
+            assert columns.shape == (forcing.AKs.shape[0], 3)
+            assert index.tolist() == [0, 0, 1, 2]
+
+            forcing.vertdiff(X, Y, Z + 10, 'AKs')
+            (columns2, _), = [v[1:] for v in forcing._column_memo.values()]
+            assert columns2 is columns
+
+            forcing.update(1)
+            forcing.close()
+            assert len(forcing._column_memo) == 0
+
+
+class Test_compute_w_lean:
+    def test_matches_standard_version(self):
+        from ladim_plugins.benchmarks.compute_w import synthetic_frame
+        f = synthetic_frame(imax=15, jmax=10, N=8)
+        w = gridforce.compute_w(
+            f['pn'], f['pm'], f['u'][np.newaxis], f['v'][np.newaxis],
+            f['z_w'][np.newaxis], f['z_r'][np.newaxis])[0]
+        w_lean = gridforce.compute_w_lean(
+            f['pn'], f['pm'], f['u'], f['v'], f['z_w'], f['z_r'])
+        assert w_lean.dtype == np.float32
+        assert w_lean.shape == w.shape
+        assert np.max(np.abs(w_lean - w)) < 1e-5 * np.max(np.abs(w))
+
+    def test_can_reuse_work_buffers(self):
+        from ladim_plugins.benchmarks.compute_w import synthetic_frame
+        f = synthetic_frame(imax=15, jmax=10, N=8)
+        work = dict()
+        w1 = gridforce.compute_w_lean(
+            f['pn'], f['pm'], f['u'], f['v'], f['z_w'], f['z_r'], work)
+        w2 = gridforce.compute_w_lean(
+            f['pn'], f['pm'], 2 * f['u'], 2 * f['v'], f['z_w'], f['z_r'], work)
+        assert np.allclose(2 * w1, w2, atol=1e-6)
+
+    def test_can_be_selected_in_forcing(self):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = make_forcing(fname, grid)
+            lean = make_forcing(fname, grid, w_engine='lean')
+            forcing.update(0)
+            lean.update(0)
+            forcing.close()
+            lean.close()
+            assert lean.W.dtype == np.float32
+            assert np.max(np.abs(lean.W - forcing.W)) < 1e-5 * np.max(np.abs(forcing.W))
+
+    def test_lower_peak_memory_than_standard_version(self):
+        from ladim_plugins.benchmarks.compute_w import compute_w_memory
+        result = compute_w_memory(imax=40, jmax=30, N=10)
+        assert result['peak_bytes_lean'] < 0.5 * result['peak_bytes_standard']
+
+
+class Test_horzdiff_engine:
+    def test_field_engine_matches_standard_engine(self):
+        from ladim_plugins.benchmarks.horzdiff import horzdiff_speed
+        result = horzdiff_speed(imax=20, jmax=15, N=8, num_particles=500, steps=1)
+        assert result['max_rel_diff'] < 1e-6
+
+    def test_computes_shear_once_per_frame_in_ring_buffer(self):
+        X = np.array([4.2, 6.7, 10.5])
+        Y = np.array([3.1, 5.8, 7.5])
+        Z = np.array([1., 5., 30.])
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = make_forcing(fname, grid)
+            ring = make_forcing(
+                fname, grid, horzdiff_engine='field', forcing_buffer='ring')
+            computed = []
+
+            class RecordingDict(dict):
+                def __setitem__(self, key, value):
+                    computed.append(key)
+                    super().__setitem__(key, value)
+
+            ring._shear_fields = RecordingDict()
+            for t in range(13):
+                forcing.update(t)
+                ring.update(t)
+                assert np.allclose(
+                    forcing.horzdiff(X, Y, Z), ring.horzdiff(X, Y, Z), rtol=1e-5)
+            forcing.close()
+            ring.close()
+
+        assert len(computed) == 3  # Forcing steps 0, 6 and 12
+
+    @pytest.mark.parametrize("interpolate", [True, False])
+    def test_computes_shear_once_per_frame_in_standard_buffer(self, interpolate):
+        X = np.array([4.2, 6.7, 10.5])
+        Y = np.array([3.1, 5.8, 7.5])
+        Z = np.array([1., 5., 30.])
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = make_forcing(
+                fname, grid, interpolate_velocity_in_time=interpolate)
+            field = make_forcing(
+                fname, grid, horzdiff_engine='field',
+                interpolate_velocity_in_time=interpolate)
+            computed = []
+            subgrid_shear = field._subgrid_shear
+
+            def recording_shear(U, V):
+                computed.append(field._time)
+                return subgrid_shear(U, V)
+
+            field._subgrid_shear = recording_shear
+            for t in range(13):
+                forcing.update(t)
+                field.update(t)
+                assert np.allclose(
+                    forcing.horzdiff(X, Y, Z), field.horzdiff(X, Y, Z), rtol=1e-5)
+                field.horzdiff(X + 0.1, Y, Z)
+            forcing.close()
+            field.close()
+
+        # Shear of the frames at steps 0, 6 and 12. With time interpolation,
+        # the shear of the increment is computed at the second step after a
+        # frame, and the frame shear is recomputed at the first.
+        if interpolate:
+            assert computed == [0, 1, 2, 6, 7, 8, 12]
+        else:
+            assert computed == [0, 6, 12]
+
+
 class Test_xy2ll:
     def test_returns_boundary_value_when_outside_grid(self):
         from importlib.resources import files, as_file
@@ -154,6 +673,335 @@ class Test_xy2ll:
             grid.xy2ll(x, y)
 
 
+class Test_Forcing_prefetch:
+    def test_same_fields_as_without_prefetch(self, monkeypatch):
+        monkeypatch.setattr(gridforce, 'hdf5_threadsafe', lambda: True)
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = make_forcing(fname, grid, prefetch=0)
+            prefetched = make_forcing(fname, grid, prefetch=2)
+            try:
+                for t in range(13):
+                    forcing.update(t)
+                    prefetched.update(t)
+                    for name in ['U', 'V', 'W', 'AKs']:
+                        assert np.array_equal(forcing[name], prefetched[name])
+            finally:
+                forcing.close()
+                prefetched.close()
+
+    def test_can_close_before_all_frames_are_read(self, monkeypatch):
+        monkeypatch.setattr(gridforce, 'hdf5_threadsafe', lambda: True)
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = make_forcing(fname, grid, prefetch=1)
+            forcing.update(0)
+            forcing.close()
+            assert forcing._prefetcher is None
+
+    def test_rejects_prefetch_unless_hdf5_is_thread_safe(self, monkeypatch):
+        monkeypatch.setattr(gridforce, 'hdf5_threadsafe', lambda: False)
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            with pytest.raises(ValueError):
+                make_forcing(fname, grid, prefetch=1)
+
+    def test_reports_hdf5_thread_safety(self):
+        assert gridforce.hdf5_threadsafe() in (True, False)
+
+
+class Test_Forcing_w_cache:
+    def test_same_vertical_velocity_as_without_cache(self, tmp_path):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = make_forcing(fname, grid)
+            cached = make_forcing(fname, grid, w_cache=str(tmp_path))
+            for t in range(13):
+                forcing.update(t)
+                cached.update(t)
+                assert np.array_equal(forcing.W, cached.W)
+            forcing.close()
+            cached.close()
+
+    def test_reuses_cached_values(self, tmp_path):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = make_forcing(fname, grid, w_cache=str(tmp_path))
+            forcing.update(0)
+            forcing.close()
+            cache_files = sorted(tmp_path.glob('*.npy'))
+            assert len(cache_files) == 2
+
+            # Modify cached values to check that they are used
+            for cache_file in cache_files:
+                np.save(cache_file, np.zeros_like(np.load(cache_file)) + 1)
+            forcing = make_forcing(fname, grid, w_cache=str(tmp_path))
+            forcing.update(0)
+            forcing.close()
+            assert np.all(forcing.W == 1)
+
+    def test_ignores_cached_values_from_other_grid(self, tmp_path):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = make_forcing(fname, grid, w_cache=str(tmp_path))
+            forcing.update(0)
+            forcing.close()
+
+            grid.H = grid.H + 1
+            forcing = make_forcing(fname, grid, w_cache=str(tmp_path))
+            forcing.update(0)
+            forcing.close()
+            assert len(list(tmp_path.glob('*.npy'))) == 4
+
+
+class Test_Forcing_io_stats:
+    def test_counts_reads_and_bytes(self):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = make_forcing(fname, grid)
+            forcing.update(0)
+            forcing.close()
+
+        ops = forcing.io_stats.summary()['operations']
+        assert ops['scan_file_times']['misses'] == 1
+        assert ops['open_forcing_file']['misses'] == 1
+        assert ops['read_velocity']['calls'] == 2
+        assert ops['read_field']['calls'] == 2
+        assert ops['read_field']['shape'] == grid.z_w.shape
+        assert ops['read_field']['bytes'] == 2 * grid.z_w.size * 4
+        assert forcing.io_stats.totals()['seconds'] > 0
+
+    def test_counts_w_cache_hits(self, tmp_path):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            for _ in range(2):
+                forcing = make_forcing(fname, grid, w_cache=str(tmp_path))
+                forcing.update(0)
+                forcing.close()
+
+        ops = forcing.io_stats.summary()['operations']
+        assert ops['w_cache']['hits'] == 2
+        assert ops['w_cache']['misses'] == 0
+
+    def test_counts_only_read_window(self):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            grid.modules = Stub()
+            grid.modules.state = dict(X=np.array([4, 5]), Y=np.array([3, 4]))
+            forcing = make_forcing(fname, grid, read_window=2)
+            forcing.update(0)
+            forcing.close()
+
+        j0, j1, i0, i1 = forcing._window
+        shape = (grid.z_w.shape[0], j1 - j0, i1 - i0)
+        ops = forcing.io_stats.summary()['operations']
+        assert ops['read_field']['shape'] == shape
+        assert ops['read_field']['bytes'] == 2 * np.prod(shape) * 4
+        assert ops['read_field']['bytes'] < 2 * grid.z_w.size * 4
+
+
+class Test_Forcing_read_window:
+    def test_reads_only_fields_around_particles(self):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            grid.modules = Stub()
+            grid.modules.state = dict(X=np.array([4, 5]), Y=np.array([3, 4]))
+            full = make_forcing(fname, grid)
+            windowed = make_forcing(fname, grid, read_window=2)
+            full.update(0)
+            windowed.update(0)
+            full.close()
+            windowed.close()
+
+            j0, j1, i0, i1 = windowed._window
+            assert (j0, j1, i0, i1) == (0, 6, 1, 7)
+            J, I = slice(j0, j1), slice(i0, i1)
+            assert np.array_equal(windowed.AKs[:, J, I], full.AKs[:, J, I])
+            assert np.array_equal(windowed.U[:, J, i0:i1 + 1], full.U[:, J, i0:i1 + 1])
+            assert np.array_equal(windowed.V[:, j0:j1 + 1, I], full.V[:, j0:j1 + 1, I])
+            assert np.all(windowed.U[:, :, i1 + 1:] == 0)
+            assert np.all(windowed.V[:, j1 + 1:, :] == 0)
+
+            # Vertical velocity is also correct at the window boundary
+            assert windowed.W.dtype == full.W.dtype
+            assert np.allclose(windowed.W[:, J, I], full.W[:, J, I])
+            assert np.all(windowed.W[:, j1:, :] == 0)
+
+    def test_expands_window_when_particles_approach_edge(self):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            grid.modules = Stub()
+            grid.modules.state = dict(X=np.array([4]), Y=np.array([3]))
+            full = make_forcing(fname, grid)
+            windowed = make_forcing(fname, grid, read_window=2)
+            for t in range(4):
+                full.update(t)
+                windowed.update(t)
+            old_window = windowed._window
+
+            grid.modules.state = dict(X=np.array([4, 10]), Y=np.array([3, 6]))
+            for t in range(4, 9):
+                full.update(t)
+                windowed.update(t)
+            full.close()
+            windowed.close()
+
+            j0, j1, i0, i1 = windowed._window
+            assert old_window == [0, 5, 1, 6]
+            assert (j0, j1, i0, i1) == (0, 8, 1, 12)
+            J, I = slice(j0 + 1, j1 - 1), slice(i0 + 1, i1 - 1)
+            for name in ['U', 'V', 'W', 'AKs']:
+                assert np.allclose(windowed[name][:, J, I], full[name][:, J, I])
+
+    def test_pads_window_by_step_displacement(self):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            grid.modules = Stub()
+            grid.modules.state = dict(X=np.array([8]), Y=np.array([5]))
+            windowed = make_forcing(fname, grid, read_window=2)
+            windowed.update(0)
+            old_window = windowed._window
+            windowed.dt *= 10
+            windowed.update(1)
+            windowed.close()
+
+            pad = windowed._step_displacement() + 1
+            assert pad > 3
+            extent = windowed._particle_extent()
+            assert windowed._window != old_window
+            assert windowed._window == [
+                max(0, extent[0] - pad), min(grid.jmax, extent[1] + pad),
+                max(0, extent[2] - pad), min(grid.imax, extent[3] + pad),
+            ]
+
+    def test_warns_when_sampling_outside_window(self, caplog):
+        import logging
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            grid.modules = Stub()
+            grid.modules.state = dict(X=np.array([4]), Y=np.array([3]))
+            windowed = make_forcing(fname, grid, read_window=2)
+            windowed.update(0)
+            windowed.close()
+
+            with caplog.at_level(logging.WARNING):
+                windowed.velocity(np.array([4.]), np.array([3.]), np.array([1.]))
+                assert 'outside the forcing read window' not in caplog.text
+                windowed.velocity(np.array([12.]), np.array([3.]), np.array([1.]))
+                assert 'outside the forcing read window' in caplog.text
+
+
+class Test_z2s_columns:
+    def test_matches_z2s(self):
+        H = np.linspace(10, 200, 6 * 5).reshape((6, 5))
+        Cs_w = gridforce.s_stretch(12, 6, 0, stagger="w")
+        z_w = gridforce.sdepth(H, 10, Cs_w, stagger="w")
+        z_cols = gridforce.z_columns(z_w)
+
+        rng = np.random.default_rng(0)
+        X = rng.uniform(0, 4, 1000)
+        Y = rng.uniform(0, 5, 1000)
+        Z = rng.uniform(-10, 250, 1000)
+        Z[:3] = [0, 10, np.nan]
+        Z[3:5] = -z_w[[0, 5], np.around(Y[3:5]).astype(int),
+                      np.around(X[3:5]).astype(int)]
+
+        K, A = gridforce.z2s(z_w, X, Y, Z)
+        K_cols, A_cols = gridforce.z2s_columns(z_cols, X, Y, Z)
+        assert np.array_equal(K, K_cols)
+        assert np.array_equal(A, A_cols, equal_nan=True)
+
+    def test_raises_outside_grid(self):
+        z_cols = gridforce.z_columns(np.zeros((3, 6, 5)))
+        X, Y, Z = np.array([1.0, 5.0]), np.array([1.0, 1.0]), np.ones(2)
+
+        with pytest.raises(ValueError):
+            gridforce.z2s_columns(z_cols, X, Y, Z)
+
+
+class Test_Forcing_z2s_memo:
+    def test_reuses_field_lookup_within_time_step(self):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = make_forcing(fname, grid)
+            forcing.update(0)
+            forcing.close()
+
+        X, Y, Z = np.array([4.2, 6.7]), np.array([3.1, 5.8]), np.array([1., 5.])
+        x, y = X - grid.i0, Y - grid.j0
+        K, A = forcing._field_z2s(X, Y, Z, x, y)
+        K2, A2 = forcing._field_z2s(X, Y, Z, x, y)
+        assert K2 is K and A2 is A
+
+        # Arrays updated in place are looked up again
+        Z += 20
+        K3, A3 = forcing._field_z2s(X, Y, Z, x, y)
+        K_ref, A_ref = gridforce.z2s(grid.z_r, x, y, Z)
+        assert np.array_equal(K3, K_ref) and np.array_equal(A3, A_ref)
+        assert not np.array_equal(K3, K)
+
+    def test_only_field_uses_memo(self):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = make_forcing(fname, grid)
+            forcing.update(0)
+            forcing.close()
+
+        X, Y, Z = np.array([4.2, 6.7]), np.array([3.1, 5.8]), np.array([1., 5.])
+        forcing.velocity(X, Y, Z)
+        forcing.wvel(X, Y, Z)
+        forcing.vertdiff(X, Y, Z, 'AKs')
+        forcing.horzdiff(X, Y, Z)
+        assert forcing._z2s_memo == dict()
+
+        forcing.field(X, Y, Z, 'AKs')
+        assert list(forcing._z2s_memo) == ['field']
+
+
+class Test_sample3D_fused:
+    def test_matches_sample3D(self):
+        rng = np.random.default_rng(0)
+        F = rng.normal(size=(5, 6, 7))
+        X = np.concatenate([rng.uniform(0, 6, 100), [-0.3, 0, 5.9, 6, 6.4]])
+        Y = np.concatenate([rng.uniform(0, 5, 100), [5.2, 0, -0.2, 5, 0.5]])
+        K = rng.integers(1, 5, len(X))
+        A = rng.uniform(0, 1, len(X))
+
+        expected = gridforce.sample3D(F, X, Y, K, A)
+        result = gridforce.sample3D_fused(F, X, Y, K, A)
+        assert np.array_equal(result, expected)
+
+        result32 = gridforce.sample3D_fused(F.astype('f4'), X, Y, K, A)
+        assert np.array_equal(
+            result32, gridforce.sample3D(F.astype('f4'), X, Y, K, A))
+
+    def test_reuses_scratch_arrays_but_not_output(self):
+        rng = np.random.default_rng(0)
+        F = rng.normal(size=(5, 6, 7))
+        X, Y = rng.uniform(0, 6, 10), rng.uniform(0, 5, 10)
+        K, A = rng.integers(1, 5, 10), rng.uniform(0, 1, 10)
+        work = dict()
+
+        first = gridforce.sample3D_fused(F, X, Y, K, A, work)
+        scratch = {k: v for k, v in work.items()}
+        first_copy = first.copy()
+        second = gridforce.sample3D_fused(F, X[:4], Y[:4], K[:4], A[:4], work)
+
+        assert all(work[k] is v for k, v in scratch.items())
+        assert np.array_equal(first, first_copy)
+        assert np.array_equal(second, first[:4])
+
+    def test_raises_on_out_of_range_corner(self):
+        F = np.zeros((5, 6, 7))
+        X, Y = np.array([1.0, 2.0]), np.array([1.0, 2.0])
+        K, A = np.array([1, 5]), np.array([0.5, 0.5])
+
+        with pytest.raises(IndexError):
+            gridforce.sample3D(F, X, Y, K, A)
+        with pytest.raises(IndexError):
+            gridforce.sample3D_fused(F, X, Y, K, A)
+
+
 class Test_vertdiff:
     def test_stable_distribution_when_discontinuous_vertdiff(self):
         np.random.seed(0)
@@ -175,19 +1023,7 @@ class Test_vertdiff:
             )
         )
 
-        state = Stub()
-
-        forcing = Stub()
-        forcing.forcing = Stub()
-        forcing.forcing.wvel = lambda x, y, z: x*0
-        forcing.forcing.vertdiff = lambda x, y, z, n: vertdiff(z)
-
-        grid = Stub()
-        grid.sample_depth = lambda x, y: x*0 + depth
-
-        state.X = np.ones(num_particles)
-        state.Y = np.ones(num_particles)
-        state.Z = np.arange(num_particles) * depth / num_particles
+        grid, state, forcing = column_stubs(vertdiff, depth, num_particles)
 
         bins = np.linspace(0, 1, 11) * depth
         pre_distribution = np.histogram(state.Z, bins=bins)[0]
@@ -219,19 +1055,7 @@ class Test_vertdiff:
             )
         )
 
-        state = Stub()
-
-        forcing = Stub()
-        forcing.forcing = Stub()
-        forcing.forcing.wvel = lambda x, y, z: x*0
-        forcing.forcing.vertdiff = lambda x, y, z, n: vertdiff(z)
-
-        grid = Stub()
-        grid.sample_depth = lambda x, y: x*0 + depth
-
-        state.X = np.ones(num_particles)
-        state.Y = np.ones(num_particles)
-        state.Z = np.arange(num_particles) * depth / num_particles
+        grid, state, forcing = column_stubs(vertdiff, depth, num_particles)
 
         bins = np.linspace(0, 1, 11) * depth
         pre_distribution = np.histogram(state.Z, bins=bins)[0]
@@ -264,19 +1088,7 @@ class Test_vertdiff:
             )
         )
 
-        state = Stub()
-
-        forcing = Stub()
-        forcing.forcing = Stub()
-        forcing.forcing.wvel = lambda x, y, z: x*0
-        forcing.forcing.vertdiff = lambda x, y, z, n: vertdiff(z)
-
-        grid = Stub()
-        grid.sample_depth = lambda x, y: x*0 + depth
-
-        state.X = np.ones(num_particles)
-        state.Y = np.ones(num_particles)
-        state.Z = np.arange(num_particles) * depth / num_particles
+        grid, state, forcing = column_stubs(vertdiff, depth, num_particles)
 
         bins = np.linspace(0, 1, 11) * depth
         pre_distribution = np.histogram(state.Z, bins=bins)[0]
@@ -289,6 +1101,119 @@ class Test_vertdiff:
         assert deviation < 0.1
 
 
+class Test_adaptive_substeps:
+    def test_substep_counts(self):
+        from ladim_plugins.chemicals.ibm import substep_counts
+        K = np.array([0, 1e-4, 0.01, 0.02, 1, np.inf, np.nan])
+        counts = substep_counts(K, dt=100, dz=1, max_substeps=64)
+        assert counts.tolist() == [1, 1, 8, 16, 64, 64, 1]
+        assert np.all(6 * K[:4] * (100 / counts[:4]) <= 1)
+
+    def test_stable_distribution_with_fewer_samples(self):
+        depth = 10
+        AKs = 0.01
+        vertdiff = lambda z: AKs/100 + AKs*99/100 * ((depth/2 < z) & (z < depth/2 + 1))
+
+        def run(substeps):
+            np.random.seed(0)
+            num_particles = 10000
+            ibm = IBM(dict(dt=100, ibm=dict(
+                land_collision='freeze',
+                vertical_mixing='AKs',
+                vertdiff_dt=1,
+                vertdiff_dz=0.5,
+                vertdiff_substeps=substeps,
+            )))
+            num_sampled = []
+
+            def sample_vertdiff(x, y, z, n):
+                num_sampled.append(len(z))
+                return vertdiff(z)
+
+            grid, state, forcing = column_stubs(vertdiff, depth, num_particles)
+            forcing.forcing.vertdiff = sample_vertdiff
+
+            bins = np.linspace(0, 1, 11) * depth
+            pre_distribution = np.histogram(state.Z, bins=bins)[0]
+            ibm.update_ibm(grid, state, forcing)
+            post_distribution = np.histogram(state.Z, bins=bins)[0]
+            deviation = np.linalg.norm(np.divide(post_distribution, pre_distribution) - 1)
+            return deviation, sum(num_sampled)
+
+        deviation, num_samples = run('adaptive')
+        deviation_fixed, num_samples_fixed = run('fixed')
+        assert deviation < 0.1
+        assert num_samples < 0.2 * num_samples_fixed
+
+    def test_requires_vertdiff_dz(self):
+        with pytest.raises(ValueError):
+            IBM(dict(dt=100, ibm=dict(vertdiff_substeps='adaptive')))
+
+    def test_equals_fixed_with_single_substep(self):
+        depth = 10
+
+        def run(substeps):
+            np.random.seed(0)
+            ibm = IBM(dict(dt=100, ibm=dict(
+                land_collision='freeze',
+                vertical_mixing='AKs',
+                vertdiff_dt=100,
+                vertdiff_dz=0.5,
+                vertdiff_substeps=substeps,
+            )))
+            grid, state, forcing = column_stubs(
+                lambda z: 0.5 + 0.01 * z, depth, num_particles=1000)
+            ibm.update_ibm(grid, state, forcing)
+            return state.Z
+
+        z_adaptive = run('adaptive')
+        z_fixed = run('fixed')
+        assert np.any(z_fixed != np.arange(1000) * depth / 1000)
+        assert np.array_equal(z_adaptive, z_fixed)
+
+
+class Test_reflect:
+    def test_matches_masked_reflection(self):
+        from ladim_plugins.chemicals.ibm import reflect_inplace
+        z = np.array([-15, -3, 0, 4, 12, 25], dtype=float)
+        H = np.array([10, 10, 10, 10, 10, 20], dtype=float)
+
+        # Seabed test uses the original positions
+        z1 = reflect_inplace(z.copy(), H, 2 * H)
+        assert z1.tolist() == [15, 3, 0, 4, 8, 15]
+
+        # Seabed test uses the positions after surface reflection
+        z2 = reflect_inplace(z.copy(), H, 2 * H, surface_first=True)
+        assert z2.tolist() == [5, 3, 0, 4, 8, 15]
+
+
+class Test_reposition:
+    @staticmethod
+    def make_ibm():
+        ibm = IBM(dict(dt=100, ibm=dict(land_collision='reposition')))
+        state = Stub()
+        state.pid = np.array([0, 2, 5])
+        state.X = np.array([1., 2., 3.])
+        state.Y = np.array([4., 5., 6.])
+        ibm.state = state
+        ibm.store_position()
+        return ibm
+
+    def test_repositions_particles_that_have_not_moved(self):
+        ibm = self.make_ibm()
+        state = Stub()
+        state.pid = np.array([2, 5, 7])
+        state.X = np.array([2.1, 3., 4.])
+        state.Y = np.array([5., 6., 7.])
+        ibm.state = state
+        ibm.reposition()
+
+        assert state.X[[0, 2]].tolist() == [2.1, 4]
+        assert state.Y[[0, 2]].tolist() == [5, 7]
+        assert state.X[1] != 3 and 2.5 <= state.X[1] < 3.5
+        assert state.Y[1] != 6 and 5.5 <= state.Y[1] < 6.5
+
+
 class Test_update:
     def test_kills_old_particles(self):
         ibm_conf = {
@@ -305,6 +1230,316 @@ class Test_update:
         assert state['alive'].tolist() == [False, True, False]
 
 
+class Test_chunk_size:
+    @staticmethod
+    def run_ibm(chunk_size):
+        np.random.seed(0)
+        num_particles = 10
+
+        ibm = IBM(dict(dt=100, ibm=dict(
+            land_collision='freeze',
+            vertical_mixing='AKs',
+            vertdiff_dt=25,
+            horzdiff_type='smagorinsky',
+            chunk_size=chunk_size,
+        )))
+
+        grid, state, forcing = transport_stubs(num_particles)
+        for i in range(3):
+            ibm.update_ibm(grid, state, forcing)
+        return state
+
+    def test_same_result_as_single_batch(self):
+        state = self.run_ibm(chunk_size=None)
+        state_chunked = self.run_ibm(chunk_size=3)
+
+        assert not np.all(state.Z == np.linspace(0, 10, 10))
+        for name in ['X', 'Y', 'Z', 'alive']:
+            assert state[name].tolist() == state_chunked[name].tolist()
+
+
+class Test_profile:
+    def test_records_stages(self, tmp_path):
+        ibm = IBM(dict(dt=100, ibm=dict(
+            land_collision='freeze',
+            vertical_mixing='AKs',
+            vertdiff_dt=25,
+            horzdiff_type='smagorinsky',
+            chunk_size=3,
+            profile=str(tmp_path / 'profile.json'),
+        )))
+
+        grid, state, forcing = transport_stubs(num_particles=10)
+        for i in range(3):
+            ibm.update_ibm(grid, state, forcing)
+        summary = ibm.timer.summary()
+        ibm.timer.close()
+
+        assert list(summary) == ['advect', 'diffuse_labolle', 'horzdiff']
+        assert summary['horzdiff']['calls'] == 3
+        assert summary['horzdiff']['particles'] == 30
+        assert (tmp_path / 'profile.json').exists()
+
+
+class Test_workers:
+    @staticmethod
+    def run_ibm(workers, seed, **ibmconf):
+        with forcing_file() as fname:
+            grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+            forcing = Stub()
+            forcing.forcing = make_forcing(fname, grid)
+            forcing.forcing.update(0)
+            forcing.forcing.close()
+
+        ibm = IBM(dict(dt=600, ibm=dict(
+            land_collision='freeze',
+            vertical_mixing='AKs',
+            vertdiff_dt=60,
+            horzdiff_type='smagorinsky',
+            workers=workers,
+            seed=seed,
+            **ibmconf,
+        )))
+
+        state = Stub()
+        state.pid = np.arange(100, 120)
+        state.X = np.linspace(3, 10, 20)
+        state.Y = np.linspace(3, 7, 20)
+        state.Z = np.linspace(1, 10, 20)
+        state.alive = np.ones(20, dtype=bool)
+
+        try:
+            for i in range(2):
+                ibm.update_ibm(grid, state, forcing)
+        finally:
+            if ibm._pool is not None:
+                ibm._pool.close()
+        return state
+
+    def test_reproducible_results(self):
+        state1 = self.run_ibm(workers=2, seed=1)
+        state2 = self.run_ibm(workers=2, seed=1)
+
+        assert not np.all(state1.Z == np.linspace(1, 10, 20))
+        for name in ['X', 'Y', 'Z', 'alive']:
+            assert state1[name].tolist() == state2[name].tolist()
+
+    def test_philox_rng_is_independent_of_workers(self):
+        state0 = self.run_ibm(workers=0, seed=1, rng='philox')
+        state2 = self.run_ibm(workers=2, seed=1, rng='philox', chunk_size=3)
+
+        assert not np.all(state0.Z == np.linspace(1, 10, 20))
+        for name in ['X', 'Y', 'Z', 'alive']:
+            assert state0[name].tolist() == state2[name].tolist()
+
+    @pytest.mark.parametrize("conf", [
+        dict(),
+        dict(interpolate_ibm_forcing_in_time=True),
+        dict(interpolate_ibm_forcing_in_time='lazy'),
+        dict(forcing_buffer='ring'),
+        dict(forcing_buffer='ring', interpolate_ibm_forcing_in_time=True),
+        dict(horzdiff_engine='field'),
+    ])
+    def test_shared_frames_match_serial_run(self, conf):
+        def run(workers):
+            with forcing_file() as fname:
+                grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+                forcing = Stub()
+                forcing.forcing = make_forcing(fname, grid, **conf)
+                ibm = IBM(dict(dt=600, ibm=dict(
+                    vertical_mixing='AKs', horzdiff_type='smagorinsky',
+                    workers=workers, seed=1, rng='philox')))
+                state = Stub()
+                state.pid = np.arange(20)
+                state.X = np.linspace(3, 10, 20)
+                state.Y = np.linspace(3, 7, 20)
+                state.Z = np.linspace(1, 10, 20)
+                state.alive = np.ones(20, dtype=bool)
+                try:
+                    for t in range(8):  # Crosses the forcing frame at t = 6
+                        forcing.forcing.update(t)
+                        ibm.update_ibm(grid, state, forcing)
+                    fields = np.array(forcing.forcing['U']), np.array(forcing.forcing['W'])
+                finally:
+                    if ibm._pool is not None:
+                        ibm._pool.close()
+                    forcing.forcing.close()
+            return state, fields
+
+        state0, fields0 = run(workers=0)
+        state2, fields2 = run(workers=2)
+        for name in ['X', 'Y', 'Z', 'alive']:
+            assert state0[name].tolist() == state2[name].tolist()
+        for a, b in zip(fields0, fields2):
+            assert np.array_equal(a, b)
+
+    @pytest.mark.parametrize("conf", [
+        dict(interpolate_ibm_forcing_in_time=True),
+        dict(interpolate_ibm_forcing_in_time='lazy'),
+        dict(forcing_buffer='ring'),
+    ])
+    def test_publishes_each_frame_once(self, conf):
+        from ladim_plugins.chemicals.parallel import WorkerPool
+
+        pool = WorkerPool(dict(dt=600), workers=0, seed=1)
+        shared = pool._shared['forcing']
+        put = shared.put
+        copied = []
+        shared.put = lambda name, value: copied.append(name) or put(name, value)
+
+        try:
+            with forcing_file() as fname:
+                grid = gridforce.Grid(dict(gridforce=dict(grid_file=fname)))
+                forcing = make_forcing(fname, grid, **conf)
+                for t in range(12):  # Forcing frames at t = 0, 6 and 12
+                    forcing.update(t)
+                    del copied[:]
+                    versions = dict(pool._versions)
+                    pool._publish_forcing(['AKs'], forcing)
+                    if t == 0:
+                        assert copied
+                    elif t not in (1, 6, 7):
+                        assert copied == []
+                        assert pool._versions == versions
+                forcing.close()
+        finally:
+            pool.close()
+
+        # The forcing keeps private copies of its fields after the pool is closed
+        if forcing._ring is None:
+            assert forcing.W is not shared.get('W')
+            assert forcing.W.base is None
+
+    def test_copies_particles_only_when_replaced(self):
+        from ladim_plugins.chemicals.parallel import WorkerPool
+
+        pool = WorkerPool(dict(dt=600), workers=0, seed=1)
+        shared = pool._shared['state']
+        put = shared.put
+        copied = []
+        shared.put = lambda name, value: copied.append(name) or put(name, value)
+
+        state = Stub()
+        state.pid = np.arange(10)
+        state.X = np.linspace(3, 10, 10)
+        state.Y = np.linspace(3, 7, 10)
+        state.Z = np.linspace(1, 10, 10)
+        state.alive = np.ones(10, dtype=bool)
+        try:
+            pool._publish_state(state)
+            assert sorted(copied) == ['X', 'Y', 'Z', 'alive', 'pid']
+            assert state.X is shared['X']
+
+            del copied[:]
+            state.Z += 1  # Updated in place
+            pool._publish_state(state)
+            assert copied == []
+
+            state.X = np.concatenate([state.X, [5.0]])  # Added particle
+            pool._publish_state(state)
+            assert copied == ['X']
+        finally:
+            pool.close()
+
+        # The state keeps private copies of its variables after the pool is closed
+        assert state.X.base is None
+        assert state.X.tolist() == np.concatenate([np.linspace(3, 10, 10), [5]]).tolist()
+        assert state.Z.tolist() == (np.linspace(1, 10, 10) + 1).tolist()
+
+    def test_attached_arrays_are_kept_while_unchanged(self):
+        from ladim_plugins.chemicals.parallel import SharedArrays, AttachedArrays
+
+        shared = SharedArrays()
+        attached = AttachedArrays()
+        try:
+            shared.put('U', np.zeros((2, 3)))
+            U1, in_use = attached.attach(shared.spec())
+            shared.put('U', np.ones((2, 3)))  # Same block
+            U2, _ = attached.attach(shared.spec())
+            assert U2['U'] is U1['U']
+            assert U2['U'].tolist() == np.ones((2, 3)).tolist()
+
+            shared.put('U', np.ones((20, 3)))  # New block
+            U3, in_use = attached.attach(shared.spec())
+            assert U3['U'] is not U1['U']
+            U1 = U2 = None
+            attached.release(in_use)
+            assert list(attached._blocks) == [key[0] for key in in_use]
+        finally:
+            U1 = U2 = U3 = None
+            attached.close()
+            shared.close()
+
+    def test_step_memo_keeps_entries_used_since_last_prune(self):
+        from ladim_plugins.chemicals.parallel import StepMemo
+
+        memo = StepMemo()
+        memo['a'] = 1
+        memo['b'] = 2
+        memo.prune()
+        assert memo == dict(a=1, b=2)
+
+        assert memo.get('a') == 1
+        memo['c'] = 3
+        memo.prune()
+        assert memo == dict(a=1, c=3)
+
+
+def forcing_file():
+    from importlib.resources import files, as_file
+    traversible = files('ladim_plugins.chemicals').joinpath('forcing.nc')
+    return as_file(traversible)
+
+
+def make_forcing(fname, grid, **gridforce_conf):
+    config = dict(
+        gridforce=dict(input_file=str(fname), **gridforce_conf),
+        ibm_forcing=['AKs'],
+        start_time=np.datetime64('2015-09-07T01:00:00'),
+        stop_time=np.datetime64('2015-09-07T03:00:00'),
+        dt=600,
+    )
+    return gridforce.Forcing(config, grid)
+
+
+def column_stubs(vertdiff, depth, num_particles):
+    # Grid, state and forcing of a water column with vertical diffusion only
+    forcing = Stub()
+    forcing.forcing = Stub()
+    forcing.forcing.wvel = lambda x, y, z: x*0
+    forcing.forcing.vertdiff = lambda x, y, z, n: vertdiff(z)
+
+    grid = Stub()
+    grid.sample_depth = lambda x, y: x*0 + depth
+
+    state = Stub()
+    state.X = np.ones(num_particles)
+    state.Y = np.ones(num_particles)
+    state.Z = np.arange(num_particles) * depth / num_particles
+    return grid, state, forcing
+
+
+def transport_stubs(num_particles):
+    # Grid, state and forcing with advection and diffusion in all directions
+    forcing = Stub()
+    forcing.forcing = Stub()
+    forcing.forcing.wvel = lambda x, y, z: 0.001 * np.sin(z)
+    forcing.forcing.vertdiff = lambda x, y, z, n: 0.001 * (1 + np.cos(z))
+    forcing.forcing.horzdiff = lambda x, y, z: 0.1 * (1 + np.sin(x + y))
+
+    grid = Stub()
+    grid.sample_depth = lambda x, y: x * 0 + 10
+    grid.sample_metric = lambda x, y: (x * 0 + 100, x * 0 + 100)
+    grid.ingrid = lambda x, y: (x > 0) & (y > 0)
+
+    state = Stub()
+    state.X = np.linspace(1, 5, num_particles)
+    state.Y = np.linspace(2, 3, num_particles)
+    state.Z = np.linspace(0, 10, num_particles)
+    state.alive = np.ones(num_particles, dtype=bool)
+    return grid, state, forcing
+
+
 class Stub:
     def __getitem__(self, item):
         return getattr(self, item)
@@ -1,5 +1,6 @@
 import numpy as np
 import typing
+from ..utils import make_rng, particle_ids
 
 
 class IBM:
@@ -8,12 +9,14 @@ class IBM:
         self.vertical_diffusion = (self.D > 0)
         self.egg_diam = config['ibm']['egg_diam']
         self.dt = config['dt']
+        self.rng = make_rng(config['ibm'])
         self.model = dict(grid=None, state=None, forcing=None)  # type: typing.Any
 
     def update_ibm(self, grid, state, forcing):
         self.model['grid'] = grid
         self.model['state'] = state
         self.model['forcing'] = forcing
+        self.rng.next_timestep()
         self.update()
 
     def update(self):
@@ -46,7 +49,7 @@ class IBM:
 
         # Random diffusion velocity
         if self.vertical_diffusion:
-            rand = np.random.normal(size=len(W))
+            rand = self.rng.normal(particle_ids(state), 'vertdiff')
             W += rand * (2 * self.D / self.dt) ** 0.5
 
         # Update vertical position, using reflexive boundary condition at the top
@@ -1,5 +1,5 @@
 import numpy as np
-from ..utils import light, density, viscosity
+from ..utils import light, density, viscosity, make_rng, particle_ids
 
 
 class IBM:
@@ -70,8 +70,11 @@ class IBM:
         self.length = read_species_param('length')
 
         self.dt = config['dt']
+        self.rng = make_rng(config['ibm'])
 
     def update_ibm(self, grid, state, forcing):
+        self.rng.next_timestep()
+
         # --- Update forcing ---
         state['temp'] = forcing.field(state.X, state.Y, state.Z, 'temp')
         state['salt'] = forcing.field(state.X, state.Y, state.Z, 'salt')
@@ -104,7 +107,7 @@ class IBM:
 
         # --- Vertical turbulent mixing ---
         if self.D:
-            W += np.random.normal(size=len(W)) * np.sqrt(2 * self.D / self.dt)
+            W += self.rng.normal(particle_ids(state), 'vertdiff') * np.sqrt(2 * self.D / self.dt)
 
         # --- Execute vertical movement ---
         Z = state.Z + W * self.dt
@@ -1,4 +1,5 @@
 import numpy as np
+from ..utils import make_rng, particle_ids
 
 
 class IBM:
@@ -16,6 +17,7 @@ class IBM:
         self.vertical_limits = config['ibm']['vertical_limits']
 
         self.dt = config['dt']
+        self.rng = make_rng(config['ibm'])
         self.xs_dx = None
         self.ys_dy = None
         self.state = None
@@ -26,6 +28,7 @@ class IBM:
     def update_ibm(self, grid, state, _):
         self.state = state
         self.grid = grid
+        self.rng.next_timestep()
 
         if self.xs_dx is None:
             self.init_grid()
@@ -62,7 +65,7 @@ class IBM:
         state = self.state
 
         # Random diffusion velocity
-        rand = np.random.normal(size=len(state.Z))
+        rand = self.rng.normal(particle_ids(state), 'vertdiff')
         state['Z'] += rand * np.sqrt(2 * self.D * self.dt)
 
         # Keep within vertical limits, reflexive condition
@@ -1,4 +1,5 @@
 import numpy as np
+from ..utils import make_rng, particle_ids, ParticleHistory, make_stage_timer
 
 
 class IBM:
@@ -16,6 +17,12 @@ class IBM:
         # Store time step value to calculate age
         self.dt = config['dt']
 
+        # Random numbers, 'legacy' or 'philox'
+        self.rng = make_rng(config['ibm'])
+
+        # Time spent in each stage, enabled by 'profile'
+        self.timer = make_stage_timer(config['ibm'], 'mine')
+
         # Possible separate output file to record time (and place) of death
         self.output_file = config["ibm"].get('output_file', None)
         self.output_vars = {
@@ -27,9 +34,7 @@ class IBM:
 
         # Record positions to know if the particles are stuck near land
         self.land_collision = config["ibm"].get('land_collision', 'reposition')
-        self.x = np.array([])
-        self.y = np.array([])
-        self.pid = np.array([])
+        self.history = ParticleHistory()
 
         # Reference to other modules
         self.grid = None
@@ -44,19 +49,29 @@ class IBM:
         self.grid = grid
         self.forcing = forcing
         self.state = state
+        self.rng.next_timestep()
 
         if self.has_active():
             has_been_buried_before = (self.state.active != 1)
         else:
             has_been_buried_before = None
 
-        self.reposition()
-        self.resuspend()
-        self.diffuse()
-        self.sink()
-        self.bury()
-        self.kill_old()
-        self.store()
+        timer = self.timer
+        num = len(state.X)
+        with timer.stage('reposition', num):
+            self.reposition()
+        with timer.stage('resuspend', num):
+            self.resuspend()
+        with timer.stage('diffuse', num):
+            self.diffuse()
+        with timer.stage('sink', num):
+            self.sink()
+        with timer.stage('bury', num):
+            self.bury()
+        with timer.stage('kill_old', num):
+            self.kill_old()
+        with timer.stage('store', num):
+            self.store()
 
         if self.has_active():
             is_active = (self.state.active != 0)
@@ -83,23 +98,16 @@ class IBM:
 
             # If particles have not moved: Assume they ended up on land.
             # If that is the case, reposition them within the cell.
-            pid, pidx_old, pidx_new = np.intersect1d(self.pid, state.pid, return_indices=True)
-            onland = ((self.x[pidx_old] == X[pidx_new]) &
-                      (self.y[pidx_old] == Y[pidx_new]) &
-                      np.bool_(a[pidx_new])
-                      )
-            num_onland = np.count_nonzero(onland)
-            pidx_new_onland = pidx_new[onland]
-            x_new = np.round(X[pidx_new_onland]) - 0.5 + np.random.rand(num_onland)
-            y_new = np.round(Y[pidx_new_onland]) - 0.5 + np.random.rand(num_onland)
-            X[pidx_new_onland] = x_new
-            Y[pidx_new_onland] = y_new
+            onland = self.history.unchanged(state.pid, X=X, Y=Y) & np.bool_(a)
+            pid_onland = state.pid[onland]
+            x_new = np.round(X[onland]) - 0.5 + self.rng.uniform(pid_onland, 'reposition_x')
+            y_new = np.round(Y[onland]) - 0.5 + self.rng.uniform(pid_onland, 'reposition_y')
+            X[onland] = x_new
+            Y[onland] = y_new
 
             state['X'] = X
             state['Y'] = Y
-            self.x = np.copy(state.X)
-            self.y = np.copy(state.Y)
-            self.pid = state.pid
+            self.history.store(state.pid, X=state.X, Y=state.Y)
 
     def resuspend(self):
         if self.taucrit_fn is None:
@@ -139,7 +147,8 @@ class IBM:
 
         # Diffusion
         b0 = np.sqrt(2 * self.vdiff)
-        dw = np.random.randn(z.size).reshape(z.shape) * np.sqrt(dt)
+        pid = particle_ids(self.state)[a]
+        dw = self.rng.normal(pid, 'vertdiff').reshape(z.shape) * np.sqrt(dt)
         z1 = z + b0 * dw
 
         # Reflexive boundary condition at the top
@@ -210,24 +219,6 @@ def get_taucrit_fn(value):
         return lambda lon, lat: np.zeros_like(lon) + value
 
 
-def get_vdiff_constant_fn(value):
-    def fn(z, h, dt, _):
-        # Diffusion
-        b0 = np.sqrt(2 * value)
-        dw = np.random.randn(z.size).reshape(z.shape) * np.sqrt(dt)
-        z1 = z + b0 * dw
-
-        # Reflexive boundary conditions
-        z1[z1 < 0] *= -1  # Surface
-        below_seabed = z1 > h
-        z1[below_seabed] = 2*h[below_seabed] - z1[below_seabed]
-
-        # Return new vertical position
-        return z1
-
-    return fn
-
-
 def create_outfile(fname, variables):
     import netCDF4 as nc
     with nc.Dataset(fname, 'w') as dset:
@@ -4,6 +4,8 @@ import threading
 import datetime
 from pyproj import CRS, Transformer
 
+from ..utils.iostats import IOStats
+
 
 class Grid:
     def __init__(self, config):
@@ -78,7 +80,9 @@ class Forcing:
 
         self._grid = grid
         server = config['gridforce'].get('input_file', None)
-        self.dbase = OnlineDatabase(server)
+        log_interval = config['gridforce'].get('io_log_interval', 0)
+        self.io_stats = IOStats('OnlineDatabase', log_interval)
+        self.dbase = OnlineDatabase(server, self.io_stats)
         dset = self.dbase.get_dset(config['start_time'])
         self.dvars = dict(
             h=dset.variables['h'][:].filled(0),
@@ -88,6 +92,7 @@ class Forcing:
         )
 
     def update(self, t):
+        self.io_stats.step()
         self.current_time = self.timeconfig['start'] + np.timedelta64(
             self.timeconfig['step'] * t, 's')
 
@@ -118,10 +123,11 @@ def interp(arr, i, j, k):
 class OnlineDatabase:
     default_database = "https://thredds.met.no/thredds/dodsC/fou-hi/norkyst800m-1h/NorKyst-800m_ZDEPTHS_his.an.{year:04}{month:02}{day:02}00.nc"
 
-    def __init__(self, pattern=None):
+    def __init__(self, pattern=None, io_stats=None):
         self._dset_buf = Buffer()
         self._vars_buf = Buffer()
         self.pattern = pattern or self.default_database
+        self.io_stats = io_stats or IOStats('OnlineDatabase')
 
     def get_var(self, name, time):
         val_1 = self._get_var(name, time)
@@ -135,8 +141,11 @@ class OnlineDatabase:
         tstr = str(time.astype('datetime64[h]'))
         key = (name, tstr)
         if key not in self._vars_buf:
-            v = dset[name][tidx, ...].filled(0)
+            with self.io_stats.measure('get_var', hit=False) as m:
+                v = m.add(dset[name][tidx, ...].filled(0))
             self._vars_buf.push(key, v, tstr)
+        else:
+            self.io_stats.hit('get_var')
         return self._vars_buf[key]
 
     def get_dset(self, time):
@@ -144,7 +153,11 @@ class OnlineDatabase:
         tstr = str(time.astype('datetime64[D]'))
         pat = self.pattern.format(year=t.year, month=t.month, day=t.day)
         if pat not in self._dset_buf:
-            self._dset_buf.push(pat, nc.Dataset(pat), tstr)
+            with self.io_stats.measure('get_dset', hit=False):
+                dset = nc.Dataset(pat)
+            self._dset_buf.push(pat, dset, tstr)
+        else:
+            self.io_stats.hit('get_dset')
         return self._dset_buf[pat]
 
     def request_dset(self, time, when_finished):
@@ -24,3 +24,22 @@ class Test_OnlineDatabase_request_dset:
 
         th = dbase.request_dset(time, check)
         th.join()
+
+
+class Test_OnlineDatabase_io_stats:
+    def test_counts_reads_and_cache_hits(self):
+        import os
+        fname = os.path.join(os.path.dirname(gridforce.__file__), 'forcing.nc')
+        time = np.datetime64('2020-01-01T00:30')
+        dbase = gridforce.OnlineDatabase(fname)
+        dbase.get_var('u', time)
+        dbase.get_var('u', time)
+
+        ops = dbase.io_stats.summary()['operations']
+        assert ops['get_dset']['calls'] == 1
+        assert ops['get_dset']['hits'] == 3
+        assert ops['get_var']['calls'] == 2
+        assert ops['get_var']['misses'] == 2
+        assert ops['get_var']['hits'] == 2
+        assert ops['get_var']['shape'] == (16, 6, 5)
+        assert ops['get_var']['bytes'] == 2 * 16 * 6 * 5 * 4
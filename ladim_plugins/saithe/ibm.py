@@ -1,5 +1,5 @@
 import numpy as np
-from ..utils import light, density, viscosity
+from ..utils import light, density, viscosity, make_rng, particle_ids
 from ..larvae.ibm import weight_to_length, sinkvel_egg, growth_cod_larvae
 
 
@@ -12,6 +12,7 @@ class IBM:
 
         self.dt = config['dt']
         self.extra_spreading = config['ibm'].get('extra_spreading', True)
+        self.rng = make_rng(config['ibm'])
 
         self.hatch_day = 60      # Hatch day [degree days]
         self.egg_diam = 0.0011   # Egg diameter [m]
@@ -28,6 +29,7 @@ class IBM:
         self.grid = grid
         self.state = state
         self.forcing = forcing
+        self.rng.next_timestep()
 
         # --- Update forcing ---
         state['temp'] = forcing.field(state.X, state.Y, state.Z, 'temp')
@@ -65,7 +67,7 @@ class IBM:
 
         # --- Vertical turbulent mixing ---
         if self.D:
-            W += np.random.normal(size=len(W)) * np.sqrt(2 * self.D / self.dt)
+            W += self.rng.normal(particle_ids(state), 'vertdiff') * np.sqrt(2 * self.D / self.dt)
 
         # --- Execute vertical movement ---
         Z = state.Z + W * self.dt
@@ -79,8 +81,8 @@ class IBM:
         # Set direction for new particles
         direction = self.state['direction']
         idx_new_particles = (direction == 0)
-        num_new_particles = np.count_nonzero(idx_new_particles)
-        new_directions = 2 * np.pi * np.random.rand(num_new_particles)
+        pid = particle_ids(self.state)
+        new_directions = 2 * np.pi * self.rng.uniform(pid[idx_new_particles], 'direction')
 
         # Let some of the new particles be non-directed
         new_directions /= fraction_directed
@@ -1,5 +1,6 @@
 import numpy as np
 from ladim.ibms import light
+from ..utils import make_rng, particle_ids
 
 
 class IBM:
@@ -19,8 +20,12 @@ class IBM:
 
         self.dt = config["dt"]
         self.mortality_factor = np.exp(-mortality * self.dt / 86400)
+        self.rng = make_rng(config["ibm"])
 
     def update_ibm(self, grid, state, forcing):
+        self.rng.next_timestep()
+        pid = particle_ids(state)
+
         # Mortality
         state['super'] *= self.mortality_factor
 
@@ -44,7 +49,7 @@ class IBM:
 
         # Downwards if salinity is too low
         nauplie = state.age < 40
-        state_rand = np.random.rand(*state.salt.shape)
+        state_rand = self.rng.uniform(pid, 'salinity')
         not_enough_salt_cop = state.salt < 28 - state_rand*8
         W[~nauplie & not_enough_salt_cop] = self.swim_vel
 
@@ -53,7 +58,7 @@ class IBM:
 
         # Random diffusion velocity
         if self.vertical_diffusion:
-            rand = np.random.normal(size=len(W))
+            rand = self.rng.normal(pid, 'vertdiff')
             W += rand * (2 * self.D / self.dt) ** 0.5
 
         # Update vertical position, using reflexive boundary condition at the top
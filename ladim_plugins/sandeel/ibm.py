@@ -1,5 +1,6 @@
 import numpy as np
 from scipy.interpolate import RectBivariateSpline
+from ..utils import make_rng, particle_ids
 
 
 class IBM:
@@ -9,6 +10,7 @@ class IBM:
         self.D = config['ibm']['vertical_mixing']
         self.dt = config['dt']
         self.maxdepth = config['ibm']['max_depth']
+        self.rng = make_rng(config['ibm'])
 
         self.state = None
         self.grid = None
@@ -18,6 +20,7 @@ class IBM:
         self.state = state
         self.grid = grid
         self.forcing = forcing
+        self.rng.next_timestep()
 
         self.initialize_hatch_rate()
 
@@ -33,7 +36,7 @@ class IBM:
         h = self.state['hatch_rate']
         idx = (h == 0)
         if np.any(idx):
-            h[idx] = np.random.rand(np.count_nonzero(idx))
+            h[idx] = self.rng.uniform(particle_ids(self.state)[idx], 'hatch_rate')
 
     def bottom_temp(self):
         i = np.round(self.state['X'] - self.grid.grid.i0).astype('i4')
@@ -48,7 +51,7 @@ class IBM:
         z = state['Z'][idx]
 
         # Random diffusion velocity
-        rand = np.random.normal(size=len(z))
+        rand = self.rng.normal(particle_ids(self.state)[idx], 'vertdiff')
         z += rand * np.sqrt(2 * self.D * self.dt)
 
         # Keep within vertical limits, reflexive condition
@@ -1,4 +1,5 @@
 import numpy as np
+from ..utils import state_chunks, make_rng, particle_ids, LegacyRandom, make_stage_timer
 
 
 class IBM:
@@ -13,6 +14,15 @@ class IBM:
         # Store time step value to calculate age
         self.dt = config['dt']
 
+        # Maximal number of particles processed in one batch
+        self.chunk_size = config['ibm'].get('chunk_size', None)
+
+        # Random numbers, 'legacy' or 'philox'
+        self.rng = make_rng(config['ibm'])
+
+        # Time spent in each stage, enabled by 'profile'
+        self.timer = make_stage_timer(config['ibm'], 'sedimentation')
+
         # Reference to other modules
         self.grid = None
         self.forcing = None
@@ -26,15 +36,33 @@ class IBM:
         self.grid = grid
         self.forcing = forcing
         self.state = state
+        self.rng.next_timestep()
+        timer = self.timer
 
         has_been_buried_before = (self.state.active != 1)
 
-        self.initialize()
-        self.resuspend()
-        self.diffuse()
-        self.sink()
-        self.bury()
-        self.kill_old()
+        with timer.stage('initialize', len(state.Z)):
+            self.initialize()
+
+        for chunk in state_chunks(state, self.chunk_size, len(state.Z)):
+            self.state = chunk
+            if chunk is not state:
+                self._ustar_tstep = -1  # Bottom shear velocity is per chunk
+            num = len(chunk.Z)
+            with timer.stage('resuspend', num):
+                self.resuspend()
+            with timer.stage('diffuse', num):
+                self.diffuse()
+            with timer.stage('sink', num):
+                self.sink()
+            with timer.stage('bury', num):
+                self.bury()
+
+        self.state = state
+        if self.chunk_size:
+            self._ustar_tstep = -1
+        with timer.stage('kill_old', len(state.Z)):
+            self.kill_old()
 
         is_active = (self.state.active != 0)
         self.state.active[is_active & has_been_buried_before] = 2
@@ -45,7 +73,8 @@ class IBM:
         num_new_particles = np.count_nonzero(idx_new_particles)
 
         if num_new_particles:
-            state['sink_vel'][idx_new_particles] = sinkvel(num_new_particles)
+            pid = particle_ids(state)[idx_new_particles]
+            state['sink_vel'][idx_new_particles] = sinkvel(num_new_particles, self.rng, pid)
 
     def resuspend(self):
         if self.taucrit_fn is None:
@@ -81,8 +110,9 @@ class IBM:
         x, y, z = self.state.X[a], self.state.Y[a], self.state.Z[a]
         h = self.grid.sample_depth(x, y)
         ustar = self.shear_velocity_btm()[a]
+        pid = particle_ids(self.state)[a]
 
-        self.state.Z[a] = self.vdiff_fn(z, h, self.dt, ustar)
+        self.state.Z[a] = self.vdiff_fn(z, h, self.dt, ustar, self.rng, pid)
 
     def sink(self):
         # Get parameters
@@ -121,7 +151,7 @@ def shear_stress_btm(ustar):
     return ustar * ustar * rho
 
 
-def ladis(x0, t0, t1, v, K):
+def ladis(x0, t0, t1, v, K, rng=None, pid=None):
     """
     Lagrangian Advection and DIffusion Solver.
 
@@ -155,16 +185,20 @@ def ladis(x0, t0, t1, v, K):
     :param v:  The velocity. A function (x, t) --> x-like.
     :param K:  The diagonal elements of the diffusion tensor.
                A function (x, t) --> x-like.
+    :param rng: Random number service. Defaults to the global numpy
+               generator.
+    :param pid: Identifiers, one per element of x0, for the random numbers.
     :return:   An x0-like array of the new particle positions.
     """
 
+    rng, pid = _default_rng(rng, pid, x0)
     dt = t1 - t0
 
     # --- Diffusion, LaBolle scheme ---
 
     # First diffusion step (predictor)
     b0 = np.sqrt(2 * K(x0, t0))
-    dw = np.random.randn(x0.size).reshape(x0.shape) * np.sqrt(dt)
+    dw = rng.normal(pid, 'ladis').reshape(x0.shape) * np.sqrt(dt)
     x1 = x0 + b0 * dw
 
     # Second diffusion step (corrector)
@@ -269,10 +303,12 @@ def get_vdiff_fn(subconf):
 
 
 def get_vdiff_constant_fn(value):
-    def fn(z, h, dt, _):
+    def fn(z, h, dt, _, rng=None, pid=None):
+        rng, pid = _default_rng(rng, pid, z)
+
         # Diffusion
         b0 = np.sqrt(2 * value)
-        dw = np.random.randn(z.size).reshape(z.shape) * np.sqrt(dt)
+        dw = rng.normal(pid, 'vertdiff').reshape(z.shape) * np.sqrt(dt)
         z1 = z + b0 * dw
 
         # Reflexive boundary conditions
@@ -299,12 +335,13 @@ def get_vdiff_bounded_linear_fn(max_diff):
         dA_dz[cutoff] = 0
         return A, dA_dz
 
-    def fn(z, h, dt, ustar):
+    def fn(z, h, dt, ustar, rng=None, pid=None):
+        rng, pid = _default_rng(rng, pid, z)
         A, dA_dZ = get_turbulence(ustar, np.maximum(h - z, 0), max_diff)
 
         # Diffusion velocity, adding a pseudovelocity and evaluating the diffusion
         # in an upstream point
-        rand = np.random.normal(size=len(A))
+        rand = rng.normal(pid, 'vertdiff')
         diff_upstream = A + 0.5 * dA_dZ ** 2 * dt
         w = -dA_dZ + rand * np.sqrt(2 * diff_upstream / dt)
 
@@ -319,12 +356,22 @@ def get_vdiff_bounded_linear_fn(max_diff):
     return fn
 
 
-def sinkvel(n):
+def sinkvel(n, rng=None, pid=None):
     from scipy.interpolate import InterpolatedUnivariateSpline
+    rng, pid = _default_rng(rng, pid, np.empty(n))
     sinkvel_tab = np.array([.100, .050, .025, .015, .010, .005, 0])
     cumprob_tab = np.array([.000, .662, .851, .883, .909, .937, 1])
     fn = InterpolatedUnivariateSpline(cumprob_tab, sinkvel_tab, k=2)
-    return fn(np.random.rand(n))
+    return fn(rng.uniform(pid, 'sinkvel'))
+
+
+def _default_rng(rng, pid, z):
+    # Random number service and particle identifiers, if not given
+    if rng is None:
+        rng = LegacyRandom()
+    if pid is None:
+        pid = np.size(z)
+    return rng, pid
 
 
 def get_settled_particles(dset):
@@ -112,6 +112,22 @@ class Test_update:
 
         assert np.all(state.Z == 10)
 
+    def test_same_result_when_chunked(self):
+        ibmconf = dict(lifespan=100, taucrit=0.12, vertical_mixing=0.01)
+        results = []
+        for chunk_size in [None, 2]:
+            np.random.seed(0)
+            grid, state, forcing = self.gsf(num=5, hvel=1)
+            state.Z[:] = [0, 1, 5, 10, 10]
+            state.active[:] = [1, 1, 1, 0, 0]
+            config = dict(dt=state.dt, ibm=dict(chunk_size=chunk_size, **ibmconf))
+            my_ibm = ibm.IBM(config)
+
+            my_ibm.update_ibm(grid, state, forcing)
+            results.append((state.Z.tolist(), state.active.tolist()))
+
+        assert results[0] == results[1]
+
 
 class Test_ladis:
     def test_exact_when_trivial(self):
@@ -220,6 +236,25 @@ class Test_ladis:
         assert not np.any(too_low)
         assert not np.any(too_high)
 
+    def test_draws_from_given_rng(self):
+        from ladim_plugins.utils import make_rng
+        x0 = np.linspace(0, 1, 11)
+        pid = np.arange(11)
+
+        def advect_fn(x, _):
+            return np.zeros_like(x)
+
+        def diffuse_fn(x, _):
+            return np.ones_like(x)
+
+        rng = make_rng(dict(rng='philox', seed=1))
+        rng.next_timestep()
+        sol = ibm.ladis(x0, 0, 1, advect_fn, diffuse_fn, rng, pid)
+        sol_reversed = ibm.ladis(
+            x0[::-1], 0, 1, advect_fn, diffuse_fn, rng, pid[::-1])
+
+        assert np.allclose(sol, sol_reversed[::-1])
+
 
 def get_grainsize_fixture_fname():
     import ladim_plugins.tests
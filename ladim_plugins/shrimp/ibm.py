@@ -1,4 +1,5 @@
 import numpy as np
+from ..utils import make_rng, particle_ids
 
 
 class IBM:
@@ -17,6 +18,7 @@ class IBM:
         self.state = None
         self.forcing = None
         self.dt = config['dt']
+        self.rng = make_rng(config['ibm'])
 
         # Check if active parameter is in state (raises error if not present)
         if 'active' not in config['ibm']['variables']:
@@ -26,6 +28,7 @@ class IBM:
         self.grid = grid
         self.state = state
         self.forcing = forcing
+        self.rng.next_timestep()
 
         self.initialize()
         self.update_ibm_forcing()
@@ -45,8 +48,8 @@ class IBM:
         # Initialize quantile variable
         q = self.state['depth_quantile']
         is_not_initialized = q == 0
-        num = np.count_nonzero(is_not_initialized)
-        q[is_not_initialized] = np.random.rand(num)
+        pid = particle_ids(self.state)
+        q[is_not_initialized] = self.rng.uniform(pid[is_not_initialized], 'depth_quantile')
         self.state['depth_quantile'] = q
 
         # Initialize stage variable
@@ -88,7 +91,7 @@ class IBM:
         vertmix = self.vertical_mixing[int_stage]
 
         z = self.state['Z']
-        dw = np.random.normal(size=len(z))
+        dw = self.rng.normal(particle_ids(self.state), 'vertdiff')
         dz = np.sqrt(2 * vertmix * self.dt) * dw
         z += dz
         z[z < 0] *= -1  # Reflective boundary at surface
@@ -2,3 +2,8 @@ from .light import light
 from .eos import calc_density as density, viscosity
 from .rasterize import ladim_raster
 from .converter import ladim_file_to_sqlite
+from .chunks import state_chunks
+from .rng import make_rng, particle_ids, LegacyRandom, ParticleRandom
+from .history import ParticleHistory
+from .timing import make_stage_timer, StageTimer
+from .iostats import IOStats
@@ -0,0 +1,70 @@
+import numpy as np
+
+
+def state_chunks(state, chunk_size=None, num=None):
+    """
+    Split a particle state into consecutive chunks
+
+    Each chunk is a StateChunk, where the particle variables are views into
+    the arrays of the original state. Changes made to a chunk are therefore
+    visible in the original state.
+
+    :param state: The particle state
+    :param chunk_size: Maximal number of particles per chunk. If None or
+        zero, the original state is returned as a single chunk.
+    :param num: Number of particles. Default is the length of state['X'].
+    :return: An iterator of StateChunk objects
+    """
+    if num is None:
+        num = len(state['X'])
+
+    if not chunk_size or chunk_size >= num:
+        yield state
+        return
+
+    for start in range(0, num, chunk_size):
+        yield StateChunk(state, slice(start, min(start + chunk_size, num)), num)
+
+
+class StateChunk:
+    """
+    A slice of a particle state
+
+    Supports the same item and attribute access as the original state.
+    Particle variables are returned as views, other attributes (such as
+    dt and timestep) are returned as is. Assignments are written back to
+    the original arrays.
+    """
+
+    def __init__(self, state, index, num):
+        self.__dict__['_state'] = state
+        self.__dict__['_index'] = index
+        self.__dict__['_num'] = num
+
+    def _is_particle_variable(self, value):
+        return (
+            isinstance(value, np.ndarray)
+            and value.ndim == 1
+            and len(value) == self._num
+        )
+
+    def __getitem__(self, item):
+        value = self._state[item]
+        if self._is_particle_variable(value):
+            return value[self._index]
+        return value
+
+    def __setitem__(self, item, value):
+        self._state[item][self._index] = value
+
+    def __getattr__(self, item):
+        value = getattr(self._state, item)
+        if self._is_particle_variable(value):
+            return value[self._index]
+        return value
+
+    def __setattr__(self, item, value):
+        getattr(self._state, item)[self._index] = value
+
+    def __len__(self):
+        return self._index.stop - self._index.start
@@ -0,0 +1,81 @@
+import numpy as np
+
+
+class ParticleHistory:
+    """
+    Previous values of particle variables, looked up by pid
+
+    The values are stored together with a dense array mapping each pid to
+    its index in the stored arrays. Lookups are therefore O(1) per particle,
+    and do not require sorting. The mapping grows on demand, and its size is
+    bounded by the largest pid.
+
+    :param copy: If True (default), copies of the values are stored.
+        Otherwise, the arrays are stored by reference.
+    """
+
+    def __init__(self, copy=True):
+        self.copy = copy
+        self._index = np.array([], dtype=np.int64)  # pid -> index, or -1
+        self._pid = np.array([], dtype=np.int64)
+        self._values = dict()
+
+    def store(self, pid, **values):
+        """
+        Store particle values
+
+        :param pid: Particle identifiers
+        :param values: Particle variables, with one value per pid
+        """
+        pid = np.asarray(pid)
+        self._index[self._pid] = -1
+        self._grow(pid)
+        self._index[pid] = np.arange(len(pid))
+        self._pid = pid
+        self._values = {
+            k: np.copy(v) if self.copy else v for k, v in values.items()
+        }
+
+    def index(self, pid):
+        """Index of each particle in the stored arrays, or -1 if not stored"""
+        pid = np.asarray(pid)
+        self._grow(pid)
+        return self._index[pid]
+
+    def lookup(self, pid, name):
+        """
+        Stored values of a particle variable
+
+        :param pid: Particle identifiers
+        :param name: Name of the particle variable
+        :return: A tuple (values, found). Values of particles that are not
+            stored are undefined.
+        """
+        idx = self.index(pid)
+        found = idx >= 0
+        stored = self._values.get(name, ())
+        if len(stored) == 0:
+            return np.zeros(len(idx)), np.zeros(len(idx), dtype=bool)
+        return stored[np.maximum(idx, 0)], found
+
+    def unchanged(self, pid, **values):
+        """
+        Find particles where all the given variables equal the stored values
+
+        :param pid: Particle identifiers
+        :param values: Current particle variables, with one value per pid
+        :return: A boolean array, which is False for particles not stored
+        """
+        result = self.index(pid) >= 0
+        for name, value in values.items():
+            stored, _ = self.lookup(pid, name)
+            result &= stored == value
+        return result
+
+    def _grow(self, pid):
+        size = int(np.max(pid, initial=-1)) + 1
+        old_size = len(self._index)
+        if size > old_size:
+            index = np.full(max(size, 2 * old_size), -1, dtype=np.int64)
+            index[:old_size] = self._index
+            self._index = index
@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+
+class IOStats:
+    """
+    Counters and timers for file access
+
+    Each operation (such as reading a variable or opening a file) records
+    the number of calls, the time spent, the number of bytes read, the shape
+    of the last hyperslab read and the number of cache hits and misses. The
+    time spent is compared with the wall time since the object was created,
+    to tell whether a run is I/O-bound.
+
+    Usage: `with stats.measure('read_field') as m: m.add(var[...])`, and
+    `stats.hit('open')` or `stats.miss('open')` for cache lookups that do not
+    need timing. If the access must hold a lock, pass it to `measure`: the
+    time spent waiting for the lock is then recorded separately, and is not
+    part of the access time.
+
+    The counters may be updated from several threads, such as the prefetch
+    thread of a forcing.
+
+    :param name: Name used in the log line
+    :param log_interval: If positive, a summary line is written to the log
+        every `log_interval` calls to `step`
+    """
+
+    def __init__(self, name='io', log_interval=0):
+        self.name = name
+        self.log_interval = int(log_interval)
+        self.ops = dict()  # operation -> counters
+        self.steps = 0
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()  # Guards the counters
+
+    def _op(self, op):
+        s = self.ops.get(op)
+        if s is None:
+            s = self.ops[op] = dict(
+                calls=0, seconds=0., max_seconds=0., lock_seconds=0., bytes=0,
+                shape=None, hits=0, misses=0)
+        return s
+
+    def measure(self, op, hit=None, lock=None):
+        """
+        Context manager recording the latency of a file access
+
+        :param op: Name of the operation
+        :param hit: If True or False, the access is also counted as a cache
+            hit or miss
+        :param lock: If given, the lock is held during the access, and the
+            time spent waiting for it is recorded as `lock_seconds`
+        """
+        if hit is not None:
+            self._add(op, **{'hits' if hit else 'misses': 1})
+        return _Measurement(self, op, lock)
+
+    def hit(self, op, num=1):
+        """Count cache hits"""
+        self._add(op, hits=num)
+
+    def miss(self, op, num=1):
+        """Count cache misses"""
+        self._add(op, misses=num)
+
+    def _add(self, op, **counts):
+        with self._lock:
+            s = self._op(op)
+            for k, v in counts.items():
+                s[k] += v
+
+    def _record(self, op, seconds, lock_seconds, nbytes, shape):
+        with self._lock:
+            s = self._op(op)
+            s['calls'] += 1
+            s['seconds'] += seconds
+            s['max_seconds'] = max(s['max_seconds'], seconds)
+            s['lock_seconds'] += lock_seconds
+            s['bytes'] += nbytes
+            if shape is not None:
+                s['shape'] = shape
+
+    def _snapshot(self):
+        with self._lock:
+            return {op: dict(s) for op, s in self.ops.items()}
+
+    def totals(self, ops=None):
+        """Counters summed over all operations, and the wall time"""
+        if ops is None:
+            ops = self._snapshot()
+        keys = ['calls', 'seconds', 'lock_seconds', 'bytes', 'hits', 'misses']
+        total = {k: sum(s[k] for s in ops.values()) for k in keys}
+        total['wall_seconds'] = time.perf_counter() - self.start
+        return total
+
+    def summary(self):
+        """Counters per operation, and the totals"""
+        snapshot = self._snapshot()
+        ops = {
+            op: dict(s, mean_seconds=s['seconds'] / s['calls'] if s['calls'] else 0.)
+            for op, s in snapshot.items()
+        }
+        return dict(name=self.name, operations=ops, total=self.totals(snapshot))
+
+    def log_line(self):
+        t = self.totals()
+        fraction = t['seconds'] / t['wall_seconds'] if t['wall_seconds'] > 0 else 0.
+        return (
+            f"{self.name} I/O: {t['calls']} accesses, {t['bytes'] / 1e6:.1f} MB, "
+            f"{t['seconds']:.2f} s ({100 * fraction:.0f} % of wall time), "
+            f"cache hits {t['hits']}/{t['hits'] + t['misses']}")
+
+    def step(self):
+        """Count a model time step, and write the log line if due"""
+        self.steps += 1
+        if self.log_interval > 0 and self.steps % self.log_interval == 0:
+            logging.info(self.log_line())
+
+
+class _Measurement:
+    # Counts are collected here, and added to the IOStats object on exit
+    __slots__ = ('iostats', 'op', 'lock', 'start', 'lock_seconds', 'bytes', 'shape')
+
+    def __init__(self, iostats, op, lock=None):
+        self.iostats = iostats
+        self.op = op
+        self.lock = lock
+        self.start = 0.
+        self.lock_seconds = 0.
+        self.bytes = 0
+        self.shape = None
+
+    def add(self, array):
+        """Count an array that has been read, and return it"""
+        self.bytes += int(np.asarray(array).nbytes)
+        self.shape = tuple(int(n) for n in np.shape(array))
+        return array
+
+    def __enter__(self):
+        if self.lock is not None:
+            wait_start = time.perf_counter()
+            self.lock.acquire()
+            self.start = time.perf_counter()
+            self.lock_seconds = self.start - wait_start
+        else:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        if self.lock is not None:
+            self.lock.release()
+        self.iostats._record(
+            self.op, seconds, self.lock_seconds, self.bytes, self.shape)
+        return False
@@ -0,0 +1,194 @@
+import zlib
+import numpy as np
+
+
+def make_rng(config):
+    """
+    Random number service for an IBM
+
+    :param config: The IBM configuration. The key `rng` selects the
+        generator: "legacy" (default) draws from the global numpy generator,
+        and "philox" draws counter-based numbers keyed by particle. The key
+        `seed` is the seed of the "philox" generator.
+    :return: A LegacyRandom or ParticleRandom object
+    """
+    kind = config.get('rng', 'legacy')
+    if kind == 'legacy':
+        return LegacyRandom()
+    elif kind == 'philox':
+        return ParticleRandom(config.get('seed', None))
+    else:
+        raise ValueError(f'Unknown rng: {kind}')
+
+
+def particle_ids(state):
+    """
+    Particle identifiers of a state
+
+    Returns the particle indices instead, if the state has no `pid` variable.
+    """
+    try:
+        return state['pid']
+    except (KeyError, AttributeError):
+        return np.arange(len(state['X']))
+
+
+class LegacyRandom:
+    """
+    Random numbers from the global numpy generator
+
+    Draws the same sequence as calling `np.random` directly. The particle
+    identifiers are only used to determine the number of values, and the
+    stream and draw arguments are ignored.
+    """
+
+    def __init__(self):
+        self.timestep = -1
+
+    def next_timestep(self):
+        self.timestep += 1
+
+    def uniform(self, pid, stream='', draw=0, out=None):
+        """Uniform numbers in [0, 1), one per particle"""
+        return _fill(np.random.rand(_count(pid)), out)
+
+    def normal(self, pid, stream='', draw=0, out=None):
+        """Standard normal numbers, one per particle"""
+        return _fill(np.random.normal(size=_count(pid)), out)
+
+    def integers(self, high, pid, stream='', draw=0):
+        """Integers in [0, high), one per particle"""
+        return np.random.randint(0, high, size=_count(pid))
+
+
+class ParticleRandom:
+    """
+    Counter-based random numbers keyed by particle
+
+    Each value is computed by the Philox4x32-10 generator from the key
+    (seed, timestep) and the counter (pid, draw, stream). A particle
+    therefore gets the same values regardless of its position in the state
+    array, the chunk size or the number of worker processes.
+
+    The timestep is advanced by `next_timestep`, which the IBM calls once per
+    time step. Within a time step, different random terms must use different
+    streams, and repeated draws in the same stream must use different draw
+    numbers.
+
+    :param seed: Seed of the generator. If None, a seed is drawn from the
+        global numpy random generator.
+    """
+
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = int(np.random.randint(2**31))
+        self.seed = seed
+        self.timestep = -1
+        self._key = None
+        self._work = dict()
+
+    def next_timestep(self):
+        self.timestep += 1
+
+    def key(self):
+        """Philox key of the current time step"""
+        if self._key is None or self._key[0] != self.timestep:
+            seq = np.random.SeedSequence([self.seed, max(0, self.timestep)])
+            self._key = (self.timestep, tuple(int(k) for k in seq.generate_state(2)))
+        return self._key[1]
+
+    def uniform(self, pid, stream='', draw=0, out=None):
+        """Uniform numbers in [0, 1), one per particle"""
+        c0, c1 = self._words(pid, stream, draw)
+        np.right_shift(c0, 5, out=c0)
+        np.right_shift(c1, 6, out=c1)
+        c0 *= 67108864
+        c0 += c1
+        if out is None:
+            out = np.empty(len(c0))
+        return np.multiply(c0, 2.0**-53, out=out)
+
+    def normal(self, pid, stream='', draw=0, out=None):
+        """Standard normal numbers, one per particle"""
+        from scipy.special import ndtri
+        u = self.uniform(pid, stream, draw, out)
+        u += 2.0**-54  # Exclude 0
+        return ndtri(u, out=u)
+
+    def integers(self, high, pid, stream='', draw=0):
+        """Integers in [0, high), one per particle"""
+        return (self.uniform(pid, stream, draw) * high).astype(np.int64)
+
+    def _words(self, pid, stream, draw):
+        if np.ndim(pid) == 0:
+            pid = np.arange(pid)
+        pid = np.asarray(pid)
+        num = len(pid)
+
+        # Reuse the counter buffers between calls
+        work = self._work
+        if 'c0' not in work or len(work['c0']) < num:
+            for name in ['c0', 'c1', 'c2', 'c3', 'p0', 'p1']:
+                work[name] = np.empty(num, dtype=np.uint64)
+        c0, c1, c2, c3, p0, p1 = (
+            work[name][:num] for name in ['c0', 'c1', 'c2', 'c3', 'p0', 'p1'])
+
+        np.copyto(c0, pid, casting='unsafe')
+        np.right_shift(c0, 32, out=c1)
+        c0 &= _MASK
+        c2[:] = draw
+        c3[:] = zlib.crc32(stream.encode())
+        philox4x32((c0, c1, c2, c3), self.key(), work=(p0, p1))
+        return c0, c1
+
+
+_MASK = np.uint64(0xFFFFFFFF)
+_PHILOX_M = (np.uint64(0xD2511F53), np.uint64(0xCD9E8D57))
+_PHILOX_W = (0x9E3779B9, 0xBB67AE85)
+
+
+def philox4x32(counter, key, rounds=10, work=None):
+    """
+    The Philox4x32 block function (Salmon et al., 2011)
+
+    :param counter: Four uint64 arrays with 32-bit values, which are
+        overwritten by the output
+    :param key: Two 32-bit integers
+    :param rounds: Number of rounds
+    :param work: Two uint64 work arrays of the same shape as the counter
+    :return: The counter arrays
+    """
+    c0, c1, c2, c3 = counter
+    if work is None:
+        work = (np.empty_like(c0), np.empty_like(c0))
+    p0, p1 = work
+    k0, k1 = key
+
+    for _ in range(rounds):
+        np.multiply(c0, _PHILOX_M[0], out=p0)
+        np.multiply(c2, _PHILOX_M[1], out=p1)
+        np.right_shift(p1, 32, out=c0)
+        c0 ^= c1
+        c0 ^= np.uint64(k0)
+        np.bitwise_and(p1, _MASK, out=c1)
+        np.right_shift(p0, 32, out=c2)
+        c2 ^= c3
+        c2 ^= np.uint64(k1)
+        np.bitwise_and(p0, _MASK, out=c3)
+        k0 = (k0 + _PHILOX_W[0]) & 0xFFFFFFFF
+        k1 = (k1 + _PHILOX_W[1]) & 0xFFFFFFFF
+
+    return counter
+
+
+def _count(pid):
+    if np.ndim(pid) == 0:
+        return int(pid)
+    return len(pid)
+
+
+def _fill(values, out):
+    if out is None:
+        return values
+    out[...] = values
+    return out
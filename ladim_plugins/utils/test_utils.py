@@ -46,6 +46,205 @@ class Test_viscosity:
         assert mu.tolist() == [0.0013235000000000002, 0.0014155000000000003]
 
 
+class Test_state_chunks:
+    def test_chunks_are_views_into_state(self):
+        state = dict(X=np.arange(5.), Z=np.zeros(5))
+        chunks = list(utils.state_chunks(state, chunk_size=2))
+        assert [len(c) for c in chunks] == [2, 2, 1]
+
+        for i, chunk in enumerate(chunks):
+            chunk['Z'] += i
+        assert state['Z'].tolist() == [0, 0, 1, 1, 2]
+
+    def test_returns_state_if_no_chunk_size(self):
+        state = dict(X=np.arange(5.))
+        assert list(utils.state_chunks(state)) == [state]
+        assert list(utils.state_chunks(state, chunk_size=5)) == [state]
+
+
+class Test_rng:
+    def test_legacy_draws_from_global_generator(self):
+        rng = utils.make_rng(dict())
+        np.random.seed(0)
+        values = [rng.uniform(np.arange(3)), rng.normal(2), rng.integers(5, [7])]
+        np.random.seed(0)
+        expected = [np.random.rand(3), np.random.normal(size=2), np.random.randint(0, 5, 1)]
+        for v, e in zip(values, expected):
+            assert v.tolist() == e.tolist()
+
+    def test_philox_known_answer(self):
+        from ladim_plugins.utils.rng import philox4x32
+        words = (0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344)
+        counter = [np.array([w], dtype=np.uint64) for w in words]
+        out = philox4x32(counter, key=(0xa4093822, 0x299f31d0))
+        assert [int(c[0]) for c in out] == [
+            0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1]
+
+    def test_philox_values_are_keyed_by_pid(self):
+        rng = utils.make_rng(dict(rng='philox', seed=1))
+        rng.next_timestep()
+        pid = np.arange(10, 20)
+        u = rng.uniform(pid, 'a')
+        assert rng.uniform(pid[::-1], 'a').tolist() == u[::-1].tolist()
+        assert rng.uniform(pid[3:5], 'a').tolist() == u[3:5].tolist()
+
+    def test_philox_values_change_with_stream_draw_and_timestep(self):
+        rng = utils.ParticleRandom(seed=1)
+        rng.next_timestep()
+        pid = np.arange(5)
+        u = rng.uniform(pid, 'a')
+        assert not np.any(u == rng.uniform(pid, 'b'))
+        assert not np.any(u == rng.uniform(pid, 'a', draw=1))
+        rng.next_timestep()
+        assert not np.any(u == rng.uniform(pid, 'a'))
+
+    def test_philox_distributions(self):
+        rng = utils.ParticleRandom(seed=1)
+        pid = np.arange(100000)
+        u = rng.uniform(pid, 'a')
+        n = rng.normal(pid, 'b', out=np.empty(len(pid)))
+        assert 0 <= u.min() and u.max() < 1
+        assert np.abs(u.mean() - 0.5) < 0.01
+        assert np.abs(n.mean()) < 0.01
+        assert np.abs(n.std() - 1) < 0.01
+
+    def test_particle_ids_without_pid(self):
+        assert utils.particle_ids(dict(X=np.zeros(3))).tolist() == [0, 1, 2]
+        assert utils.particle_ids(dict(X=np.zeros(2), pid=[4, 5])) == [4, 5]
+
+    def test_unknown_rng(self):
+        with pytest.raises(ValueError):
+            utils.make_rng(dict(rng='unknown'))
+
+
+class Test_ParticleHistory:
+    def test_finds_unchanged_particles(self):
+        history = utils.ParticleHistory()
+        history.store(pid=[0, 3, 4], X=np.array([1., 2., 3.]), Y=np.array([4., 5., 6.]))
+        unchanged = history.unchanged(
+            pid=[3, 4, 9], X=np.array([2., 3.5, 0.]), Y=np.array([5., 6., 0.]))
+        assert unchanged.tolist() == [True, False, False]
+
+    def test_lookup_by_pid(self):
+        history = utils.ParticleHistory()
+        history.store(pid=[5, 2], X=np.array([1., 2.]))
+        values, found = history.lookup([2, 7, 5], 'X')
+        assert found.tolist() == [True, False, True]
+        assert values[found].tolist() == [2, 1]
+
+    def test_forgets_particles_not_in_last_store(self):
+        history = utils.ParticleHistory()
+        history.store(pid=[0, 1], X=np.array([1., 2.]))
+        history.store(pid=[1], X=np.array([2.]))
+        assert history.index([0, 1]).tolist() == [-1, 0]
+
+    def test_stores_copy_or_reference(self):
+        X = np.array([1., 2.])
+        copied = utils.ParticleHistory()
+        referenced = utils.ParticleHistory(copy=False)
+        copied.store(pid=[0, 1], X=X)
+        referenced.store(pid=[0, 1], X=X)
+        X += 1
+        assert copied.unchanged([0, 1], X=X).tolist() == [False, False]
+        assert referenced.unchanged([0, 1], X=X).tolist() == [True, True]
+
+
+class Test_StageTimer:
+    def test_records_nothing_when_disabled(self):
+        timer = utils.make_stage_timer(dict())
+        with timer.stage('diffuse', 10):
+            pass
+        assert not timer.enabled
+        assert timer.summary() == dict()
+
+    def test_records_calls_and_particles(self):
+        timer = utils.StageTimer(enabled=True)
+        for num in [10, 20]:
+            with timer.stage('diffuse', num):
+                pass
+        with timer.stage('sink', 5):
+            pass
+        summary = timer.summary()
+        assert summary['diffuse']['calls'] == 2
+        assert summary['diffuse']['particles'] == 30
+        assert summary['sink']['calls'] == 1
+        assert summary['sink']['seconds'] >= 0
+
+    def test_writes_json_file_when_closed(self, tmp_path):
+        import json
+        fname = tmp_path / 'profile.json'
+        timer = utils.make_stage_timer(dict(profile=str(fname)), 'chemicals')
+        with timer.stage('horzdiff', 3):
+            pass
+        timer.close()
+        with open(fname, encoding='utf-8') as fp:
+            stats = json.load(fp)
+        assert stats['chemicals']['horzdiff']['calls'] == 1
+        assert stats['chemicals']['horzdiff']['particles'] == 3
+
+    def test_writes_to_log_when_profile_is_true(self, caplog):
+        import logging
+        timer = utils.make_stage_timer(dict(profile=True), 'mine')
+        with timer.stage('bury', 7):
+            pass
+        with caplog.at_level(logging.INFO):
+            timer.close()
+        assert 'mine bury: 1 calls' in caplog.text
+
+
+class Test_IOStats:
+    def test_counts_bytes_shape_and_cache_hits(self):
+        stats = utils.IOStats()
+        with stats.measure('read', hit=False) as m:
+            m.add(np.zeros((2, 3), dtype='f4'))
+        stats.hit('read')
+        op = stats.summary()['operations']['read']
+        assert op['calls'] == 1
+        assert op['bytes'] == 24
+        assert op['shape'] == (2, 3)
+        assert (op['hits'], op['misses']) == (1, 1)
+
+    def test_writes_log_line_at_interval(self, caplog):
+        import logging
+        stats = utils.IOStats('Forcing', log_interval=2)
+        with caplog.at_level(logging.INFO):
+            stats.step()
+            assert 'Forcing I/O' not in caplog.text
+            stats.step()
+            assert 'Forcing I/O: 0 accesses' in caplog.text
+
+    def test_records_lock_wait_separately(self):
+        import threading
+        stats = utils.IOStats()
+        lock = threading.Lock()
+        lock.acquire()
+        threading.Timer(0.05, lock.release).start()
+        with stats.measure('read', lock=lock):
+            assert lock.locked()
+        op = stats.summary()['operations']['read']
+        assert not lock.locked()
+        assert op['lock_seconds'] >= 0.04
+        assert op['seconds'] < op['lock_seconds']
+
+    def test_counts_from_several_threads(self):
+        import threading
+        stats = utils.IOStats()
+
+        def count():
+            for _ in range(1000):
+                stats.hit('read')
+                with stats.measure('read') as m:
+                    m.add(np.zeros(2, dtype='f4'))
+
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        op = stats.summary()['operations']['read']
+        assert (op['calls'], op['hits'], op['bytes']) == (4000, 4000, 32000)
+
+
 class Test_ladim_raster:
     @pytest.fixture(scope='class')
     def ladim_dset(self):
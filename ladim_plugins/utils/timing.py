@@ -0,0 +1,123 @@
+import contextlib
+import json
+import logging
+import time
+import weakref
+
+
+def make_stage_timer(config, name='ibm'):
+    """
+    Stage timer for an IBM
+
+    :param config: The IBM configuration. The key `profile` enables the
+        timer: `true` writes the statistics to the log at the end of the run,
+        and a file name writes them to a JSON file instead.
+    :param name: Name of the IBM, used in the output
+    :return: A StageTimer object, which is disabled unless profiling is
+        requested
+    """
+    profile = config.get('profile', False)
+    if not profile:
+        return StageTimer(name, enabled=False)
+    output = None if profile is True else profile
+    return StageTimer(name, output=output)
+
+
+class StageTimer:
+    """
+    Wall time, call count and particle count per IBM stage
+
+    Usage: `with timer.stage('diffuse', num_particles): ...`. When disabled,
+    `stage` returns a shared no-op context manager, so the overhead is a
+    single method call per stage.
+
+    The statistics are written when the timer is closed, garbage collected
+    or at interpreter exit, whichever comes first. The IBM wrapper in ladim
+    does not forward close(), so the last two are the common case.
+
+    :param name: Name of the IBM, used in the output
+    :param enabled: If False, nothing is recorded or written
+    :param output: JSON file for the statistics. If None, the statistics
+        are written to the log.
+    """
+
+    def __init__(self, name='ibm', enabled=True, output=None):
+        self.name = name
+        self.enabled = enabled
+        self.output = output
+        self.stats = dict()  # stage name -> dict(calls, seconds, particles)
+        self._finalizer = None
+        if enabled:
+            self._finalizer = weakref.finalize(
+                self, write_stage_stats, self.stats, name, output)
+
+    def stage(self, name, num=0):
+        """
+        Context manager recording the time spent in a stage
+
+        :param name: Name of the stage
+        :param num: Number of particles processed by the stage
+        """
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self.stats, name, num)
+
+    def summary(self):
+        """Statistics per stage, including the mean time per call"""
+        return stage_summary(self.stats)
+
+    def close(self):
+        """Write the statistics, if not already written"""
+        if self._finalizer is not None:
+            self._finalizer()
+
+
+class _Stage:
+    __slots__ = ('stats', 'name', 'num', 'start')
+
+    def __init__(self, stats, name, num):
+        self.stats = stats
+        self.name = name
+        self.num = num
+        self.start = 0.
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        s = self.stats.get(self.name)
+        if s is None:
+            s = self.stats[self.name] = dict(calls=0, seconds=0., particles=0)
+        s['calls'] += 1
+        s['seconds'] += seconds
+        s['particles'] += int(self.num)
+        return False
+
+
+_NO_STAGE = contextlib.nullcontext()
+
+
+def stage_summary(stats):
+    return {
+        name: dict(s, mean_seconds=s['seconds'] / s['calls'])
+        for name, s in stats.items()
+    }
+
+
+def write_stage_stats(stats, name, output=None):
+    """Write stage statistics to a JSON file, or to the log if no file is given"""
+    if not stats:
+        return
+
+    summary = stage_summary(stats)
+    if output is not None:
+        with open(output, 'w', encoding='utf-8') as fp:
+            json.dump({name: summary}, fp, indent=2)
+        return
+
+    for stage, s in summary.items():
+        logging.info(
+            f'{name} {stage}: {s["calls"]} calls, {s["seconds"]:.3f} s, '
+            f'{s["particles"]} particles, {1000 * s["mean_seconds"]:.3f} ms per call')
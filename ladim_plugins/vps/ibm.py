@@ -1,4 +1,5 @@
 import numpy as np
+from ..utils import make_rng, particle_ids
 
 
 class IBM:
@@ -7,9 +8,12 @@ class IBM:
         self.vertical_diffusion = self.D > 0
         self.dt = config["dt"]
         self.fjord_index_file = config["ibm"]["fjord_index_file"]
+        self.rng = make_rng(config["ibm"])
 
     def update_ibm(self, grid, state, forcing):
         fjord_index = np.load(self.fjord_index_file)
+        self.rng.next_timestep()
+        pid = particle_ids(state)
 
         state.age += state.dt #/ 86400
         swim_vel = state.size # assume 1bl/sec   
@@ -20,6 +24,11 @@ class IBM:
         ddx = []
         ddy = []
 
+        # Draw the random choices for all particles at once
+        rand_xdir = self.rng.uniform(pid, 'xdir')
+        rand_ydir = self.rng.uniform(pid, 'ydir')
+        rand_xory = self.rng.integers(2, pid, 'xory')
+
         for n in range(len(state.X)):
             x = int(state.X[n])
             y = int(state.Y[n])
@@ -30,9 +39,9 @@ class IBM:
             yv = [fjord_index[y-1,x],fjord_index[y,x],fjord_index[y+1,x]]
 
             r = np.where(xv==min(xv))[0] # liste x-retn som er nermere havet
-            xdir = delta[r[np.random.randint(0,len(r))]] # trekker tilf i lista
+            xdir = delta[r[int(rand_xdir[n] * len(r))]] # trekker tilf i lista
             r = np.where(yv==min(yv))[0]
-            ydir = delta[r[np.random.randint(0,len(r))]]
+            ydir = delta[r[int(rand_ydir[n] * len(r))]]
 
             # beregner svommedist i x eller y retn
             if xdir == 0:
@@ -40,7 +49,7 @@ class IBM:
             elif ydir == 0:
                 r = 1
             else:
-                r = np.random.randint(0,2)
+                r = rand_xory[n]
             ddx.append(r * swim_vel * xdir * self.dt /dx)
             ddy.append((1-r) * swim_vel * ydir * self.dt /dy)
 
@@ -52,7 +61,7 @@ class IBM:
 
         # Random vertical diffusion velocity
         if self.vertical_diffusion:
-            rand = np.random.normal(size=len(W))
+            rand = self.rng.normal(pid, 'vertdiff')
             W += rand * (2*self.D/self.dt)**0.5
 
             # Update vertical position